@@ -1,26 +1,55 @@
-from flask import Flask, request, send_file, render_template
+from flask import Flask, Response, request, send_file, render_template, stream_with_context
 from flask_cors import CORS
+from functools import partial
+from werkzeug.exceptions import HTTPException
 import io
+import json
 import os
-import zipfile
-from PIL import Image
 
+from backend.admission import ImageTooLarge, Overloaded, batch_memory, check_image, memory_budget
+from backend.animation import animated_format, output_format_for
+from backend.batch import default_workers, iter_zip, parallel_map, process_batch
+from backend.batch_mask import SharedMaskStage, estimate_animation_mask, estimate_shared_mask
+from backend.cache import result_cache
+from backend.fonts import font_path, register_font
+from backend.image_store import image_store
+from backend import metrics
+from backend.jobs import (
+    QueueFull,
+    get_status as get_job_status,
+    result_path as job_result_path,
+    submit as submit_job
+)
+from backend.inpaint import INPAINT_ENGINES
+from backend.preview import render_preview
+from backend.resize import Resize, image_size
+from backend.tiling import TILE_MEMORY_BUDGET, TiledStage
 from backend.watermark_remover import (
-    remove_watermark_auto,
-    remove_watermark_region,
-    remove_watermark_color,
-    remove_watermark_frequency,
-    add_text_watermark,
-    add_image_watermark,
-    add_qrcode_watermark,
-    add_datetime_watermark
+    run_pipeline,
+    remove_watermark_auto_array,
+    remove_watermark_region_array,
+    remove_watermark_color_array,
+    remove_watermark_frequency_array,
+    TextWatermark,
+    ImageWatermark,
+    QRCodeWatermark,
+    WatermarkStack
 )
 
 app = Flask(__name__)
 CORS(app)
 
-# 配置上传文件大小限制
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB
+# 配置上传文件大小限制（环境变量 MAX_UPLOAD_MB，默认 16MB）
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_UPLOAD_MB', 16)) * 1024 * 1024
+
+# 分块处理的工作内存预算（MB，环境变量 TILE_MEMORY_BUDGET），超过一个分块的大图按块处理
+app.config['TILE_MEMORY_BUDGET'] = TILE_MEMORY_BUDGET
+
+# 批量处理的工作进程数（环境变量 BATCH_WORKERS，默认 CPU 核数）
+app.config['BATCH_WORKERS'] = default_workers()
+
+# 多水印叠加时单次请求的图层数上限（环境变量 MAX_WATERMARK_LAYERS，默认 10）
+app.config['MAX_WATERMARK_LAYERS'] = int(os.environ.get('MAX_WATERMARK_LAYERS', 10))
 
 
 def hex_to_bgr(hex_color):
@@ -33,416 +62,927 @@ def hex_to_bgr(hex_color):
 
 
 def convert_image_format(image_bytes, output_format='png', quality=95):
-    """转换图片格式和压缩质量"""
-    img = Image.open(io.BytesIO(image_bytes))
-
-    # 确保正确的模式
-    if output_format.lower() == 'jpeg' or output_format.lower() == 'jpg':
-        if img.mode in ('RGBA', 'P'):
-            img = img.convert('RGB')
-
-    output = io.BytesIO()
-
-    if output_format.lower() in ('jpeg', 'jpg'):
-        img.save(output, format='JPEG', quality=quality, optimize=True)
-    elif output_format.lower() == 'webp':
-        img.save(output, format='WEBP', quality=quality)
-    else:  # PNG
-        if quality < 100:
-            # PNG 使用 compress_level (0-9)
-            compress_level = max(0, min(9, int((100 - quality) / 11)))
-            img.save(output, format='PNG', compress_level=compress_level)
-        else:
-            img.save(output, format='PNG')
+    """转换图片格式和压缩质量（结果缓存同流水线）"""
+    return run_pipeline(image_bytes, [], output_format, quality)
 
-    return output.getvalue()
 
+class ParamError(ValueError):
+    """请求参数错误（默认返回 400）"""
 
-@app.route('/')
-def index():
-    return render_template('index.html')
-
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
 
-@app.route('/api/remove-watermark', methods=['POST'])
-def remove_watermark():
-    if 'image' not in request.files:
-        return {'error': '没有上传图片'}, 400
 
-    file = request.files['image']
-    if file.filename == '':
-        return {'error': '没有选择文件'}, 400
+def check_image_size(image_bytes, name=None):
+    """解码前按文件头检查像素数，超过上限返回 413（批量时错误信息带文件名）"""
+    try:
+        check_image(image_bytes)
+    except ImageTooLarge as e:
+        raise ParamError(f'{name}: {e}' if name else str(e), status=413)
 
-    method = request.form.get('method', 'auto')
-    image_bytes = file.read()
 
+def memory_estimate(tasks, workers=1):
+    """任务的峰值内存估计（字节），单张所需内存超过整个预算时返回 413"""
     try:
-        if method == 'auto':
-            threshold = int(request.form.get('threshold', 200))
-            result_bytes = remove_watermark_auto(image_bytes, threshold=threshold)
-
-        elif method == 'region':
-            x = int(request.form.get('x', 0))
-            y = int(request.form.get('y', 0))
-            width = int(request.form.get('width', 100))
-            height = int(request.form.get('height', 50))
-            result_bytes = remove_watermark_region(image_bytes, x, y, width, height)
-
-        elif method == 'color':
-            color_lower = request.form.get('color_lower', '#c8c8c8')
-            color_upper = request.form.get('color_upper', '#ffffff')
-            lower_bgr = hex_to_bgr(color_lower)
-            upper_bgr = hex_to_bgr(color_upper)
-            result_bytes = remove_watermark_color(image_bytes, lower_bgr, upper_bgr)
-
-        elif method == 'frequency':
-            result_bytes = remove_watermark_frequency(image_bytes)
+        return batch_memory(tasks, workers)
+    except ImageTooLarge as e:
+        raise ParamError(str(e), status=413)
+
+
+def admit_tasks(tasks, workers=1):
+    """
+    按估计的峰值内存为任务预留内存，返回 Reservation（处理完成后释放）
+    预算不足时排队等待，超时抛出 Overloaded（返回 503 + Retry-After）
+    """
+    return memory_budget.reserve(memory_estimate(tasks, workers))
+
+
+def overloaded_response(e):
+    """内存预算已满：503，客户端按 Retry-After 稍后重试"""
+    return {'error': str(e)}, 503, {'Retry-After': str(e.retry_after)}
+
+
+def tiled(stage):
+    """按配置的内存预算分块执行处理阶段"""
+    return TiledStage(stage, app.config['TILE_MEMORY_BUDGET'])
+
+
+def scale_px(value, scale, minimum=0):
+    """按预览缩放比例映射像素参数（整图 -> 代理图）"""
+    if scale == 1.0:
+        return value
+    return max(minimum, int(round(value * scale)))
+
+
+def read_inpaint_engine(form):
+    """修复引擎：telea（默认）或 pyramid（金字塔由粗到细，大面积遮罩更快）"""
+    engine = form.get('inpaint_engine', 'telea')
+    if engine not in INPAINT_ENGINES:
+        raise ParamError('未知的修复引擎')
+    return engine
+
+
+def build_remove_stage(form, method=None, scale=1.0):
+    """
+    根据表单参数构造去水印处理阶段
+    scale 为预览代理图相对原图的缩放比例，坐标与面积参数按比例映射
+    """
+    method = method or form.get('method', 'auto')
+    engine = read_inpaint_engine(form)
+
+    if method == 'auto':
+        threshold = int(form.get('threshold', 200))
+        # 面积按像素数计，随缩放比例的平方变化
+        min_area = scale_px(int(form.get('min_area', 100)), scale * scale)
+        max_area = scale_px(int(form.get('max_area', 50000)), scale * scale, minimum=1)
+        return tiled(partial(remove_watermark_auto_array, threshold=threshold,
+                             min_area=min_area, max_area=max_area, inpaint_engine=engine))
+
+    elif method == 'region':
+        x = scale_px(int(form.get('x', 0)), scale)
+        y = scale_px(int(form.get('y', 0)), scale)
+        width = scale_px(int(form.get('width', 100)), scale, minimum=1)
+        height = scale_px(int(form.get('height', 50)), scale, minimum=1)
+        # 区域修复只在选区附近的局部区域内运行，内存与选区大小相关，无需分块
+        return partial(remove_watermark_region_array, x=x, y=y, width=width, height=height,
+                       inpaint_engine=engine)
+
+    elif method == 'color':
+        color_lower = form.get('color_lower', '#c8c8c8')
+        color_upper = form.get('color_upper', '#ffffff')
+        lower_bgr = hex_to_bgr(color_lower)
+        upper_bgr = hex_to_bgr(color_upper)
+        return tiled(partial(remove_watermark_color_array, color_lower=lower_bgr, color_upper=upper_bgr,
+                             inpaint_engine=engine))
+
+    elif method == 'frequency':
+        # 频域滤波作用于整幅频谱，不能分块
+        return remove_watermark_frequency_array
+
+    raise ParamError('未知的处理方式')
+
+
+def build_batch_remove_stage(form, index, scale=1.0):
+    """构造批量去水印中第 index 张图片的处理阶段（scale 同 build_remove_stage）"""
+    method = form.get('method', 'auto')
+
+    if method == 'region':
+        # 手动区域模式
+        region_mode = form.get('region_mode', 'unified')
+        if region_mode == 'unified':
+            x = int(form.get('region_x', 0))
+            y = int(form.get('region_y', 0))
+            w = int(form.get('region_w', 100))
+            h = int(form.get('region_h', 50))
+        else:
+            # 逐张标记模式
+            regions = json.loads(form.get('regions', '[]'))
+            if index < len(regions):
+                region = regions[index]
+                x = region.get('x', 0)
+                y = region.get('y', 0)
+                w = region.get('w', 100)
+                h = region.get('h', 50)
+            else:
+                x, y, w, h = 0, 0, 100, 50
+        return partial(remove_watermark_region_array,
+                       x=scale_px(x, scale), y=scale_px(y, scale),
+                       width=scale_px(w, scale, minimum=1), height=scale_px(h, scale, minimum=1),
+                       inpaint_engine=read_inpaint_engine(form))
+
+    if method not in ('auto', 'color', 'frequency'):
+        return tiled(partial(remove_watermark_auto_array, inpaint_engine=read_inpaint_engine(form)))
+
+    return build_remove_stage(form, method, scale)
+
+
+def build_add_stage(form, watermark_bytes=None, datetime_format_key='datetime_format', scale=1.0):
+    """
+    根据表单参数构造加水印处理阶段
+    返回预编译水印，每个请求只构建一次，批量处理时所有图片共用
+    scale 为预览代理图相对原图的缩放比例：位置、边距、字号与平铺间距按比例映射，
+    图片/二维码水印的 scale 参数本身是相对图片宽度的比例，无需映射
+    """
+    watermark_type = form.get('type', 'text')
 
+    # 通用参数
+    common = {
+        'position': form.get('position', 'bottom-right'),
+        'opacity': float(form.get('opacity', 0.5)),
+        'margin': scale_px(int(form.get('margin', 20)), scale),
+        'custom_x': scale_px(int(form.get('custom_x', 0)), scale),
+        'custom_y': scale_px(int(form.get('custom_y', 0)), scale),
+    }
+    if scale != 1.0:
+        # 平铺间距（文字水印另有单元留白）使用默认值按比例缩放
+        if watermark_type in ('text', 'datetime'):
+            common['tile_gap'] = (scale_px(100, scale), scale_px(80, scale))
+            common['tile_padding'] = scale_px(20, scale)
         else:
-            return {'error': '未知的处理方式'}, 400
-
-        # 格式转换和压缩
-        output_format = request.form.get('format', 'png')
-        quality = int(request.form.get('quality', 95))
-        result_bytes = convert_image_format(result_bytes, output_format, quality)
-
-        # 确定 mimetype 和文件名
-        ext = output_format if output_format != 'jpeg' else 'jpg'
-        mimetypes = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
-        mimetype = mimetypes.get(output_format, 'image/png')
-
-        return send_file(
-            io.BytesIO(result_bytes),
-            mimetype=mimetype,
-            as_attachment=False,
-            download_name=f'result.{ext}'
+            default_gap = (QRCodeWatermark if watermark_type == 'qrcode' else ImageWatermark).tile_gap
+            common['tile_gap'] = scale_px(default_gap, scale)
+
+    # 用户上传字体（文字/日期时间水印）
+    font_id = form.get('font_id') or None
+    if font_id:
+        try:
+            font_path(font_id)
+        except ValueError as e:
+            raise ParamError(str(e))
+
+    if watermark_type == 'text':
+        text = form.get('text', '')
+        if not text:
+            raise ParamError('请输入水印文字')
+
+        return TextWatermark(
+            text,
+            font_size=scale_px(int(form.get('font_size', 36)), scale, minimum=1),
+            font_color=form.get('font_color', '#FFFFFF'),
+            rotation=float(form.get('rotation', 0)),
+            font_id=font_id,
+            **common
         )
 
-    except Exception as e:
-        return {'error': f'处理失败: {str(e)}'}, 500
+    elif watermark_type == 'image':
+        if watermark_bytes is None:
+            raise ParamError('请上传水印图片')
 
+        return ImageWatermark(
+            watermark_bytes,
+            scale=float(form.get('scale', 0.2)),
+            **common
+        )
 
-@app.route('/api/batch-remove-watermark', methods=['POST'])
-def batch_remove_watermark():
-    """批量去水印处理"""
-    if 'images' not in request.files:
-        return {'error': '没有上传图片'}, 400
+    elif watermark_type == 'qrcode':
+        url = form.get('url', '')
+        if not url:
+            raise ParamError('请输入二维码链接')
+
+        return QRCodeWatermark(
+            url,
+            scale=float(form.get('scale', 0.15)),
+            fill_color=form.get('fill_color', '#000000'),
+            back_color=form.get('back_color', '#FFFFFF'),
+            **common
+        )
+
+    elif watermark_type == 'datetime':
+        return TextWatermark.from_datetime(
+            form.get(datetime_format_key, '%Y-%m-%d %H:%M:%S'),
+            form.get('custom_text', ''),
+            font_size=scale_px(int(form.get('font_size', 36)), scale, minimum=1),
+            font_color=form.get('font_color', '#FFFFFF'),
+            rotation=float(form.get('rotation', 0)),
+            font_id=font_id,
+            **common
+        )
+
+    raise ParamError('未知的水印类型')
 
-    files = request.files.getlist('images')
-    if len(files) == 0:
-        return {'error': '没有选择文件'}, 400
 
-    method = request.form.get('method', 'auto')
-    output_format = request.form.get('format', 'png')
-    quality = int(request.form.get('quality', 95))
+def read_watermark_image(files, field='watermark_image'):
+    """读取上传的水印图片，未上传时抛出 ParamError"""
+    if field not in files:
+        raise ParamError('请上传水印图片')
+    watermark_file = files[field]
+    if watermark_file.filename == '':
+        raise ParamError('请选择水印图片')
+    return watermark_file.read()
 
-    # 创建 ZIP 文件
-    zip_buffer = io.BytesIO()
+
+def read_watermark_layers(form, files, datetime_format_key='datetime_format'):
+    """
+    读取加水印参数，返回各图层的构造函数（调用时可传 scale，见 build_add_stage）
+
+    表单带 layers 时为 JSON 图层列表，按顺序叠加（后面的图层在上层）；每个图层是一个对象，
+    键与单水印的表单参数相同（type、text、position、opacity、rotation 等，日期格式为
+    datetime_format），图片水印的 image_field 为对应上传文件的字段名（默认 watermark_image）。
+    否则为表单本身描述的单个水印。上传文件只读取一次，预览按不同比例重复构造时不再读取
+    """
+    layers = form.get('layers')
+    if not layers:
+        watermark_bytes = None
+        if form.get('type', 'text') == 'image':
+            watermark_bytes = read_watermark_image(files)
+        return [partial(build_add_stage, form, watermark_bytes, datetime_format_key)]
 
     try:
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for i, file in enumerate(files):
-                if file.filename == '':
-                    continue
-
-                image_bytes = file.read()
-
-                # 处理图片
-                if method == 'auto':
-                    threshold = int(request.form.get('threshold', 200))
-                    result_bytes = remove_watermark_auto(image_bytes, threshold=threshold)
-                elif method == 'region':
-                    # 手动区域模式
-                    region_mode = request.form.get('region_mode', 'unified')
-                    if region_mode == 'unified':
-                        x = int(request.form.get('region_x', 0))
-                        y = int(request.form.get('region_y', 0))
-                        w = int(request.form.get('region_w', 100))
-                        h = int(request.form.get('region_h', 50))
-                    else:
-                        # 逐张标记模式
-                        import json
-                        regions = json.loads(request.form.get('regions', '[]'))
-                        if i < len(regions):
-                            region = regions[i]
-                            x = region.get('x', 0)
-                            y = region.get('y', 0)
-                            w = region.get('w', 100)
-                            h = region.get('h', 50)
-                        else:
-                            x, y, w, h = 0, 0, 100, 50
-                    result_bytes = remove_watermark_region(image_bytes, x, y, w, h)
-                elif method == 'color':
-                    color_lower = request.form.get('color_lower', '#c8c8c8')
-                    color_upper = request.form.get('color_upper', '#ffffff')
-                    lower_bgr = hex_to_bgr(color_lower)
-                    upper_bgr = hex_to_bgr(color_upper)
-                    result_bytes = remove_watermark_color(image_bytes, lower_bgr, upper_bgr)
-                elif method == 'frequency':
-                    result_bytes = remove_watermark_frequency(image_bytes)
-                else:
-                    result_bytes = remove_watermark_auto(image_bytes)
-
-                # 格式转换
-                result_bytes = convert_image_format(result_bytes, output_format, quality)
-
-                # 生成文件名
-                original_name = os.path.splitext(file.filename)[0]
-                ext = output_format if output_format != 'jpeg' else 'jpg'
-                new_filename = f"{original_name}_processed.{ext}"
-
-                zip_file.writestr(new_filename, result_bytes)
-
-        zip_buffer.seek(0)
-
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='watermark_removed.zip'
-        )
+        layers = json.loads(layers)
+    except ValueError:
+        raise ParamError('水印图层参数格式错误')
+    if not isinstance(layers, list) or not layers or not all(isinstance(layer, dict) for layer in layers):
+        raise ParamError('水印图层参数格式错误')
+    if len(layers) > app.config['MAX_WATERMARK_LAYERS']:
+        raise ParamError(f"水印图层不能超过 {app.config['MAX_WATERMARK_LAYERS']} 个")
+
+    images = {}
+    builders = []
+    for layer in layers:
+        watermark_bytes = None
+        if layer.get('type', 'text') == 'image':
+            field = layer.get('image_field', 'watermark_image')
+            if field not in images:
+                images[field] = read_watermark_image(files, field)
+            watermark_bytes = images[field]
+        builders.append(partial(build_add_stage, layer, watermark_bytes, 'datetime_format'))
+    return builders
+
+
+def build_watermark(layers, scale=1.0):
+    """
+    按图层构造函数构造加水印处理阶段：单个水印直接返回预编译水印，
+    多个水印合并为一个 WatermarkStack，一次解码、一次合成遍历、一次编码
+    """
+    watermarks = [build(scale=scale) for build in layers]
+    if len(watermarks) == 1:
+        return watermarks[0]
+    return WatermarkStack(watermarks)
+
+
+def read_image_file(files):
+    """读取单张上传图片，返回 (文件名, 图片字节)；像素数超过上限时返回 413"""
+    if 'image' not in files:
+        raise ParamError('没有上传图片')
+    file = files['image']
+    if file.filename == '':
+        raise ParamError('没有选择文件')
+    image_bytes = file.read()
+    check_image_size(image_bytes)
+    return file.filename, image_bytes
+
+
+def read_image_source(req):
+    """
+    单图处理的输入：表单中的 image_id（/api/images 返回的句柄）或上传的图片文件
+    返回 (文件名, 图片字节或已解码图片)；句柄失效时返回 410，客户端重新上传即可，
+    从共享目录解码时内存预算不足且排队超时抛出 Overloaded（返回 503）
+    """
+    image_id = req.form.get('image_id')
+    if image_id:
+        # 其他工作进程上传的图片需从共享目录解码整图，与上传时一样按解码所需内存排队
+        image = image_store.get(image_id, admit=admit_decode)
+        if image is None:
+            raise ParamError('图片已过期，请重新上传', status=410)
+        return image_id, image
+    return read_image_file(req.files)
+
+
+def admit_decode(image_bytes):
+    """为解码整图（会话图片）预留内存，返回 Reservation"""
+    return admit_tasks([(image_bytes, [], 'png', 95)])
+
+
+def store_image(image_bytes):
+    """解码整图存为会话图片（按解码所需内存排队），返回 (句柄, 已解码图片)"""
+    with admit_decode(image_bytes):
+        return image_store.put(image_bytes)
+
+
+def read_batch_files(files):
+    """
+    读取批量上传图片，返回 [(序号, 文件名, 图片字节)]
+    跳过未选择的空文件，序号为上传顺序（逐张标记区域时按序号对应）
+    上传文件在视图返回后即关闭，需先读出；任一图片像素数超过上限时返回 413
+    """
+    if 'images' not in files:
+        raise ParamError('没有上传图片')
+    uploads = files.getlist('images')
+    if len(uploads) == 0:
+        raise ParamError('没有选择文件')
+    images = [(i, file.filename, file.read()) for i, file in enumerate(uploads) if file.filename != '']
+    for _, name, image_bytes in images:
+        check_image_size(image_bytes, name)
+    return images
+
+
+def output_params(form):
+    """输出格式与质量"""
+    return form.get('format', 'png'), int(form.get('quality', 95))
+
+
+def read_resize(form):
+    """
+    输出尺寸：resize_scale 为缩放比例 (0, 1]，resize_width/resize_height 为最大宽高（保持宽高比），
+    均未指定时返回 None（按原尺寸输出）
+    """
+    scale, width, height = (form.get(f'resize_{name}') for name in ('scale', 'width', 'height'))
+    if not (scale or width or height):
+        return None
+    try:
+        return Resize(scale=float(scale) if scale else None,
+                      width=int(width) if width else None,
+                      height=int(height) if height else None)
+    except ValueError as e:
+        raise ParamError(f'输出尺寸参数错误: {e}')
+
+
+def resized_stages(resize, image, build):
+    """
+    按输出尺寸构造处理阶段：先缩小（JPEG 直接按 DCT 缩放解码）再执行其余阶段
+    build(scale) 返回其余阶段；坐标、边距、字号等参数仍按原图填写，按实际缩放比例映射（同实时预览），
+    结果与按原图处理后再缩小一致
+    """
+    if resize is None:
+        return build(1.0)
+    size = image_size(image)
+    if size is None:
+        # 无法读取文件头，解码后再按目标尺寸缩小，参数不映射
+        return [resize] + build(1.0)
+    scale = resize.factor(*size)
+    if scale == 1.0:
+        return build(1.0)
+    return [resize] + build(scale)
+
+
+def single_spec(name, task, result_name, output_format, finalize=None):
+    """
+    单图任务说明（参数与 jobs.submit 一致）
+    finalize(tasks) 在执行阶段（已预留内存后）补全任务并返回最终的 tasks（如估计遮罩），
+    tasks 为逐张检测的任务，用于估计内存；为 None 时直接处理
+    """
+    ext, mimetype = output_file_info(output_format)
+    return {
+        'names': [name],
+        'tasks': [task],
+        'output_names': [f'{result_name}.{ext}'],
+        'download_name': f'{result_name}.{ext}',
+        'mimetype': mimetype,
+        'archive': False,
+        'finalize': finalize,
+    }
+
+
+def batch_spec(names, tasks, suffix, download_name, finalize=None):
+    """
+    批量任务说明：结果为 ZIP，输出文件名为 原文件名_后缀.扩展名（扩展名按各任务的输出格式）
+    finalize 同 single_spec
+    """
+    return {
+        'names': names,
+        'tasks': tasks,
+        'output_names': [f"{os.path.splitext(name)[0]}_{suffix}.{output_file_info(task[2])[0]}"
+                         for name, task in zip(names, tasks)],
+        'download_name': download_name,
+        'mimetype': 'application/zip',
+        'archive': True,
+        'finalize': finalize,
+    }
+
+
+def spec_tasks(spec):
+    """执行阶段的最终任务（调用 finalize），须在预留内存之后调用"""
+    finalize = spec.get('finalize')
+    return finalize(spec['tasks']) if finalize is not None else spec['tasks']
+
+
+def prepare_remove(req):
+    """
+    单图去水印（动图的 auto/color 方式只估计一次遮罩，各帧复用）
+    动图遮罩在执行阶段（已预留内存后）估计，异步任务提交时不解码动图帧
+    """
+    form = req.form
+    name, image = read_image_source(req)
+    resize = read_resize(form)
+    output_format, quality = output_params(form)
+    output_format = output_format_for(image, output_format)
+
+    def make_task(shared):
+        def build(scale):
+            stage = build_remove_stage(form, scale=scale)
+            return [SharedMaskStage(shared, stage) if shared is not None else stage]
+        return image, resized_stages(resize, image, build), output_format, quality
+
+    def finalize(tasks):
+        shared = build_animation_mask(form, image, resize)
+        return tasks if shared is None else [make_task(shared)]
+
+    return single_spec(name, make_task(None), 'result', output_format,
+                       finalize=finalize if uses_animation_mask(form, image) else None)
+
+
+def prepare_add(req):
+    """单图加水印（可叠加多个水印图层）"""
+    name, image = read_image_source(req)
+
+    layers = read_watermark_layers(req.form, req.files, datetime_format_key='format')
+    stages = resized_stages(read_resize(req.form), image,
+                            lambda scale: [tiled(build_watermark(layers, scale))])
+    output_format, quality = output_params(req.form)
+    output_format = output_format_for(image, output_format)
+    return single_spec(name, (image, stages, output_format, quality), 'watermarked', output_format)
+
+
+def shared_mask_params(form, method):
+    """共享遮罩估计使用的参数（auto/color 方式，与逐张检测的参数一致）"""
+    if method == 'auto':
+        params = {
+            'threshold': int(form.get('threshold', 200)),
+            'min_area': int(form.get('min_area', 100)),
+            'max_area': int(form.get('max_area', 50000)),
+        }
+    else:
+        params = {
+            'color_lower': hex_to_bgr(form.get('color_lower', '#c8c8c8')),
+            'color_upper': hex_to_bgr(form.get('color_upper', '#ffffff')),
+        }
+    params['inpaint_engine'] = read_inpaint_engine(form)
+    return params
+
+
+def uses_shared_mask(form):
+    """是否整批估计共享遮罩（mask_mode=shared，仅 auto/color 方式）"""
+    return form.get('mask_mode', 'each') == 'shared' and form.get('method', 'auto') in ('auto', 'color')
+
+
+def build_shared_mask(form, images, resize):
+    """
+    mask_mode=shared 时在样本上估计一次整批共享的水印遮罩（仅 auto/color 方式），
+    无法估计（同尺寸图片太少、没有位置固定的水印）时返回 None，逐张检测
+    """
+    if not uses_shared_mask(form):
+        return None
+    method = form.get('method', 'auto')
+    return estimate_shared_mask(images, method, shared_mask_params(form, method), resize,
+                                map_func=partial(parallel_map, workers=app.config['BATCH_WORKERS']))
+
+
+def uses_animation_mask(form, image):
+    """是否为动图估计遮罩（auto/color 方式，只读文件头）"""
+    return form.get('method', 'auto') in ('auto', 'color') and bool(animated_format(image))
+
+
+def build_animation_mask(form, image, resize):
+    """
+    动图（auto/color 方式）在抽样帧上估计一次水印遮罩，各帧跳过检测直接修复；
+    静态图片或无法估计（帧数太少、没有位置固定的水印）时返回 None，逐帧检测
+    """
+    if not uses_animation_mask(form, image):
+        return None
+    method = form.get('method', 'auto')
+    return estimate_animation_mask(getattr(image, 'source', image), method,
+                                   shared_mask_params(form, method), resize)
+
+
+def prepare_batch_remove(req):
+    """
+    批量去水印（mask_mode=shared 时整批共用一次估计的水印遮罩；
+    动图使用在自身抽样帧上估计的遮罩）
+    共享遮罩与动图遮罩都在执行阶段（已预留内存后）估计：样本解码与处理同在批量处理进程中进行，
+    投票图与梯度（每像素几个字节）在处理图片的内存估计之内；异步任务提交时不做估计
+    """
+    form = req.form
+    uploads = read_batch_files(req.files)
+    output_format, quality = output_params(form)
+    resize = read_resize(form)
+
+    def build(index, mask, scale):
+        stage = build_batch_remove_stage(form, index, scale)
+        if mask is not None:
+            # 与共享遮罩尺寸不同的图片按原方式逐张检测
+            stage = SharedMaskStage(mask, stage)
+        return [stage]
+
+    def make_tasks(masks):
+        return [(image_bytes, resized_stages(resize, image_bytes, partial(build, i, mask)),
+                 output_format_for(image_bytes, output_format), quality)
+                for (i, _, image_bytes), mask in zip(uploads, masks)]
+
+    def animation_mask(image_bytes):
+        try:
+            return build_animation_mask(form, image_bytes, resize)
+        except Exception:
+            # 无法解码的动图逐帧处理，出错时写入 errors.txt
+            return None
+
+    def finalize(tasks):
+        try:
+            shared = build_shared_mask(form, [image_bytes for _, _, image_bytes in uploads], resize)
+        except Exception:
+            # 样本中有无法解码的图片等：逐张检测，出错的图片写入 errors.txt
+            shared = None
+        masks = [animation_mask(image_bytes) or shared for _, _, image_bytes in uploads]
+        return tasks if not any(masks) else make_tasks(masks)
+
+    names = [name for _, name, _ in uploads]
+    needs_masks = uses_shared_mask(form) or any(uses_animation_mask(form, image_bytes)
+                                                for _, _, image_bytes in uploads)
+    return batch_spec(names, make_tasks([None] * len(uploads)), 'processed', 'watermark_removed.zip',
+                      finalize=finalize if needs_masks else None)
+
+
+def prepare_batch_add(req):
+    """批量加水印：水印（及各图层）只构建一次，所有图片共用（缩小输出时按缩放比例各构建一次）"""
+    uploads = read_batch_files(req.files)
+    output_format, quality = output_params(req.form)
+    resize = read_resize(req.form)
+
+    layers = read_watermark_layers(req.form, req.files)
+    watermarks = {}
+
+    def build(scale):
+        if scale not in watermarks:
+            watermarks[scale] = tiled(build_watermark(layers, scale))
+        return [watermarks[scale]]
+
+    names = [name for _, name, _ in uploads]
+    tasks = [(image_bytes, resized_stages(resize, image_bytes, build),
+              output_format_for(image_bytes, output_format), quality)
+             for _, _, image_bytes in uploads]
+    return batch_spec(names, tasks, 'watermarked', 'watermarked.zip')
+
+
+def batch_zip_entries(spec, reservation):
+    """
+    并行处理批量任务，按顺序产出 ZIP 条目 (文件名, 数据)
+    单张失败不会中断整个批次，失败信息汇总写入 errors.txt
+    预留的内存在全部处理完成（或客户端中途断开）后释放
+    """
+    with reservation:
+        results = process_batch(spec_tasks(spec), app.config['BATCH_WORKERS'])
+
+        errors = []
+        for name, output_name, (ok, result) in zip(spec['names'], spec['output_names'], results):
+            if ok:
+                yield output_name, result
+            else:
+                errors.append(f"{name}: {result}")
+
+        if errors:
+            yield 'errors.txt', '\n'.join(errors) + '\n'
+
+
+def zip_response(entries, download_name):
+    """以流式 ZIP 响应返回，处理完一张即发送一张"""
+    return Response(
+        stream_with_context(iter_zip(entries)),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={download_name}'}
+    )
+
+
+def output_file_info(output_format):
+    """返回输出格式对应的扩展名和 mimetype"""
+    ext = output_format if output_format != 'jpeg' else 'jpg'
+    mimetypes = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp',
+                 'gif': 'image/gif'}
+    return ext, mimetypes.get(output_format, 'image/png')
+
+
+def single_response(spec):
+    """同步处理单图并直接返回结果"""
+    # 按估计的峰值内存排队，解码一次（会话图片已解码）、处理、按输出格式编码一次
+    with admit_tasks(spec['tasks']):
+        image, stages, output_format, quality = spec_tasks(spec)[0]
+        result_bytes = run_pipeline(image, stages, output_format, quality)
+
+    return send_file(
+        io.BytesIO(result_bytes),
+        mimetype=spec['mimetype'],
+        as_attachment=False,
+        download_name=spec['download_name']
+    )
+
+
+# 各接口在指标中的处理方式标签：(表单参数, 默认值)
+METRIC_METHOD_PARAMS = {
+    'remove_watermark': ('method', 'auto'),
+    'batch_remove_watermark': ('method', 'auto'),
+    'add_watermark': ('type', 'text'),
+    'batch_add_watermark': ('type', 'text'),
+}
+
+# 指标标签允许的取值：表单值由客户端决定，其余一律记为 other，避免标签组合无限增长
+METRIC_METHODS = {
+    'method': ('auto', 'region', 'color', 'frequency', 'inpaint'),
+    'type': ('text', 'image', 'qrcode', 'datetime', 'layers'),
+}
+
+
+def metric_method():
+    """当前请求的处理方式（去水印方式或水印类型），用作指标标签"""
+    endpoint = request.endpoint
+    if endpoint == 'preview':
+        endpoint = 'add_watermark' if request.form.get('action') == 'add' else 'remove_watermark'
+    elif endpoint == 'create_job':
+        endpoint = request.view_args['kind'].replace('-', '_')
+    param = METRIC_METHOD_PARAMS.get(endpoint)
+    if param is None:
+        return ''
+    try:
+        if param[0] == 'type' and request.form.get('layers'):
+            return 'layers'
+        value = request.form.get(*param)
+    except HTTPException:
+        # 请求体无法解析（如超过大小限制）
+        return ''
+    return value if value in METRIC_METHODS[param[0]] else 'other'
+
+
+@app.before_request
+def start_timing():
+    """记录请求的分阶段耗时；POST 请求先解析表单，单独计入 parse 阶段"""
+    if not request.path.startswith('/api/'):
+        return
+    metrics.begin_request()
+    if request.method == 'POST':
+        with metrics.stage_timer('parse'):
+            request.form
+            request.files
+
+
+@app.after_request
+def finish_timing(response):
+    """汇总本请求的指标，并以 Server-Timing 响应头返回各阶段耗时"""
+    if not request.path.startswith('/api/'):
+        return response
+    # 流式响应（ZIP）没有 Content-Length，不计入输出字节数
+    timings = metrics.end_request(request.endpoint or 'unknown', metric_method(), response.status_code,
+                                  request.content_length, response.content_length)
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 文本格式指标（当前进程）"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/')
+def index():
+    return render_template('index.html')
+
+
+@app.route('/api/remove-watermark', methods=['POST'])
+def remove_watermark():
+    try:
+        return single_response(prepare_remove(request))
+    except ParamError as e:
+        return {'error': str(e)}, e.status
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return {'error': f'处理失败: {str(e)}'}, 500
+
 
+@app.route('/api/batch-remove-watermark', methods=['POST'])
+def batch_remove_watermark():
+    """批量去水印处理"""
+    try:
+        spec = prepare_batch_remove(request)
+        reservation = admit_tasks(spec['tasks'], app.config['BATCH_WORKERS'])
+    except ParamError as e:
+        return {'error': str(e)}, e.status
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         return {'error': f'处理失败: {str(e)}'}, 500
 
+    # 多进程处理并流式写入 ZIP；响应未开始发送即被关闭时同样释放预留的内存
+    response = zip_response(batch_zip_entries(spec, reservation), spec['download_name'])
+    response.call_on_close(reservation.release)
+    return response
+
 
 @app.route('/api/batch-add-watermark', methods=['POST'])
 def batch_add_watermark():
     """批量添加水印"""
-    if 'images' not in request.files:
-        return {'error': '没有上传图片'}, 400
-
-    files = request.files.getlist('images')
-    if len(files) == 0:
-        return {'error': '没有选择文件'}, 400
+    try:
+        spec = prepare_batch_add(request)
+        reservation = admit_tasks(spec['tasks'], app.config['BATCH_WORKERS'])
+    except ParamError as e:
+        return {'error': str(e)}, e.status
+    except Overloaded as e:
+        return overloaded_response(e)
+    except Exception as e:
+        return {'error': f'处理失败: {str(e)}'}, 500
 
-    watermark_type = request.form.get('type', 'text')
-    output_format = request.form.get('format', 'png')
-    quality = int(request.form.get('quality', 95))
+    # 多进程处理并流式写入 ZIP；响应未开始发送即被关闭时同样释放预留的内存
+    response = zip_response(batch_zip_entries(spec, reservation), spec['download_name'])
+    response.call_on_close(reservation.release)
+    return response
 
-    # 通用参数
-    position = request.form.get('position', 'bottom-right')
-    opacity = float(request.form.get('opacity', 0.5))
-    margin = int(request.form.get('margin', 20))
-    custom_x = int(request.form.get('custom_x', 0))
-    custom_y = int(request.form.get('custom_y', 0))
-
-    # 获取水印图片（如果是图片水印）
-    watermark_bytes = None
-    if watermark_type == 'image':
-        if 'watermark_image' not in request.files:
-            return {'error': '请上传水印图片'}, 400
-        watermark_file = request.files['watermark_image']
-        if watermark_file.filename == '':
-            return {'error': '请选择水印图片'}, 400
-        watermark_bytes = watermark_file.read()
-
-    # 创建 ZIP 文件
-    zip_buffer = io.BytesIO()
 
+@app.route('/api/add-watermark', methods=['POST'])
+def add_watermark():
     try:
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
-            for i, file in enumerate(files):
-                if file.filename == '':
-                    continue
-
-                image_bytes = file.read()
-
-                if watermark_type == 'text':
-                    text = request.form.get('text', '')
-                    if not text:
-                        return {'error': '请输入水印文字'}, 400
-
-                    font_size = int(request.form.get('font_size', 36))
-                    font_color = request.form.get('font_color', '#FFFFFF')
-                    rotation = float(request.form.get('rotation', 0))
-
-                    result_bytes = add_text_watermark(
-                        image_bytes, text,
-                        font_size=font_size, font_color=font_color,
-                        opacity=opacity, rotation=rotation,
-                        position=position, margin=margin,
-                        custom_x=custom_x, custom_y=custom_y
-                    )
-
-                elif watermark_type == 'image':
-                    scale = float(request.form.get('scale', 0.2))
-                    result_bytes = add_image_watermark(
-                        image_bytes, watermark_bytes,
-                        scale=scale, opacity=opacity,
-                        position=position, margin=margin,
-                        custom_x=custom_x, custom_y=custom_y
-                    )
-
-                elif watermark_type == 'qrcode':
-                    url = request.form.get('url', '')
-                    if not url:
-                        return {'error': '请输入二维码链接'}, 400
-
-                    scale = float(request.form.get('scale', 0.15))
-                    fill_color = request.form.get('fill_color', '#000000')
-                    back_color = request.form.get('back_color', '#FFFFFF')
-
-                    result_bytes = add_qrcode_watermark(
-                        image_bytes, url,
-                        scale=scale, opacity=opacity,
-                        position=position, margin=margin,
-                        custom_x=custom_x, custom_y=custom_y,
-                        fill_color=fill_color, back_color=back_color
-                    )
-
-                elif watermark_type == 'datetime':
-                    format_str = request.form.get('datetime_format', '%Y-%m-%d %H:%M:%S')
-                    custom_text = request.form.get('custom_text', '')
-                    font_size = int(request.form.get('font_size', 36))
-                    font_color = request.form.get('font_color', '#FFFFFF')
-                    rotation = float(request.form.get('rotation', 0))
-
-                    result_bytes = add_datetime_watermark(
-                        image_bytes,
-                        format_str=format_str, custom_text=custom_text,
-                        font_size=font_size, font_color=font_color,
-                        opacity=opacity, rotation=rotation,
-                        position=position, margin=margin,
-                        custom_x=custom_x, custom_y=custom_y
-                    )
-
-                else:
-                    return {'error': '未知的水印类型'}, 400
-
-                # 格式转换
-                result_bytes = convert_image_format(result_bytes, output_format, quality)
-
-                # 生成文件名
-                original_name = os.path.splitext(file.filename)[0]
-                ext = output_format if output_format != 'jpeg' else 'jpg'
-                new_filename = f"{original_name}_watermarked.{ext}"
-
-                zip_file.writestr(new_filename, result_bytes)
-
-        zip_buffer.seek(0)
-
-        return send_file(
-            zip_buffer,
-            mimetype='application/zip',
-            as_attachment=True,
-            download_name='watermarked.zip'
-        )
-
+        return single_response(prepare_add(request))
+    except ParamError as e:
+        return {'error': str(e)}, e.status
+    except Overloaded as e:
+        return overloaded_response(e)
     except Exception as e:
         return {'error': f'处理失败: {str(e)}'}, 500
 
 
-@app.route('/api/add-watermark', methods=['POST'])
-def add_watermark():
-    if 'image' not in request.files:
-        return {'error': '没有上传图片'}, 400
+@app.route('/api/preview', methods=['POST'])
+def preview():
+    """
+    实时预览：在缩小的代理图上运行所选去水印/加水印方式，返回小尺寸 JPEG
+    参数与 /api/remove-watermark、/api/add-watermark 相同，另加 action=remove|add；
+    坐标等参数按原图填写，服务端按缩放比例映射。最终结果仍需调用原接口按原图处理
+    """
+    try:
+        image_id = request.form.get('image_id')
+        if image_id:
+            _, image = read_image_source(request)
+        else:
+            # 直接上传图片时存为会话图片，后续预览传回 X-Image-Id 即可
+            _, image_bytes = read_image_file(request.files)
+            image_id, image = store_image(image_bytes)
+
+        action = request.form.get('action', 'remove')
+        if action == 'remove':
+            build_stages = lambda scale: [build_remove_stage(request.form, scale=scale)]
+        elif action == 'add':
+            layers = read_watermark_layers(request.form, request.files, datetime_format_key='format')
+            build_stages = lambda scale: [build_watermark(layers, scale)]
+        else:
+            raise ParamError('未知的预览类型')
+
+        result_bytes, scale, elapsed_ms = render_preview(image, build_stages)
+    except ParamError as e:
+        return {'error': str(e)}, e.status
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    except Exception as e:
+        return {'error': f'预览失败: {str(e)}'}, 500
 
-    file = request.files['image']
-    if file.filename == '':
-        return {'error': '没有选择文件'}, 400
+    return Response(result_bytes, mimetype='image/jpeg', headers={
+        'X-Image-Id': image_id,
+        'X-Preview-Scale': f'{scale:.6f}',
+        'X-Preview-Time-Ms': f'{elapsed_ms:.1f}',
+        'Cache-Control': 'no-store',
+    })
 
-    watermark_type = request.form.get('type', 'text')
-    image_bytes = file.read()
 
-    # 通用参数
-    position = request.form.get('position', 'bottom-right')
-    opacity = float(request.form.get('opacity', 0.5))
-    margin = int(request.form.get('margin', 20))
-    custom_x = int(request.form.get('custom_x', 0))
-    custom_y = int(request.form.get('custom_y', 0))
+# 异步任务类型（与同步接口参数相同）
+JOB_PREPARERS = {
+    'remove-watermark': prepare_remove,
+    'add-watermark': prepare_add,
+    'batch-remove-watermark': prepare_batch_remove,
+    'batch-add-watermark': prepare_batch_add,
+}
 
-    try:
-        if watermark_type == 'text':
-            text = request.form.get('text', '')
-            if not text:
-                return {'error': '请输入水印文字'}, 400
-
-            font_size = int(request.form.get('font_size', 36))
-            font_color = request.form.get('font_color', '#FFFFFF')
-            rotation = float(request.form.get('rotation', 0))
-
-            result_bytes = add_text_watermark(
-                image_bytes, text,
-                font_size=font_size, font_color=font_color,
-                opacity=opacity, rotation=rotation,
-                position=position, margin=margin,
-                custom_x=custom_x, custom_y=custom_y
-            )
-
-        elif watermark_type == 'image':
-            if 'watermark_image' not in request.files:
-                return {'error': '请上传水印图片'}, 400
-
-            watermark_file = request.files['watermark_image']
-            if watermark_file.filename == '':
-                return {'error': '请选择水印图片'}, 400
-
-            watermark_bytes = watermark_file.read()
-            scale = float(request.form.get('scale', 0.2))
-
-            result_bytes = add_image_watermark(
-                image_bytes, watermark_bytes,
-                scale=scale, opacity=opacity,
-                position=position, margin=margin,
-                custom_x=custom_x, custom_y=custom_y
-            )
-
-        elif watermark_type == 'qrcode':
-            url = request.form.get('url', '')
-            if not url:
-                return {'error': '请输入二维码链接'}, 400
-
-            scale = float(request.form.get('scale', 0.15))
-            fill_color = request.form.get('fill_color', '#000000')
-            back_color = request.form.get('back_color', '#FFFFFF')
-
-            result_bytes = add_qrcode_watermark(
-                image_bytes, url,
-                scale=scale, opacity=opacity,
-                position=position, margin=margin,
-                custom_x=custom_x, custom_y=custom_y,
-                fill_color=fill_color, back_color=back_color
-            )
-
-        elif watermark_type == 'datetime':
-            format_str = request.form.get('format', '%Y-%m-%d %H:%M:%S')
-            custom_text = request.form.get('custom_text', '')
-            font_size = int(request.form.get('font_size', 36))
-            font_color = request.form.get('font_color', '#FFFFFF')
-            rotation = float(request.form.get('rotation', 0))
-
-            result_bytes = add_datetime_watermark(
-                image_bytes,
-                format_str=format_str, custom_text=custom_text,
-                font_size=font_size, font_color=font_color,
-                opacity=opacity, rotation=rotation,
-                position=position, margin=margin,
-                custom_x=custom_x, custom_y=custom_y
-            )
 
-        else:
-            return {'error': '未知的水印类型'}, 400
-
-        # 格式转换和压缩
-        output_format = request.form.get('format', 'png')
-        quality = int(request.form.get('quality', 95))
-        result_bytes = convert_image_format(result_bytes, output_format, quality)
-
-        # 确定 mimetype 和文件名
-        ext = output_format if output_format != 'jpeg' else 'jpg'
-        mimetypes = {'png': 'image/png', 'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'webp': 'image/webp'}
-        mimetype = mimetypes.get(output_format, 'image/png')
-
-        return send_file(
-            io.BytesIO(result_bytes),
-            mimetype=mimetype,
-            as_attachment=False,
-            download_name=f'watermarked.{ext}'
-        )
+@app.route('/api/jobs/<kind>', methods=['POST'])
+def create_job(kind):
+    """提交异步任务，立即返回任务 ID；之后轮询状态并在完成后下载结果"""
+    prepare = JOB_PREPARERS.get(kind)
+    if prepare is None:
+        return {'error': '未知的任务类型'}, 404
 
+    try:
+        spec = prepare(request)
+        # 执行时按估计的峰值内存排队（不拒绝）；单张所需内存超过整个预算时提交即返回 413
+        memory = memory_estimate(spec['tasks'], app.config['BATCH_WORKERS'])
+        job_id = submit_job(workers=app.config['BATCH_WORKERS'], memory=memory, **spec)
+    except ParamError as e:
+        return {'error': str(e)}, e.status
+    except Overloaded as e:
+        return overloaded_response(e)
+    except QueueFull as e:
+        return {'error': str(e)}, 503, {'Retry-After': '10'}
     except Exception as e:
         return {'error': f'处理失败: {str(e)}'}, 500
 
+    return {
+        'job_id': job_id,
+        'status_url': f'/api/jobs/{job_id}',
+        'result_url': f'/api/jobs/{job_id}/result',
+    }, 202
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """任务状态与逐张进度"""
+    status = get_job_status(job_id)
+    if status is None:
+        return {'error': '任务不存在或已过期'}, 404
+    return status
+
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    """下载已完成任务的结果"""
+    status = get_job_status(job_id)
+    if status is None:
+        return {'error': '任务不存在或已过期'}, 404
+    if status['status'] != 'done':
+        return {'error': status['error'] or '任务尚未完成', 'status': status['status']}, 409
+
+    return send_file(
+        job_result_path(job_id),
+        mimetype=status['mimetype'],
+        as_attachment=True,
+        download_name=status['download_name']
+    )
+
+
+@app.route('/api/upload-font', methods=['POST'])
+def upload_font():
+    """上传自定义字体（.ttf/.otf/.ttc），返回可在加水印时使用的 font_id"""
+    if 'font' not in request.files:
+        return {'error': '没有上传字体'}, 400
+
+    file = request.files['font']
+    if file.filename == '':
+        return {'error': '没有选择文件'}, 400
+
+    try:
+        font_id = register_font(file.read(), file.filename)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    return {'font_id': font_id}
+
+
+@app.route('/api/images', methods=['POST'])
+def upload_image():
+    """上传并解码一次图片，返回句柄；之后单图处理传 image_id 即可，无需重复上传"""
+    try:
+        _, image_bytes = read_image_file(request.files)
+        image_id, image = store_image(image_bytes)
+    except ParamError as e:
+        return {'error': str(e)}, e.status
+    except Overloaded as e:
+        return overloaded_response(e)
+    except ValueError as e:
+        return {'error': str(e)}, 400
+
+    height, width = image.shape[:2]
+    return {
+        'image_id': image_id,
+        'width': width,
+        'height': height,
+        'expires_in': image_store.ttl,
+    }, 201
+
+
+@app.route('/api/images/<image_id>', methods=['DELETE'])
+def delete_image(image_id):
+    """提前释放会话图片"""
+    if not image_store.delete(image_id):
+        return {'error': '图片不存在或已过期'}, 404
+    return {'deleted': image_id}
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats():
+    """结果缓存的命中/未命中/淘汰计数（当前进程）"""
+    return result_cache.stats()
+
+
+@app.route('/api/admission/stats', methods=['GET'])
+def admission_stats():
+    """内存预算：上限、已预留字节数与排队请求数（当前进程）"""
+    return memory_budget.stats()
+
 
 if __name__ == '__main__':
     # 确保 uploads 目录存在
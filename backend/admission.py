@@ -0,0 +1,240 @@
+# 准入控制：解码前按文件头估计峰值内存，超过进程内存预算时排队等待，等待超时拒绝
+import math
+import os
+import threading
+from collections import deque
+
+from PIL import Image
+
+from backend.animation import ANIMATED_FORMATS, animated_format
+from backend.batch_mask import SharedMaskStage
+from backend.frequency import optimal_dft_shape
+from backend.inpaint import roi_padding
+from backend.metrics import ADMISSION_REJECTED, stage_timer
+from backend.resize import REDUCED_FLAGS, Resize, image_size
+from backend.tiling import TiledStage, tile_size
+from backend.watermark_remover import (
+    DecodedImage,
+    remove_watermark_frequency_array,
+    remove_watermark_region_array,
+)
+
+
+# 单张图片（动图按画布）的像素数上限（环境变量 MAX_IMAGE_PIXELS，默认 6400 万像素），
+# 超过时不解码直接拒绝；压缩率极高的图片（解压炸弹）只有十几 MB 也能解码出数 GB
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 64_000_000))
+
+# 进程内同时处理的图片的峰值内存预算（MB，环境变量 MEMORY_BUDGET_MB，默认 2048）
+# 多进程部署时按 机器内存 / 进程数 设置
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB', 2048))
+
+# 预算不足时排队等待的最长时间（秒）与排队请求数上限，超过后返回 503
+ADMISSION_TIMEOUT = float(os.environ.get('ADMISSION_TIMEOUT', 10))
+ADMISSION_QUEUE_SIZE = int(os.environ.get('ADMISSION_QUEUE_SIZE', 32))
+
+# 503 响应的 Retry-After（秒）
+ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', 5))
+
+# 解码与编码每个像素的峰值内存（字节）：BGR 整图、编码缓冲（按需增长）与结果副本（实测约 9）
+IMAGE_BYTES_PER_PIXEL = 10
+
+# 局部处理阶段（检测、修复、水印合成）每个像素的峰值工作内存（字节），
+# 分块处理时按一个分块计；实测 2~3，遮罩面积大时更多
+STAGE_BYTES_PER_PIXEL = 8
+
+# 频域滤波每个（填充到 DFT 尺寸后）像素的工作内存（字节）：
+# 填充副本、分离的通道与单个通道的 float32 输入/频谱/逆变换/归一化结果（实测约 15）
+FREQUENCY_BYTES_PER_PIXEL = 16
+
+# 动图每个画布像素的内存（字节）：当前帧、上一帧、待写出的区域、PIL 合成画布与 RGB/调色板帧
+ANIMATION_BYTES_PER_PIXEL = 24
+
+# imdecode 标志 -> JPEG 解码时的缩小倍数
+_REDUCTIONS = {flags: reduction for reduction, flags in REDUCED_FLAGS}
+
+
+class ImageTooLarge(ValueError):
+    """图片像素数或处理所需内存超过上限（无论何时重试都无法处理，返回 413）"""
+
+
+class Overloaded(Exception):
+    """内存预算已用尽且排队超时（返回 503，客户端 retry_after 秒后重试）"""
+
+    def __init__(self, message, retry_after=ADMISSION_RETRY_AFTER):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def check_image(image):
+    """
+    只读文件头检查图片的像素数，超过 MAX_IMAGE_PIXELS 时抛出 ImageTooLarge
+    返回 (宽, 高)，文件头无法识别时返回 None（交给解码报错）
+    """
+    try:
+        size = image_size(image)
+    except Image.DecompressionBombError:
+        # 超过 PIL 自身解压炸弹上限的图片在读取文件头时即报错
+        size = None
+        too_large = True
+    else:
+        too_large = size is not None and size[0] * size[1] > MAX_IMAGE_PIXELS
+    if too_large:
+        detail = f'{size[0]}x{size[1]}，' if size else ''
+        ADMISSION_REJECTED.inc(reason='pixels')
+        raise ImageTooLarge(f'图片像素数超过上限（{detail}上限 {MAX_IMAGE_PIXELS / 1e6:g} 百万像素）')
+    return size
+
+
+def stage_memory(stage, width: int, height: int) -> int:
+    """
+    处理阶段在 width x height 图片上的峰值工作内存估计（字节）
+    分块阶段按一个分块计，区域修复按选区外扩的局部区域计，频域滤波按填充后的整幅频谱计，
+    其余阶段按整图计
+    """
+    if isinstance(stage, SharedMaskStage):
+        # 共享遮罩只修复水印附近的局部区域，尺寸不符时按原方式处理，以原方式为上界
+        return stage_memory(stage.fallback, width, height)
+    if isinstance(stage, TiledStage):
+        size = tile_size(stage.budget_mb)
+        return STAGE_BYTES_PER_PIXEL * min(width, size) * min(height, size)
+    func = getattr(stage, 'func', stage)
+    if func is remove_watermark_frequency_array:
+        rows, cols = optimal_dft_shape(height, width)
+        return FREQUENCY_BYTES_PER_PIXEL * rows * cols
+    if func is remove_watermark_region_array:
+        pad = 2 * roi_padding(5)
+        keywords = stage.keywords
+        return (STAGE_BYTES_PER_PIXEL * min(width, keywords['width'] + pad)
+                * min(height, keywords['height'] + pad))
+    return STAGE_BYTES_PER_PIXEL * width * height
+
+
+def task_memory(task: tuple) -> int:
+    """
+    单张图片任务 (图片, stages, 输出格式, 质量) 的峰值内存估计（字节），只读取文件头
+    解码与编码按解码尺寸（JPEG 按 DCT 缩放后的尺寸）计，各阶段依次执行、按其中最大者计；
+    动图逐帧处理，按一帧的画布计（与帧数无关）。文件头无法识别时按像素上限估计
+    """
+    image, stages, output_format, _ = task
+    size = image_size(image)
+    if size is None:
+        side = math.isqrt(MAX_IMAGE_PIXELS)
+        size = (side, side)
+    width, height = size
+
+    resize = stages[0] if stages and isinstance(stages[0], Resize) else None
+    target = resize.target_size(width, height) if resize is not None else size
+    work = max((stage_memory(stage, *target) for stage in stages if stage is not resize), default=0)
+
+    if output_format.lower() in ANIMATED_FORMATS.values() and animated_format(image):
+        # 逐帧缩小（Resize 作为普通阶段），另加已压缩的输出（与输入大小相当）
+        source = getattr(image, 'source', image)
+        return ANIMATION_BYTES_PER_PIXEL * width * height + work + len(source)
+
+    if isinstance(image, DecodedImage):
+        # 已解码的会话图片：在（缩小后的）副本上处理
+        decoded = target
+    elif resize is not None:
+        flags, _ = resize.decode_plan(image)
+        reduction = _REDUCTIONS.get(flags, 1)
+        decoded = (-(-width // reduction), -(-height // reduction))
+    else:
+        decoded = size
+    return IMAGE_BYTES_PER_PIXEL * decoded[0] * decoded[1] + work
+
+
+def batch_memory(tasks: list, workers: int = 1) -> int:
+    """
+    一批任务的峰值内存估计：同时处理的图片最多 workers 张，按估计值最大的几张之和计
+    单张超过整个预算（无论何时都无法处理）时抛出 ImageTooLarge
+    """
+    estimates = sorted((task_memory(task) for task in tasks), reverse=True)
+    if estimates and estimates[0] > memory_budget.limit:
+        ADMISSION_REJECTED.inc(reason='memory')
+        raise ImageTooLarge(f'处理所需内存超过上限（约 {estimates[0] / 2 ** 20:.0f} MB，'
+                            f'上限 {memory_budget.limit / 2 ** 20:.0f} MB），请缩小图片或输出尺寸')
+    return sum(estimates[:max(1, workers)])
+
+
+class Reservation:
+    """已预留的内存，处理完成后释放（可重复调用，只释放一次）"""
+
+    def __init__(self, budget, amount: int):
+        self.budget = budget
+        self.amount = amount
+
+    def release(self):
+        if self.amount:
+            self.budget._release(self.amount)
+            self.amount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class MemoryBudget:
+    """
+    进程内存预算：处理前按估计的峰值内存预留，处理完释放
+    预算不足时按到达顺序排队（先到先得，大图不会被源源不断的小图饿死）；
+    超过整个预算的预留（如多进程批量）按整个预算计，等其余处理全部完成后独占执行
+    """
+
+    def __init__(self, limit_mb: int, queue_size: int, timeout: float):
+        self.limit = limit_mb * 1024 * 1024
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.reserved = 0
+        self._waiting = deque()
+        self._condition = threading.Condition()
+
+    def reserve(self, amount: int, wait: bool = False) -> Reservation:
+        """
+        预留 amount 字节，返回 Reservation
+        预算不足时排队等待 timeout 秒，排队已满或等待超时抛出 Overloaded；
+        wait=True 时一直等待（异步任务，任务队列本身有上限）
+        """
+        amount = min(amount, self.limit)
+        with self._condition:
+            if not self._waiting and self.reserved + amount <= self.limit:
+                self.reserved += amount
+                return Reservation(self, amount)
+            if not wait and len(self._waiting) >= self.queue_size:
+                ADMISSION_REJECTED.inc(reason='busy')
+                raise Overloaded('服务繁忙，请稍后重试')
+
+            ticket = object()
+            self._waiting.append(ticket)
+            try:
+                with stage_timer('admission'):
+                    admitted = self._condition.wait_for(
+                        lambda: self._waiting[0] is ticket and self.reserved + amount <= self.limit,
+                        None if wait else self.timeout)
+                if not admitted:
+                    ADMISSION_REJECTED.inc(reason='busy')
+                    raise Overloaded('服务繁忙，请稍后重试')
+                self.reserved += amount
+            finally:
+                self._waiting.remove(ticket)
+                # 队首变化，唤醒后续等待者
+                self._condition.notify_all()
+        return Reservation(self, amount)
+
+    def _release(self, amount: int):
+        with self._condition:
+            self.reserved -= amount
+            self._condition.notify_all()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                'limit': self.limit,
+                'reserved': self.reserved,
+                'waiting': len(self._waiting),
+            }
+
+
+memory_budget = MemoryBudget(MEMORY_BUDGET_MB, ADMISSION_QUEUE_SIZE, ADMISSION_TIMEOUT)
+
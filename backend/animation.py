@@ -0,0 +1,233 @@
+# 动图（GIF/WebP 动画）：逐帧解码 -> 处理 -> 编码，同一时刻只持有当前帧与上一帧
+import io
+import struct
+
+import cv2
+import numpy as np
+from PIL import GifImagePlugin, Image, ImageSequence, UnidentifiedImageError
+
+from backend.metrics import observe_image, stage_timer
+
+
+# 支持动画的源格式（PIL 格式名）及对应的输出格式
+ANIMATED_FORMATS = {'GIF': 'gif', 'WEBP': 'webp'}
+
+# WebP 帧时长字段为 24 位（毫秒）
+WEBP_MAX_DURATION = (1 << 24) - 1
+
+
+def animated_format(image):
+    """
+    图片（字节或保留了原始字节的 DecodedImage）为多帧 GIF/WebP 时返回对应的输出格式（gif/webp），
+    否则返回 None；只读取文件头与帧索引，不解码像素
+    """
+    image = getattr(image, 'source', image)
+    if not isinstance(image, bytes):
+        return None
+    try:
+        with Image.open(io.BytesIO(image)) as img:
+            fmt = ANIMATED_FORMATS.get(img.format)
+            if fmt is None or not getattr(img, 'is_animated', False):
+                return None
+    except (UnidentifiedImageError, OSError):
+        return None
+    return fmt
+
+
+def output_format_for(image, output_format: str) -> str:
+    """
+    实际输出格式：动图请求的格式不支持动画（png/jpeg）时沿用源格式，
+    请求 gif/webp 时按请求的格式输出动画；静态图片按请求的格式
+    """
+    if output_format.lower() in ANIMATED_FORMATS.values():
+        return output_format
+    return animated_format(image) or output_format
+
+
+class AnimationReader:
+    """
+    逐帧读取动图：每帧为完整画布（已按各帧的处置方式合成）的 BGR 数组与显示时长（毫秒）
+    迭代时只解码当前帧，长动图也不会把所有帧同时放在内存中；透明像素按其颜色值展平（同静态图片解码）
+    """
+
+    def __init__(self, image_bytes: bytes):
+        self._img = Image.open(io.BytesIO(image_bytes))
+        self.size = self._img.size
+        # 循环次数：0 为无限循环，None 为只播放一次（GIF 没有循环扩展块）
+        self.loop = self._img.info.get('loop')
+
+    @property
+    def frame_count(self) -> int:
+        return getattr(self._img, 'n_frames', 1)
+
+    def __iter__(self):
+        for frame in ImageSequence.Iterator(self._img):
+            with stage_timer('decode'):
+                img = cv2.cvtColor(np.asarray(frame.convert('RGB')), cv2.COLOR_RGB2BGR)
+            yield img, int(frame.info.get('duration', 0))
+
+    def close(self):
+        self._img.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AnimationWriter:
+    """
+    逐帧编码动图：每帧只编码与上一帧不同的包围盒（其余像素保留上一帧），
+    与上一帧完全相同的帧合并到上一帧的时长中。
+    最后一帧暂存到下一帧到来时才写出（需要合并时长）；已写出的帧只保留压缩后的数据
+    """
+
+    # 帧偏移的对齐粒度（WebP 要求偶数偏移）
+    align = 1
+
+    def __init__(self, loop=0, quality: int = 95):
+        self.loop = loop
+        self.quality = quality
+        self.size = None
+        self._chunks = []
+        self._previous = None
+        self._pending = None
+
+    def add(self, img: np.ndarray, duration: int):
+        """追加一帧（BGR 数组，时长毫秒），各帧尺寸需一致"""
+        height, width = img.shape[:2]
+        if self._previous is None:
+            self.size = (width, height)
+            box = (0, 0, width, height)
+        else:
+            if (width, height) != self.size:
+                raise ValueError('动图各帧尺寸不一致')
+            with stage_timer('encode'):
+                # 三个通道按行展平为单通道，包围盒的横坐标按通道数换算
+                diff = cv2.absdiff(img, self._previous).reshape(height, -1)
+                x, y, w, h = cv2.boundingRect(diff)
+            if w == 0:
+                # 与上一帧相同：只延长上一帧的显示时长
+                self._pending[3] += duration
+                return
+            x, w = x // 3, -(-(x + w) // 3) - x // 3
+            # 按对齐粒度向左上扩展
+            box = (x - x % self.align, y - y % self.align, x + w, y + h)
+
+        self._flush()
+        x0, y0, x1, y1 = box
+        self._pending = [img[y0:y1, x0:x1].copy(), x0, y0, duration]
+        self._previous = img
+
+    def _flush(self):
+        if self._pending is not None:
+            with stage_timer('encode'):
+                self._chunks.extend(self._encode_frame(*self._pending, first=not self._chunks))
+            self._pending = None
+
+    def finish(self) -> bytes:
+        """写出暂存的最后一帧并返回完整文件"""
+        if self._pending is None:
+            raise ValueError('动图没有任何帧')
+        self._flush()
+        with stage_timer('encode'):
+            return self._assemble()
+
+    def _encode_frame(self, region: np.ndarray, x: int, y: int, duration: int, first: bool) -> list:
+        raise NotImplementedError
+
+    def _assemble(self) -> bytes:
+        raise NotImplementedError
+
+
+class GifWriter(AnimationWriter):
+    """
+    GIF 编码：每帧区域单独生成自适应调色板（局部颜色表），
+    处置方式为保留上一帧（disposal=1），只覆盖变化的包围盒
+    """
+
+    def _encode_frame(self, region, x, y, duration, first):
+        frame = Image.fromarray(cv2.cvtColor(region, cv2.COLOR_BGR2RGB)).convert('P', palette=Image.Palette.ADAPTIVE)
+        chunks = []
+        if first:
+            # 文件头使用画布尺寸与首帧调色板（首帧即整幅画布）；各帧带时长/处置扩展块，版本为 89a
+            frame.info['version'] = b'89a'
+            info = {'loop': self.loop} if self.loop is not None else {}
+            header, _ = GifImagePlugin.getheader(frame, None, info)
+            chunks.extend(header)
+        params = {'duration': duration, 'disposal': 1}
+        if not first:
+            params['include_color_table'] = True
+        chunks.extend(GifImagePlugin.getdata(frame, (x, y), **params))
+        return chunks
+
+    def _assemble(self):
+        return b''.join(self._chunks) + b';'
+
+
+def _riff_chunk(fourcc: bytes, payload: bytes) -> bytes:
+    """RIFF 块：标识 + 小端长度 + 数据（奇数长度补一个字节）"""
+    return fourcc + struct.pack('<I', len(payload)) + payload + b'\0' * (len(payload) & 1)
+
+
+def _uint24(value: int) -> bytes:
+    return struct.pack('<I', value)[:3]
+
+
+class WebPWriter(AnimationWriter):
+    """
+    WebP 动画编码：每帧区域单独编码为 WebP（quality 同静态 WebP，始终为有损编码：OpenCV 只在 quality 超过 100 时无损），
+    按 WebP 容器格式封装为 ANMF 帧（不混合、不处置，直接覆盖变化的包围盒）
+    """
+
+    align = 2
+
+    def _encode_frame(self, region, x, y, duration, first):
+        ok, buffer = cv2.imencode('.webp', region, [cv2.IMWRITE_WEBP_QUALITY, max(1, min(100, self.quality))])
+        if not ok:
+            raise ValueError('图片编码失败: webp')
+        height, width = region.shape[:2]
+        # 去掉单帧文件的 RIFF 头，保留 VP8/VP8L 图像块
+        payload = (_uint24(x // 2) + _uint24(y // 2) + _uint24(width - 1) + _uint24(height - 1)
+                   + _uint24(min(duration, WEBP_MAX_DURATION)) + bytes([0b10]) + buffer.tobytes()[12:])
+        return [_riff_chunk(b'ANMF', payload)]
+
+    def _assemble(self):
+        width, height = self.size
+        # GIF 只播放一次（没有循环扩展块）对应 WebP 循环次数 1
+        loop = 1 if self.loop is None else self.loop
+        body = (b'WEBP'
+                + _riff_chunk(b'VP8X', bytes([0b10, 0, 0, 0]) + _uint24(width - 1) + _uint24(height - 1))
+                + _riff_chunk(b'ANIM', struct.pack('<IH', 0, loop))
+                + b''.join(self._chunks))
+        return b'RIFF' + struct.pack('<I', len(body)) + body
+
+
+# 输出格式 -> 动图编码器
+ANIMATION_WRITERS = {'gif': GifWriter, 'webp': WebPWriter}
+
+
+def encode_gif(img: np.ndarray) -> bytes:
+    """静态图片编码为单帧 GIF"""
+    writer = GifWriter(loop=None)
+    writer.add(img, 0)
+    return writer.finish()
+
+
+def run_animation(image_bytes: bytes, stages: list,
+                  output_format: str = 'gif', quality: int = 95) -> bytes:
+    """
+    动图处理流水线：逐帧解码 -> 依次执行各阶段 -> 逐帧编码，各帧共用同一组处理阶段
+    （预编译水印只渲染一次，每帧只做合成；共享遮罩只估计一次，每帧只做修复）
+    同一时刻只持有当前帧、上一帧与已压缩的输出，内存与帧数无关
+    """
+    with AnimationReader(image_bytes) as reader:
+        width, height = reader.size
+        observe_image(height, width)
+        writer = ANIMATION_WRITERS[output_format.lower()](loop=reader.loop, quality=quality)
+        for img, duration in reader:
+            for stage in stages:
+                img = stage(img)
+            writer.add(img, duration)
+    return writer.finish()
@@ -0,0 +1,169 @@
+# 批量处理进程池
+import os
+import threading
+import zipfile
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cv2
+
+from backend.cache import pipeline_key, result_cache
+from backend.watermark_remover import run_pipeline
+
+
+# 已压缩格式直接存储，DEFLATE 几乎没有收益
+STORED_EXTENSIONS = ('.jpg', '.jpeg', '.webp')
+
+_executor = None
+_executor_workers = 0
+_executor_lock = threading.Lock()
+
+
+def default_workers() -> int:
+    """默认工作进程数：环境变量 BATCH_WORKERS，未设置时取 CPU 核数"""
+    return int(os.environ.get('BATCH_WORKERS', 0)) or os.cpu_count() or 1
+
+
+def worker_threads(workers: int) -> int:
+    """
+    批量处理进程的 OpenCV 线程数：按进程数均分 CPU 核数（默认进程数等于核数时为 1），
+    进程池满载时总线程数不超过核数
+    """
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _init_worker(threads: int):
+    """工作进程初始化：设置本进程的 OpenCV 线程数，避免核数超订"""
+    cv2.setNumThreads(threads)
+
+
+def get_executor(workers: int) -> ProcessPoolExecutor:
+    """获取（或按新的进程数重建）共享进程池"""
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is None or _executor_workers != workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            _executor = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                            initargs=(worker_threads(workers),))
+            _executor_workers = workers
+        return _executor
+
+
+def reset_executor():
+    """丢弃当前进程池（工作进程异常退出后调用）"""
+    global _executor, _executor_workers
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+        _executor_workers = 0
+
+
+def parallel_map(func, *iterables, workers: int = None):
+    """在共享进程池中并行执行 func（按顺序返回结果的迭代器），workers <= 1 时在当前进程内执行"""
+    workers = workers or default_workers()
+    if workers <= 1:
+        return map(func, *iterables)
+    return get_executor(workers).map(func, *iterables)
+
+
+def run_task(task: tuple, use_cache: bool = True) -> tuple:
+    """
+    处理单张图片，异常不向外抛出
+    task 为 (图片字节或 DecodedImage, stages, output_format, quality)
+    返回 (是否成功, 结果字节或错误信息)
+    """
+    image, stages, output_format, quality = task
+    try:
+        return True, run_pipeline(image, stages, output_format, quality, use_cache)
+    except Exception as e:
+        return False, str(e)
+
+
+def _cached_future(result: bytes) -> Future:
+    future = Future()
+    future.set_result((True, result))
+    return future
+
+
+def process_batch(tasks, workers: int = None):
+    """
+    并行处理一批图片，按提交顺序逐个产出 (是否成功, 结果字节或错误信息)
+    tasks 可以是惰性迭代器：同时在途的任务最多 workers * 2 个，
+    已完成的结果逐个交给调用方，不会在内存中累积整批输出
+    workers <= 1 时在当前进程内顺序处理
+    """
+    workers = workers or default_workers()
+    if workers <= 1:
+        yield from map(run_task, tasks)
+        return
+
+    executor = get_executor(workers)
+    pending = deque()
+
+    def collect():
+        future, key = pending.popleft()
+        ok, result = future.result()
+        if ok and key is not None:
+            result_cache.put(key, result)
+        return ok, result
+
+    try:
+        for task in tasks:
+            # 结果缓存在主进程内查询与写入，命中的图片不再发往工作进程
+            key = pipeline_key(*task)
+            cached = result_cache.get(key) if key is not None else None
+            if cached is not None:
+                pending.append((_cached_future(cached), None))
+            else:
+                pending.append((executor.submit(run_task, task, False), key))
+            if len(pending) >= workers * 2:
+                yield collect()
+        while pending:
+            yield collect()
+    except BrokenProcessPool:
+        reset_executor()
+        raise
+    finally:
+        # 客户端中途断开时取消尚未开始的任务
+        for future, _ in pending:
+            future.cancel()
+
+
+class _ZipStream:
+    """只写缓冲区：ZipFile 写入后由生成器取走，不支持 seek/tell 即按流式写出"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def iter_zip(entries):
+    """
+    流式生成 ZIP：每写完一个条目就产出对应字节
+    entries 为 (文件名, 数据) 的迭代器；JPEG/WebP 条目直接存储，其余 DEFLATE
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, data in entries:
+            if name.lower().endswith(STORED_EXTENSIONS):
+                compress_type = zipfile.ZIP_STORED
+            else:
+                compress_type = zipfile.ZIP_DEFLATED
+            zip_file.writestr(name, data, compress_type=compress_type)
+            yield stream.drain()
+    # 中央目录
+    yield stream.drain()
@@ -0,0 +1,249 @@
+# 批量共享水印遮罩：在一批图片的样本上估计一次水印位置，同尺寸图片直接复用
+import hashlib
+import os
+from collections import Counter
+
+import cv2
+import numpy as np
+
+from backend.animation import AnimationReader
+from backend.cache import stage_key
+from backend.detect import candidate_regions, detect_scale
+from backend.metrics import stage_timer
+from backend.resize import image_size
+from backend.watermark_remover import (
+    auto_pixel_mask,
+    color_pixel_mask,
+    inpaint_roi,
+    DecodedImage,
+    load_image,
+    refine_auto_mask,
+    refine_color_mask,
+)
+
+
+# 参与估计的样本图片数上限（环境变量 SHARED_MASK_SAMPLES，默认 16）
+SHARED_MASK_SAMPLES = int(os.environ.get('SHARED_MASK_SAMPLES', 16))
+
+# 同尺寸图片少于该数量时不估计共享遮罩，逐张检测
+SHARED_MASK_MIN_SAMPLES = 3
+
+# 像素在多少比例的样本中被检出才计入共享遮罩（一致性）
+SHARED_MASK_AGREEMENT = float(os.environ.get('SHARED_MASK_AGREEMENT', 0.5))
+
+# 样本梯度中值的边缘阈值（缩小图上的 Sobel 幅值）：内容随图片变化，梯度中值趋近 0，
+# 位置固定的水印笔画边缘在各图中都存在，中值仍然较高
+MEDIAN_EDGE_LEVEL = 24
+
+# 区域遮罩的边界中至少有这一比例落在稳定边缘附近，才视为水印
+# （水印笔画的轮廓就是稳定边缘；内容偶然一致的浅色区域只有部分轮廓与之重合）
+EDGE_SUPPORT = 0.5
+
+
+def pixel_mask(img: np.ndarray, method: str, params: dict) -> np.ndarray:
+    """各去水印方式的逐像素检测遮罩（auto：浅色阈值；color：颜色范围）"""
+    if method == 'auto':
+        return auto_pixel_mask(img, params.get('threshold', 200))
+    return color_pixel_mask(img, params.get('color_lower', (200, 200, 200)),
+                            params.get('color_upper', (255, 255, 255)))
+
+
+def gradient_magnitude(img: np.ndarray, factor: int) -> np.ndarray:
+    """按 factor 缩小后的灰度梯度幅值（uint8）"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    if factor > 1:
+        height, width = gray.shape
+        gray = cv2.resize(gray, (-(-width // factor), -(-height // factor)), interpolation=cv2.INTER_AREA)
+    gx = cv2.Sobel(gray, cv2.CV_16S, 1, 0)
+    gy = cv2.Sobel(gray, cv2.CV_16S, 0, 1)
+    return cv2.addWeighted(cv2.convertScaleAbs(gx), 0.5, cv2.convertScaleAbs(gy), 0.5, 0)
+
+
+def edge_support(roi: np.ndarray, edges: np.ndarray, x0: int, y0: int, factor: int) -> float:
+    """
+    区域遮罩 roi（位于 (x0, y0)）的边界像素中落在稳定边缘附近的比例
+    edges 为缩小 factor 倍的稳定边缘图（已外扩一个像素）
+    """
+    boundary = (roi > 0) & ~(cv2.erode(roi, np.ones((3, 3), np.uint8)) > 0)
+    if not boundary.any():
+        return 0.0
+    height, width = roi.shape
+    sx, sy = x0 // factor, y0 // factor
+    block = edges[sy:-(-(y0 + height) // factor), sx:-(-(x0 + width) // factor)]
+    near = np.repeat(np.repeat(block, factor, axis=0), factor, axis=1)
+    near = near[y0 - sy * factor:y0 - sy * factor + height, x0 - sx * factor:x0 - sx * factor + width]
+    return float(near[boundary].mean())
+
+
+def sample_statistics(image, resize, method: str, params: dict) -> tuple:
+    """
+    一张样本图片的统计量（在工作进程中运行）
+    返回 (按位压缩的检测遮罩, 缩小图梯度幅值)，压缩后发回主进程的数据量为整图的 1/8
+    """
+    img = load_image(image, resize)
+    height, width = img.shape[:2]
+    mask = pixel_mask(img, method, params)
+    gradient = gradient_magnitude(img, detect_scale(height, width))
+    return np.packbits(mask > 0), gradient
+
+
+class SharedMask:
+    """
+    批量共享的水印遮罩：width x height 图片上各水印区域的 (x0, y0, 局部遮罩)
+    只保存水印附近的局部遮罩，随任务发往工作进程的数据量与水印大小相关
+    """
+
+    def __init__(self, width: int, height: int, regions: list, radius: int, engine: str = 'telea'):
+        self.width = width
+        self.height = height
+        self.regions = regions
+        self.radius = radius
+        self.engine = engine
+
+        digest = hashlib.sha1(repr((width, height, radius, engine)).encode())
+        for x0, y0, roi_mask in regions:
+            digest.update(repr((x0, y0, roi_mask.shape)).encode())
+            digest.update(roi_mask.tobytes())
+        self.key = 'shared:' + digest.hexdigest()
+
+    def apply(self, img: np.ndarray) -> np.ndarray:
+        """按共享遮罩修复（直接修改 img 并返回）"""
+        for x0, y0, roi_mask in self.regions:
+            inpaint_roi(img, x0, y0, roi_mask, radius=self.radius, engine=self.engine)
+        return img
+
+
+class SharedMaskStage:
+    """
+    使用共享遮罩的去水印阶段：尺寸与共享遮罩一致的图片跳过检测直接修复，
+    其余图片按原方式（fallback）逐张检测
+    """
+
+    def __init__(self, shared: SharedMask, fallback):
+        self.shared = shared
+        self.fallback = fallback
+
+    @property
+    def key(self):
+        inner = stage_key(self.fallback)
+        if inner is None:
+            return None
+        return f'{self.shared.key}|{inner}'
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        height, width = img.shape[:2]
+        if (width, height) != (self.shared.width, self.shared.height):
+            return self.fallback(img)
+        return self.shared.apply(img)
+
+
+def _select_samples(images: list, resize) -> tuple:
+    """
+    取最常见的（缩小后）尺寸，返回 (尺寸, 原图尺寸, 该尺寸下均匀抽取的样本)；
+    数量不足时返回 (None, None, [])
+    """
+    sources, sizes = [], []
+    for image in images:
+        source = image_size(image)
+        size = source
+        if source is not None and resize is not None:
+            size = resize.target_size(*source)
+        sources.append(source)
+        sizes.append(size)
+
+    counts = Counter(size for size in sizes if size is not None)
+    if not counts:
+        return None, None, []
+    size, count = counts.most_common(1)[0]
+    if count < SHARED_MASK_MIN_SAMPLES:
+        return None, None, []
+
+    matching = [i for i, image_size_ in enumerate(sizes) if image_size_ == size]
+    step = max(1, len(matching) // SHARED_MASK_SAMPLES)
+    chosen = matching[::step][:SHARED_MASK_SAMPLES]
+    return size, sources[chosen[0]], [images[i] for i in chosen]
+
+
+def estimate_shared_mask(images: list, method: str, params: dict,
+                         resize=None, map_func=map):
+    """
+    在一批图片的样本上估计共享水印遮罩，无法估计时返回 None
+
+    对最常见尺寸的图片均匀抽样（最多 SHARED_MASK_SAMPLES 张），统计每个像素被检出的比例
+    （一致性图），保留比例不低于 SHARED_MASK_AGREEMENT 的像素；再用样本梯度中值验证：
+    只保留轮廓与稳定边缘重合的区域，图片内容偶然一致的浅色区域（天空、白墙）不计入。
+    其余处理与对应方式一致（auto 的去噪与面积过滤、color 的形态学处理）。
+    params 为对应方式的参数（min_area/max_area 按原图像素数，缩小输出时按比例映射，
+    inpaint_engine 为修复引擎）；
+    map_func 用于并行计算样本统计量（如进程池的 map）
+    """
+    size, source, samples = _select_samples(images, resize)
+    if size is None:
+        return None
+    width, height = size
+    area_scale = (width / source[0]) ** 2
+
+    with stage_timer('mask'):
+        votes = np.zeros(height * width, np.uint16)
+        gradients = []
+        for packed, gradient in map_func(sample_statistics, samples, [resize] * len(samples),
+                                         [method] * len(samples), [params] * len(samples)):
+            votes += np.unpackbits(packed, count=height * width)
+            gradients.append(gradient)
+        votes = votes.reshape(height, width)
+
+        needed = max(2, int(np.ceil(len(samples) * SHARED_MASK_AGREEMENT)))
+        consistent = np.where(votes >= needed, 255, 0).astype(np.uint8)
+        del votes
+        edges = np.where(np.median(np.stack(gradients), axis=0) >= MEDIAN_EDGE_LEVEL, 255, 0).astype(np.uint8)
+        edges = cv2.dilate(edges, np.ones((3, 3), np.uint8)) > 0
+        factor = detect_scale(height, width)
+
+        regions = []
+        if method == 'color':
+            consistent = refine_color_mask(consistent)
+        for x0, y0, x1, y1, footprint in candidate_regions(consistent):
+            roi = np.where(footprint, consistent[y0:y1, x0:x1], 0).astype(np.uint8)
+            # 轮廓不在稳定边缘上：不是位置固定的水印
+            if edge_support(roi, edges, x0, y0, factor) < EDGE_SUPPORT:
+                continue
+            if method == 'auto':
+                roi = refine_auto_mask(roi, int(params.get('min_area', 100) * area_scale),
+                                       max(1, int(params.get('max_area', 50000) * area_scale)))
+                if roi is None:
+                    continue
+            elif not roi.any():
+                continue
+            regions.append((x0, y0, roi))
+
+    if not regions:
+        # 样本中没有位置固定的水印，逐张检测
+        return None
+    return SharedMask(width, height, regions, radius=5 if method == 'auto' else 3,
+                      engine=params.get('inpaint_engine', 'telea'))
+
+
+def sample_frames(image_bytes: bytes, count: int) -> list:
+    """
+    动图中均匀抽取的至多 count 帧（DecodedImage）
+    按顺序解码到最后一个样本帧为止，只保留样本帧
+    """
+    digest = hashlib.sha1(image_bytes).hexdigest()
+    with AnimationReader(image_bytes) as reader:
+        total = reader.frame_count
+        chosen = set(np.linspace(0, total - 1, min(total, count)).round().astype(int).tolist())
+        samples = []
+        for index, (img, _) in enumerate(reader):
+            if index in chosen:
+                samples.append(DecodedImage(img, f'{digest}:{index}'))
+                if len(samples) == len(chosen):
+                    break
+    return samples
+
+
+def estimate_animation_mask(image_bytes: bytes, method: str, params: dict, resize=None):
+    """
+    动图的共享水印遮罩：在均匀抽取的帧上估计一次（方法同 estimate_shared_mask），
+    之后每帧跳过检测直接修复；帧数太少或没有位置固定的水印时返回 None（逐帧检测）
+    """
+    return estimate_shared_mask(sample_frames(image_bytes, SHARED_MASK_SAMPLES), method, params, resize)
@@ -0,0 +1,277 @@
+# 处理结果缓存：按输入内容哈希 + 规范化参数寻址
+import functools
+import hashlib
+import inspect
+import os
+import threading
+from collections import OrderedDict
+
+
+# 内存层容量（MB），按结果字节数淘汰最久未使用的条目；0 表示不使用
+RESULT_CACHE_MEMORY_MB = int(os.environ.get('RESULT_CACHE_MEMORY_MB', 64))
+
+# 磁盘层容量（MB），多进程共享；0 表示不使用
+RESULT_CACHE_DISK_MB = int(os.environ.get('RESULT_CACHE_DISK_MB', 1024))
+
+# 磁盘层目录
+RESULT_CACHE_DIR = os.environ.get(
+    'RESULT_CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads', 'cache')
+)
+
+# 磁盘层超出容量时清理到容量的比例，避免每次写入都触发清理
+DISK_TRIM_RATIO = 0.9
+
+# 缓存键的版本：处理结果随代码变化（算法、渲染、编码参数等）时加一，
+# 磁盘层中旧版本的结果不再命中，随容量淘汰
+CACHE_VERSION = 1
+
+
+class ResultCache:
+    """
+    两级结果缓存
+    内存层为进程内 LRU；磁盘层按内容键存文件，命中时刷新修改时间，
+    超出容量时按修改时间从旧到新删除。两层都统计命中、未命中与淘汰次数。
+    """
+
+    def __init__(self, memory_mb: int, disk_mb: int, directory: str):
+        self.memory_limit = memory_mb * 1024 * 1024
+        self.disk_limit = disk_mb * 1024 * 1024
+        self.directory = directory
+        self._memory = OrderedDict()
+        self._memory_bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.counters = {
+            'memory_hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'memory_evictions': 0,
+            'disk_evictions': 0,
+        }
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key: str):
+        """查找缓存，未命中返回 None"""
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                self.counters['memory_hits'] += 1
+                return data
+
+        if self.disk_limit:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+                os.utime(path)
+            except OSError:
+                data = None
+            if data is not None:
+                with self._lock:
+                    self.counters['disk_hits'] += 1
+                self._put_memory(key, data)
+                return data
+
+        with self._lock:
+            self.counters['misses'] += 1
+        return None
+
+    def put(self, key: str, data: bytes):
+        """写入两级缓存"""
+        self._put_memory(key, data)
+        if self.disk_limit and len(data) <= self.disk_limit:
+            self._put_disk(key, data)
+
+    def _put_memory(self, key: str, data: bytes):
+        # 单个结果超过内存层四分之一时只存磁盘
+        if len(data) > self.memory_limit // 4:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = data
+            self._memory_bytes += len(data)
+            while self._memory_bytes > self.memory_limit:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_bytes -= len(evicted)
+                self.counters['memory_evictions'] += 1
+
+    def _put_disk(self, key: str, data: bytes):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+
+        with self._lock:
+            scanned = self._disk_bytes is not None
+            if scanned:
+                self._disk_bytes += len(data)
+        if not scanned:
+            # 首次写入时统计磁盘层占用；遍历目录不持有锁，不阻塞其他缓存读写
+            total = sum(size for _, size, _ in self._scan_disk())
+            with self._lock:
+                if self._disk_bytes is None:
+                    self._disk_bytes = total
+                else:
+                    self._disk_bytes += len(data)
+        with self._lock:
+            over = self._disk_bytes > self.disk_limit
+        if over:
+            self._trim_disk()
+
+    def _scan_disk(self) -> list:
+        """磁盘层所有条目 (路径, 大小, 修改时间)"""
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _trim_disk(self):
+        """按修改时间从旧到新删除，直到低于容量的 DISK_TRIM_RATIO"""
+        entries = sorted(self._scan_disk(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_limit * DISK_TRIM_RATIO
+        evicted = 0
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            evicted += 1
+        with self._lock:
+            self._disk_bytes = total
+            self.counters['disk_evictions'] += evicted
+
+    def stats(self) -> dict:
+        """命中/未命中/淘汰计数与当前占用"""
+        with self._lock:
+            stats = dict(self.counters)
+            stats['memory_entries'] = len(self._memory)
+            stats['memory_bytes'] = self._memory_bytes
+            stats['disk_bytes'] = self._disk_bytes
+        return stats
+
+    def clear(self):
+        """清空内存层（磁盘层由容量淘汰）"""
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+
+
+result_cache = ResultCache(RESULT_CACHE_MEMORY_MB, RESULT_CACHE_DISK_MB, RESULT_CACHE_DIR)
+
+
+def enabled() -> bool:
+    return bool(result_cache.memory_limit or result_cache.disk_limit)
+
+
+def _value_key(value) -> str:
+    """参数值的规范化表示：字节按内容哈希，其余按值"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return 'sha1:' + hashlib.sha1(value).hexdigest()
+    if isinstance(value, (list, tuple)):
+        return '(' + ','.join(_value_key(item) for item in value) + ')'
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return repr(value)
+
+
+def stage_key(stage):
+    """
+    处理阶段的规范化参数表示，无法确定参数的阶段返回 None（不缓存）
+    支持 functools.partial、带 key 属性的对象（预编译水印、分块阶段）与模块级函数
+    """
+    if isinstance(stage, functools.partial):
+        func_key = stage_key(stage.func)
+        if func_key is None:
+            return None
+        args = ','.join(_value_key(arg) for arg in stage.args)
+        kwargs = ','.join(f'{name}={_value_key(value)}'
+                          for name, value in sorted(stage.keywords.items()))
+        return f'{func_key}({args};{kwargs})'
+
+    key = getattr(stage, 'key', None)
+    if isinstance(key, str):
+        return key
+
+    qualname = getattr(stage, '__qualname__', None)
+    if qualname is None or '<' in qualname:
+        return None
+    return f'{stage.__module__}.{qualname}'
+
+
+def pipeline_key(image, stages: list, output_format: str = 'png', quality: int = 95):
+    """
+    流水线结果的缓存键，任一阶段无法确定参数时返回 None
+    image 为图片字节，或带 digest（原始内容哈希）的已解码图片；键中含 CACHE_VERSION
+    """
+    if not enabled():
+        return None
+    parts = []
+    for stage in stages:
+        key = stage_key(stage)
+        if key is None:
+            return None
+        parts.append(key)
+
+    output_format = output_format.lower()
+    if output_format == 'jpeg':
+        output_format = 'jpg'
+    quality = max(1, min(100, int(quality)))
+
+    source = getattr(image, 'digest', None) or hashlib.sha1(image).hexdigest()
+    digest = hashlib.sha1(f'{CACHE_VERSION}:{source}'.encode())
+    digest.update(repr((parts, output_format, quality)).encode())
+    return 'p' + digest.hexdigest()
+
+
+def cached_call(func):
+    """
+    bytes 接口函数的结果缓存：按绑定默认值后的全部参数与 CACHE_VERSION 寻址
+    （同一调用无论是否显式传入默认参数都命中同一条目）
+    """
+    signature = inspect.signature(func)
+    name = f'{func.__module__}.{func.__qualname__}'
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not enabled():
+            return func(*args, **kwargs)
+
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        digest = hashlib.sha1(f'{CACHE_VERSION}:{name}'.encode())
+        for param, value in bound.arguments.items():
+            digest.update(f'{param}={_value_key(value)};'.encode())
+        key = 'c' + digest.hexdigest()
+
+        result = result_cache.get(key)
+        if result is None:
+            result = func(*args, **kwargs)
+            result_cache.put(key, result)
+        return result
+
+    return wrapper
@@ -0,0 +1,154 @@
+# 水印合成
+import cv2
+import numpy as np
+
+
+# 平铺合成时每次处理的行数（按条带处理以限制临时内存）
+STRIP_ROWS = 256
+
+
+def pil_to_bgra(img) -> np.ndarray:
+    """PIL RGBA 图片转 BGRA 数组"""
+    return cv2.cvtColor(np.asarray(img.convert('RGBA')), cv2.COLOR_RGBA2BGRA)
+
+
+def premultiply(bgra: np.ndarray, mode: str = 'over') -> np.ndarray:
+    """
+    BGRA 水印转为合成用的精灵图：float32 (h, w, 4)，预乘颜色 + alpha(0-1)
+    mode 含义同 fold_cells：'over' 为直接 alpha 覆盖（paste 到不透明原图，
+    或已画在透明图层上的内容）；'paste' 为先 paste 到透明图层再合成
+    """
+    sprite = bgra.astype(np.float32)
+    alpha = sprite[..., 3:] / 255
+    if mode == 'paste':
+        # 透明图层 (255, 255, 255, 0) 上 paste 后：颜色按 alpha 与白色混合，alpha 变为 alpha²
+        sprite[..., :3] = 255 * (1 - alpha) + sprite[..., :3] * alpha
+        alpha = alpha * alpha
+    sprite[..., :3] *= alpha
+    sprite[..., 3:] = alpha
+    return sprite
+
+
+def composite_sprite(img: np.ndarray, sprite: np.ndarray, x: int, y: int) -> np.ndarray:
+    """
+    把精灵图（见 premultiply）合成到 BGR 图片的 (x, y) 处（原地修改）
+    只处理与图片相交的包围盒，耗时与水印大小相关，与图片大小无关；
+    x, y 可以为负或超出图片（img 是整图中的一个窗口时为相对窗口的坐标）
+    """
+    img_height, img_width = img.shape[:2]
+    height, width = sprite.shape[:2]
+    left, top = max(0, x), max(0, y)
+    right, bottom = min(img_width, x + width), min(img_height, y + height)
+    if left >= right or top >= bottom:
+        return img
+
+    region = img[top:bottom, left:right]
+    part = sprite[top - y:bottom - y, left - x:right - x]
+    for row in range(0, bottom - top, STRIP_ROWS):
+        strip = region[row:row + STRIP_ROWS]
+        cell = part[row:row + STRIP_ROWS]
+        strip[:] = (strip * (1 - cell[..., 3:]) + cell[..., :3] + 0.5).astype(np.uint8)
+    return img
+
+
+def fold_cells(tile: np.ndarray, spacing: tuple, mode: str = 'over') -> dict:
+    """
+    把平铺单元折叠为一个周期格子（spacing 大小）
+
+    旋转后的水印可能大于间距，相邻单元会互相重叠。这里把单元按间距切块，
+    按原来逐个 paste 的先后顺序（先上后下、先左后右）叠加到同一个格子里。
+    靠近起点的第一行/列单元没有左上方邻居，因此按 (行区, 列区) 分别折叠。
+
+    mode='over'：单元直接 paste 到不透明原图上（逐个 alpha 覆盖）；
+    mode='paste'：单元先 paste 到透明图层，再把图层 alpha_composite 到原图，
+    与 PIL paste(mask=alpha) 一致，四个通道都按 alpha 混合。
+
+    返回 {(ki, kj): 格子}，格子为 float32 (sy, sx, 4)：预乘颜色 + alpha(0-1)。
+    结果只与水印和间距有关，同一水印合成多幅图片（或动图的各帧）时可预先折叠一次。
+    """
+    sx, sy = spacing
+    h, w = tile.shape[:2]
+    nbi, nbj = -(-h // sy), -(-w // sx)
+
+    padded = np.zeros((nbi * sy, nbj * sx, 4), np.float32)
+    padded[:h, :w] = tile
+    padded[..., 3] /= 255
+
+    cells = {}
+    for ki in range(nbi):
+        for kj in range(nbj):
+            cell = np.zeros((sy, sx, 4), np.float32)
+            if mode == 'paste':
+                # 透明图层初始为 (255, 255, 255, 0)
+                cell[..., :3] = 255
+            for bi in range(ki, -1, -1):
+                for bj in range(kj, -1, -1):
+                    block = padded[bi * sy:(bi + 1) * sy, bj * sx:(bj + 1) * sx]
+                    m = block[..., 3:]
+                    cell[..., :3] = cell[..., :3] * (1 - m) + block[..., :3] * m
+                    if mode == 'paste':
+                        cell[..., 3:] = cell[..., 3:] * (1 - m) + m * m
+                    else:
+                        cell[..., 3:] = cell[..., 3:] * (1 - m) + m
+            if mode == 'paste':
+                # 图层颜色为非预乘值，合成前转为预乘
+                cell[..., :3] *= cell[..., 3:]
+            cells[ki, kj] = cell
+    return cells
+
+
+def _blend_pattern(region: np.ndarray, cell: np.ndarray, phase: tuple = (0, 0)):
+    """
+    用周期格子（预乘颜色 + alpha）原地覆盖 region，按条带做向量化混合
+    phase=(py, px) 为 region 左上角对应的格子内坐标
+    """
+    rh, rw = region.shape[:2]
+    sy, sx = cell.shape[:2]
+    py, px = phase
+
+    # 条带高度取格子高度的整数倍，每个条带都从格子的同一行开始
+    strip_h = min(rh, sy * max(1, STRIP_ROWS // sy))
+    pattern = np.tile(cell, (-(-(py + strip_h) // sy), -(-(px + rw) // sx), 1))
+    pattern = pattern[py:py + strip_h, px:px + rw]
+    premul = pattern[..., :3]
+    inv_alpha = 1 - pattern[..., 3:]
+
+    for y in range(0, rh, strip_h):
+        strip = region[y:y + strip_h]
+        n = strip.shape[0]
+        strip[:] = (strip * inv_alpha[:n] + premul[:n] + 0.5).astype(np.uint8)
+
+
+def composite_tiled(img: np.ndarray, tile: np.ndarray,
+                    origin: tuple, spacing: tuple, mode: str = 'over',
+                    cells: dict = None) -> np.ndarray:
+    """
+    平铺水印合成（原地修改 BGR 图片）
+
+    tile 为渲染好的单个 BGRA 水印，只渲染一次；从 origin=(x, y) 开始按
+    spacing=(sx, sy) 向右下平铺，与逐个 paste 的结果一致。
+    origin 可以为负（img 是整图中的一个窗口时，origin 为相对窗口的坐标），
+    窗口内的结果与在整图上合成后裁剪一致。
+    mode 见 fold_cells；cells 为预先折叠好的格子（fold_cells 的结果），省略时按 tile 折叠。
+    """
+    img_height, img_width = img.shape[:2]
+    x0, y0 = origin
+    sx, sy = spacing
+
+    if cells is None:
+        cells = fold_cells(tile, spacing, mode)
+    nbi = max(ki for ki, _ in cells) + 1
+    nbj = max(kj for _, kj in cells) + 1
+
+    for (ki, kj), cell in cells.items():
+        top = y0 + ki * sy
+        left = x0 + kj * sx
+        bottom = img_height if ki == nbi - 1 else min(img_height, top + sy)
+        right = img_width if kj == nbj - 1 else min(img_width, left + sx)
+        start_y, start_x = max(0, top), max(0, left)
+        if start_y >= bottom or start_x >= right:
+            continue
+        phase = ((start_y - top) % sy, (start_x - left) % sx)
+        _blend_pattern(img[start_y:bottom, start_x:right], cell, phase)
+
+    return img
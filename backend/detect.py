@@ -0,0 +1,59 @@
+# 水印候选区域检测
+import cv2
+import numpy as np
+
+
+# 候选检测时缩小图的长边上限
+DETECT_MAX_SIDE = 1024
+
+# 候选区域四周保留的全分辨率像素数（覆盖闭/开运算与遮罩膨胀的影响范围）
+DETECT_CONTEXT = 4
+
+
+def detect_scale(img_height: int, img_width: int, max_side: int = DETECT_MAX_SIDE) -> int:
+    """检测用的整数缩小倍数"""
+    return max(1, -(-max(img_height, img_width) // max_side))
+
+
+def max_pool(mask: np.ndarray, factor: int) -> np.ndarray:
+    """
+    二值遮罩按整数倍缩小（块内任一像素为正则为正）
+    用 INTER_AREA 在整数倍下等价于块均值，均值大于 0 即块内存在正像素
+    """
+    if factor == 1:
+        return mask.copy()
+    height, width = mask.shape[:2]
+    small_h, small_w = -(-height // factor), -(-width // factor)
+    padded = cv2.copyMakeBorder(mask, 0, small_h * factor - height, 0, small_w * factor - width,
+                                cv2.BORDER_CONSTANT, value=0)
+    small = cv2.resize(padded, (small_w, small_h), interpolation=cv2.INTER_AREA)
+    return np.where(small > 0, 255, 0).astype(np.uint8)
+
+
+def candidate_regions(mask: np.ndarray, context: int = DETECT_CONTEXT,
+                      max_side: int = DETECT_MAX_SIDE):
+    """
+    在缩小图上查找候选区域，逐个产出 (x0, y0, x1, y1, footprint)
+
+    坐标为全分辨率 ROI；footprint 为与 ROI 同尺寸的 bool 数组，只覆盖本候选
+    （含 context 外扩），相邻候选的像素不会出现在其中。不同候选的正像素相距
+    超过 2 * context，因此在各自 ROI 内做形态学处理与整图处理结果一致。
+    """
+    img_height, img_width = mask.shape[:2]
+    factor = detect_scale(img_height, img_width, max_side)
+
+    small = max_pool(mask, factor)
+    grow = -(-context // factor)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * grow + 1, 2 * grow + 1))
+    small = cv2.dilate(small, kernel)
+
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(small, connectivity=8)
+    for label in range(1, count):
+        sx, sy, sw, sh = stats[label, :4]
+        x0, y0 = sx * factor, sy * factor
+        x1, y1 = min(img_width, (sx + sw) * factor), min(img_height, (sy + sh) * factor)
+
+        footprint = labels[sy:sy + sh, sx:sx + sw] == label
+        if factor > 1:
+            footprint = np.repeat(np.repeat(footprint, factor, axis=0), factor, axis=1)
+        yield x0, y0, x1, y1, footprint[:y1 - y0, :x1 - x0]
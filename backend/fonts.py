@@ -0,0 +1,149 @@
+# 字体注册表
+import hashlib
+import io
+import os
+import re
+import time
+from functools import lru_cache
+
+from PIL import ImageFont
+
+
+# 系统中文字体候选（按优先级）
+SYSTEM_FONT_PATHS = [
+    '/System/Library/Fonts/PingFang.ttc',  # macOS
+    '/System/Library/Fonts/STHeiti Light.ttc',  # macOS
+    '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc',  # Linux
+    '/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf',  # Linux
+    'C:/Windows/Fonts/msyh.ttc',  # Windows
+    'C:/Windows/Fonts/simhei.ttf',  # Windows
+]
+
+# 用户上传字体的存放目录（多进程共享，按内容哈希命名）
+FONT_DIR = os.environ.get(
+    'FONT_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads', 'fonts')
+)
+
+FONT_EXTENSIONS = ('.ttf', '.otf', '.ttc')
+
+# 上传字体目录的容量上限（MB），超出后删除最久未使用的字体
+FONT_DIR_MAX_MB = int(os.environ.get('FONT_DIR_MAX_MB', 256))
+
+# 上传字体的有效期（秒，默认 30 天），每次使用后重新计时
+FONT_TTL = int(os.environ.get('FONT_TTL', 30 * 24 * 3600))
+
+# 已加载字体对象缓存上限（按 (路径, 字号) 淘汰）
+FONT_CACHE_SIZE = 64
+
+_FONT_ID_RE = re.compile(r'^[0-9a-f]{16}\.(ttf|otf|ttc)$')
+
+
+def _resolve_system_font():
+    """探测可用的系统中文字体，只在导入时执行一次"""
+    for font_path in SYSTEM_FONT_PATHS:
+        if os.path.exists(font_path):
+            try:
+                ImageFont.truetype(font_path, 12)
+                return font_path
+            except Exception:
+                continue
+    return None
+
+
+DEFAULT_FONT_PATH = _resolve_system_font()
+
+
+def _purge_fonts(now: float, incoming: int = 0):
+    """
+    删除字体目录中过期的字体；其余文件加上即将写入的 incoming 字节超过容量时，
+    按修改时间（使用时间）从旧到新删除
+    """
+    if not os.path.isdir(FONT_DIR):
+        return
+    entries = []
+    for name in os.listdir(FONT_DIR):
+        path = os.path.join(FONT_DIR, name)
+        try:
+            stat = os.stat(path)
+            if now - stat.st_mtime > FONT_TTL:
+                os.remove(path)
+                continue
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path, name.endswith('.tmp')))
+
+    total = sum(size for _, size, _, _ in entries) + incoming
+    for _, size, path, writing in sorted(entries):
+        if total <= FONT_DIR_MAX_MB * 1024 * 1024:
+            break
+        if writing:
+            # 其他进程正在写入的临时文件
+            continue
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def register_font(font_bytes: bytes, filename: str) -> str:
+    """
+    注册用户上传的字体文件，返回字体 ID
+    相同内容的字体只保存一次；写入前清理过期字体并按容量上限淘汰最久未使用的字体
+    """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext not in FONT_EXTENSIONS:
+        raise ValueError('仅支持 .ttf/.otf/.ttc 字体文件')
+
+    try:
+        ImageFont.truetype(io.BytesIO(font_bytes), 12)
+    except Exception:
+        raise ValueError('无法识别的字体文件')
+
+    font_id = hashlib.sha1(font_bytes).hexdigest()[:16] + ext
+    path = os.path.join(FONT_DIR, font_id)
+    if len(font_bytes) > FONT_DIR_MAX_MB * 1024 * 1024:
+        raise ValueError('字体文件过大')
+    try:
+        # 已保存过：刷新使用时间
+        os.utime(path)
+    except OSError:
+        _purge_fonts(time.time(), len(font_bytes))
+        os.makedirs(FONT_DIR, exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(font_bytes)
+        os.replace(tmp_path, path)
+    return font_id
+
+
+def font_path(font_id: str = None):
+    """字体 ID 对应的文件路径；未指定时返回默认系统字体路径，使用时刷新字体的使用时间"""
+    if not font_id:
+        return DEFAULT_FONT_PATH
+    if not _FONT_ID_RE.match(font_id):
+        raise ValueError('无效的字体 ID')
+    path = os.path.join(FONT_DIR, font_id)
+    try:
+        # 正在使用的字体不会因过期或容量淘汰被删除
+        os.utime(path)
+    except OSError:
+        raise ValueError('字体不存在，请重新上传')
+    return path
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def _load_font(path, size: int):
+    """按 (路径, 字号) 加载并缓存字体对象"""
+    if path is not None:
+        return ImageFont.truetype(path, size)
+    try:
+        return ImageFont.truetype('arial.ttf', size)
+    except Exception:
+        return ImageFont.load_default()
+
+
+def get_font(size: int, font_id: str = None):
+    """获取指定字号的字体（默认系统中文字体或用户上传字体）"""
+    return _load_font(font_path(font_id), size)
@@ -0,0 +1,104 @@
+# 频域滤波引擎
+import cv2
+import numpy as np
+from functools import lru_cache
+
+
+# 衰减环带（以原图频率坐标计）：inner < 半径 < outer 的频率乘以 gain
+FREQ_INNER_RADIUS = 5
+FREQ_OUTER_RADIUS = 30
+FREQ_GAIN = 0.5
+
+# 遮罩缓存条目上限（超出后按 LRU 淘汰）
+MASK_CACHE_SIZE = 32
+
+
+def optimal_dft_shape(rows: int, cols: int) -> tuple:
+    """返回适合 FFT 的填充尺寸"""
+    return cv2.getOptimalDFTSize(rows), cv2.getOptimalDFTSize(cols)
+
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def annulus_mask(shape: tuple, radius: int = FREQ_OUTER_RADIUS,
+                 inner: int = FREQ_INNER_RADIUS, gain: float = FREQ_GAIN) -> tuple:
+    """
+    生成 CCS 压缩频谱上的环带衰减遮罩（向量化，按 (shape, radius) 缓存）
+
+    cv2.dft 对实数输入输出 CCS 格式：第 0 列按行压缩存放 kx=0 的频谱，
+    第 2k-1/2k 列存放 kx=k 的实部/虚部。环带只落在低频小块上，
+    因此这里只返回小块遮罩 (col0, top, bottom)，不分配整幅遮罩。
+
+    shape 为 (原图行, 原图列, 填充行, 填充列)，半径按原图频率坐标换算，
+    因此填充不会改变被衰减的空间频率。
+    """
+    rows, cols, padded_rows, padded_cols = shape
+    scale_y = rows / padded_rows
+    scale_x = cols / padded_cols
+
+    # 环带在填充频谱上覆盖的行列数（只取低频，不触及 Nyquist 行列）
+    ny = min(int(np.ceil(radius / scale_y)), (padded_rows - 1) // 2)
+    nx = min(int(np.ceil(radius / scale_x)), (padded_cols - 1) // 2)
+
+    # 行频率 0..ny 和 -ny..-1，列频率 0..nx
+    ky = np.concatenate([np.arange(0, ny + 1), np.arange(-ny, 0)]) * scale_y
+    kx = np.arange(0, nx + 1) * scale_x
+    dist2 = ky[:, None] ** 2 + kx[None, :] ** 2
+
+    factor = np.ones(dist2.shape, np.float32)
+    factor[(dist2 > inner * inner) & (dist2 < radius * radius)] = gain
+
+    # kx=0 列：[Re Y0, Re Y1, Im Y1, Re Y2, Im Y2, ...]
+    col0 = np.concatenate([factor[:1, 0], np.repeat(factor[1:ny + 1, 0], 2)])
+    # kx>=1 列：实部虚部各占一列，系数相同
+    top = np.repeat(factor[:ny + 1, 1:], 2, axis=1)
+    bottom = np.repeat(factor[ny + 1:, 1:], 2, axis=1)
+
+    for arr in (col0, top, bottom):
+        arr.setflags(write=False)
+    return col0, top, bottom
+
+
+def apply_annulus_mask(spectrum: np.ndarray, mask: tuple) -> np.ndarray:
+    """在 CCS 频谱上原地应用环带遮罩"""
+    col0, top, bottom = mask
+    spectrum[:col0.shape[0], 0] *= col0
+    spectrum[:top.shape[0], 1:top.shape[1] + 1] *= top
+    if bottom.shape[0]:
+        spectrum[-bottom.shape[0]:, 1:bottom.shape[1] + 1] *= bottom
+    return spectrum
+
+
+def frequency_filter(img: np.ndarray, radius: int = FREQ_OUTER_RADIUS) -> np.ndarray:
+    """
+    对 BGR 图片做环带衰减滤波
+
+    尺寸填充到 cv2.getOptimalDFTSize，三个通道共用同一块填充图与遮罩，
+    逐通道做实数 DFT（CCS 格式，无复数展开），逆变换后裁回原尺寸
+    并逐通道归一化到 0-255。
+    """
+    rows, cols = img.shape[:2]
+    padded_rows, padded_cols = optimal_dft_shape(rows, cols)
+
+    # 镜像填充，避免零填充在边缘引入的高频突变
+    if (padded_rows, padded_cols) != (rows, cols):
+        img = cv2.copyMakeBorder(img, 0, padded_rows - rows, 0, padded_cols - cols,
+                                 cv2.BORDER_REFLECT_101)
+
+    mask = annulus_mask((rows, cols, padded_rows, padded_cols), radius)
+
+    result_channels = []
+    for channel in cv2.split(img):
+        # 实数输入 -> CCS 频谱
+        spectrum = cv2.dft(np.float32(channel))
+        apply_annulus_mask(spectrum, mask)
+
+        # 逆变换直接得到实数结果，裁回原尺寸
+        img_back = cv2.idft(spectrum, flags=cv2.DFT_REAL_OUTPUT)
+        img_back = np.abs(img_back[:rows, :cols])
+
+        # 归一化
+        img_back = cv2.normalize(img_back, None, 0, 255, cv2.NORM_MINMAX)
+        result_channels.append(img_back.astype(np.uint8))
+
+    # 合并通道
+    return cv2.merge(result_channels)
@@ -0,0 +1,204 @@
+# 会话图片存储：上传一次，之后按句柄反复处理
+import os
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from backend.watermark_remover import DecodedImage
+
+
+# 已解码图片的内存上限（MB），超出后淘汰最久未使用的图片
+IMAGE_STORE_MB = int(os.environ.get('IMAGE_STORE_MB', 512))
+
+# 图片句柄的有效期（秒），每次使用后重新计时
+IMAGE_STORE_TTL = int(os.environ.get('IMAGE_STORE_TTL', 1800))
+
+# 共享目录中原始图片字节的容量上限（MB），超出后删除最久未使用的文件
+IMAGE_STORE_DISK_MB = int(os.environ.get('IMAGE_STORE_DISK_MB', 2048))
+
+# 原始图片字节的存放目录（多进程共享：句柄在任一工作进程都有效）
+IMAGE_STORE_DIR = os.environ.get(
+    'IMAGE_STORE_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads', 'images')
+)
+
+_HANDLE_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+class ImageStore:
+    """
+    已解码图片存储（TTL + LRU，按内存上限淘汰）
+    解码结果保存在进程内存中；原始字节同时写入共享目录，多进程部署时其他工作进程
+    （或内存中已被淘汰后）按句柄从磁盘读取并解码一次。共享目录按 TTL 与容量上限清理
+    （超出容量时按使用时间从旧到新删除）。句柄过期或被淘汰后客户端重新上传即可
+    """
+
+    def __init__(self, limit_mb: int, ttl: int, directory: str = None, disk_mb: int = IMAGE_STORE_DISK_MB):
+        self.limit = limit_mb * 1024 * 1024
+        self.ttl = ttl
+        self.directory = directory
+        self.disk_limit = disk_mb * 1024 * 1024
+        self._images = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _path(self, handle: str) -> str:
+        return os.path.join(self.directory, handle)
+
+    def _save(self, handle: str, image_bytes: bytes):
+        """写入原始字节（原子替换），并清理过期文件、腾出容量；单张超过容量时只在本进程有效"""
+        if len(image_bytes) > self.disk_limit:
+            return
+        self._purge_disk(time.time(), len(image_bytes))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = f'{self._path(handle)}.{os.getpid()}.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(image_bytes)
+            os.replace(tmp_path, self._path(handle))
+        except OSError:
+            # 写盘失败时句柄只在本进程有效
+            pass
+
+    def _load(self, handle: str, admit=None):
+        """
+        从共享目录读取并解码，不存在或已过期时返回 None
+        admit(图片字节) 返回上下文管理器时，解码在其中进行（按解码所需内存排队）
+        """
+        path = self._path(handle)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        if admit is None:
+            return DecodedImage.from_bytes(image_bytes)
+        with admit(image_bytes):
+            return DecodedImage.from_bytes(image_bytes)
+
+    def _purge_disk(self, now: float, incoming: int = 0):
+        """
+        删除共享目录中过期的图片；其余文件加上即将写入的 incoming 字节超过容量时，
+        按修改时间（使用时间）从旧到新删除
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        entries = []
+        for name in os.listdir(self.directory):
+            path = self._path(name)
+            try:
+                stat = os.stat(path)
+                if now - stat.st_mtime > self.ttl:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path, name.endswith('.tmp')))
+
+        total = sum(size for _, size, _, _ in entries) + incoming
+        for _, size, path, writing in sorted(entries):
+            if total <= self.disk_limit:
+                break
+            if writing:
+                # 其他进程正在写入的临时文件
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def _expire(self, now: float):
+        """删除过期图片（按最近使用顺序，遇到未过期的即停止）"""
+        while self._images:
+            handle, (image, used_at) = next(iter(self._images.items()))
+            if now - used_at <= self.ttl:
+                break
+            self._remove(handle)
+
+    def _remove(self, handle: str):
+        image, _ = self._images.pop(handle)
+        self._bytes -= image.nbytes
+
+    def _insert(self, handle: str, image, now: float):
+        with self._lock:
+            self._expire(now)
+            if handle in self._images:
+                self._remove(handle)
+            self._images[handle] = (image, now)
+            self._bytes += image.nbytes
+            while self._bytes > self.limit:
+                self._remove(next(iter(self._images)))
+
+    def put(self, image_bytes: bytes) -> tuple:
+        """解码并保存图片，返回 (句柄, DecodedImage)；单张超过上限时抛出 ValueError"""
+        image = DecodedImage.from_bytes(image_bytes)
+        if image.nbytes > self.limit:
+            raise ValueError('图片过大，请直接上传处理')
+
+        handle = secrets.token_hex(16)
+        if self.directory:
+            self._save(handle, image_bytes)
+        self._insert(handle, image, time.time())
+        return handle, image
+
+    def get(self, handle: str, admit=None):
+        """
+        按句柄取图片，不存在或已过期时返回 None
+        本进程内没有、需从共享目录解码时，解码在 admit(图片字节) 返回的上下文中进行
+        """
+        if not _HANDLE_RE.match(handle):
+            return None
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._images.get(handle)
+            if entry is not None:
+                self._images[handle] = (entry[0], now)
+                self._images.move_to_end(handle)
+
+        if entry is not None:
+            # 同步刷新共享目录中的使用时间，其他进程不会提前清理
+            if self.directory:
+                try:
+                    os.utime(self._path(handle))
+                except OSError:
+                    pass
+            return entry[0]
+
+        # 本进程内没有（其他工作进程上传或已被淘汰），从共享目录读取
+        if not self.directory:
+            return None
+        image = self._load(handle, admit)
+        if image is None or image.nbytes > self.limit:
+            return image
+        self._insert(handle, image, now)
+        return image
+
+    def delete(self, handle: str) -> bool:
+        if not _HANDLE_RE.match(handle):
+            return False
+        deleted = False
+        with self._lock:
+            if handle in self._images:
+                self._remove(handle)
+                deleted = True
+        if self.directory:
+            try:
+                os.remove(self._path(handle))
+                deleted = True
+            except OSError:
+                pass
+        return deleted
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'images': len(self._images), 'bytes': self._bytes}
+
+
+image_store = ImageStore(IMAGE_STORE_MB, IMAGE_STORE_TTL, IMAGE_STORE_DIR, IMAGE_STORE_DISK_MB)
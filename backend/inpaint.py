@@ -0,0 +1,175 @@
+# 局部（ROI）修复
+import cv2
+import numpy as np
+
+from backend.detect import max_pool
+from backend.metrics import stage_timer
+
+
+# 可选的修复引擎：telea 为 cv2.inpaint 直接修复；pyramid 为金字塔由粗到细修复（大面积遮罩更快）
+INPAINT_ENGINES = ('telea', 'pyramid')
+
+# 金字塔修复的最大层数（每层缩小一半）
+PYRAMID_MAX_LEVELS = 5
+
+# 金字塔修复在每个精细层重新修复的边界带宽度（像素）；
+# 遮罩内离边界最远的距离不超过该宽度时直接修复，不建金字塔
+PYRAMID_BAND = 8
+
+# 原尺寸边界带占遮罩的比例超过该值时（细笔画遮罩，几乎全部位于边界带内）金字塔没有收益，直接修复
+PYRAMID_MAX_BAND_SHARE = 0.5
+
+
+def roi_padding(radius: int) -> int:
+    """
+    修复区域四周需要保留的像素数
+    TELEA/NS 只参考遮罩边缘 radius 范围内的已知像素，留出两倍余量后
+    在裁剪区域内修复与整图修复结果一致
+    """
+    return 2 * radius + 1
+
+
+def pyramid_levels(mask: np.ndarray, band: int = PYRAMID_BAND) -> int:
+    """
+    金字塔层数：逐层减半，直到遮罩内离边界最远的距离不超过 band
+    细长的笔画遮罩为 0 层（直接修复），大块遮罩层数随其厚度增加
+    """
+    distance = cv2.distanceTransform(mask, cv2.DIST_L2, 3)
+    masked = np.count_nonzero(mask)
+    if not masked or np.count_nonzero(distance > band) < masked * (1 - PYRAMID_MAX_BAND_SHARE):
+        return 0
+    depth = distance.max()
+    levels = 0
+    while depth > band and levels < PYRAMID_MAX_LEVELS and min(mask.shape[:2]) >> (levels + 1) >= band:
+        depth /= 2
+        levels += 1
+    return levels
+
+
+def _downscale(img: np.ndarray, mask: np.ndarray) -> tuple:
+    """
+    图片与遮罩缩小一半：奇数边先复制边缘补齐，图片按 2x2 块均值，遮罩按块内任一像素，
+    含遮罩像素（水印颜色）的块都计入遮罩，遮罩外的缩小像素只来自原始像素
+    """
+    height, width = mask.shape[:2]
+    if height % 2 or width % 2:
+        img = cv2.copyMakeBorder(img, 0, height % 2, 0, width % 2, cv2.BORDER_REPLICATE)
+    size = (-(-width // 2), -(-height // 2))
+    small = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+    return small, max_pool(mask, 2)
+
+
+def inpaint_pyramid(img: np.ndarray, mask: np.ndarray,
+                    radius: int = 5, flags: int = cv2.INPAINT_TELEA,
+                    band: int = PYRAMID_BAND) -> np.ndarray:
+    """
+    金字塔由粗到细修复，返回修复后的新数组（与 cv2.inpaint 用法一致）
+
+    在最粗一层修复整个遮罩；之后逐层放大：遮罩内像素先取上一层结果的放大值，
+    再只对遮罩边界内 band 宽的一圈重新修复，使边缘与周围的原始像素衔接。
+    遮罩内部的修复量随层数按 4 倍递减，大面积遮罩远快于在原尺寸上直接修复。
+    """
+    mask = np.where(mask > 0, 255, 0).astype(np.uint8)
+    levels = pyramid_levels(mask, band)
+    if levels == 0:
+        return cv2.inpaint(img, mask, inpaintRadius=radius, flags=flags)
+
+    pyramid = [(img, mask)]
+    for _ in range(levels):
+        pyramid.append(_downscale(*pyramid[-1]))
+
+    coarse_img, coarse_mask = pyramid.pop()
+    result = cv2.inpaint(coarse_img, coarse_mask, inpaintRadius=radius, flags=flags)
+
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * band + 1, 2 * band + 1))
+    for level_img, level_mask in reversed(pyramid):
+        height, width = level_mask.shape[:2]
+        upsampled = cv2.resize(result, (width, height), interpolation=cv2.INTER_LINEAR)
+        result = level_img.copy()
+        np.copyto(result, upsampled, where=(level_mask > 0)[..., None])
+
+        # 只重新修复遮罩边界附近的一圈（按区域裁剪），内部保留放大的粗层结果
+        edge_band = cv2.subtract(level_mask, cv2.erode(level_mask, kernel))
+        _inpaint_regions(result, edge_band, radius,
+                         lambda crop, crop_mask: cv2.inpaint(crop, crop_mask, inpaintRadius=radius, flags=flags))
+
+    return result
+
+
+def run_inpaint(img: np.ndarray, mask: np.ndarray, radius: int = 5,
+                flags: int = cv2.INPAINT_TELEA, engine: str = 'telea') -> np.ndarray:
+    """按所选引擎修复，返回修复后的新数组"""
+    if engine not in INPAINT_ENGINES:
+        raise ValueError('未知的修复引擎')
+    with stage_timer('inpaint'):
+        if engine == 'pyramid':
+            return inpaint_pyramid(img, mask, radius, flags)
+        return cv2.inpaint(img, mask, inpaintRadius=radius, flags=flags)
+
+
+def inpaint_rect(img: np.ndarray, x: int, y: int, width: int, height: int,
+                 radius: int = 5, flags: int = cv2.INPAINT_TELEA, engine: str = 'telea') -> np.ndarray:
+    """
+    修复矩形区域（直接修改 img 并返回）
+    只在矩形外扩 roi_padding 的裁剪区域内运行 inpaint，不分配整幅遮罩
+    """
+    img_height, img_width = img.shape[:2]
+    left, top = max(0, x), max(0, y)
+    right, bottom = min(img_width, x + width), min(img_height, y + height)
+    if left >= right or top >= bottom:
+        return img
+
+    pad = roi_padding(radius)
+    x0, y0 = max(0, left - pad), max(0, top - pad)
+    x1, y1 = min(img_width, right + pad), min(img_height, bottom + pad)
+
+    crop = img[y0:y1, x0:x1]
+    mask = np.zeros(crop.shape[:2], dtype=np.uint8)
+    mask[top - y0:bottom - y0, left - x0:right - x0] = 255
+
+    crop[:] = run_inpaint(crop, mask, radius, flags, engine)
+    return img
+
+
+def mask_regions(mask: np.ndarray, pad: int) -> tuple:
+    """
+    把遮罩按外扩 pad 后的连通区域分组
+    返回 (区域数, 标签图, 统计信息)，第 0 个区域为背景；
+    不同区域的遮罩像素相距超过 2 * pad，可以各自独立修复
+    """
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (2 * pad + 1, 2 * pad + 1))
+    grown = cv2.dilate(mask, kernel)
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(grown, connectivity=8)
+    return count, labels, stats
+
+
+def inpaint_mask(img: np.ndarray, mask: np.ndarray,
+                 radius: int = 5, flags: int = cv2.INPAINT_TELEA, engine: str = 'telea') -> np.ndarray:
+    """
+    按遮罩修复（直接修改 img 并返回）
+    遮罩按相互独立的区域拆分，每个区域只在其外扩后的包围盒内运行 inpaint，
+    只写回该区域的遮罩像素；engine 见 INPAINT_ENGINES
+    """
+    if not mask.any():
+        return img
+    return _inpaint_regions(img, mask, radius,
+                            lambda crop, crop_mask: run_inpaint(crop, crop_mask, radius, flags, engine))
+
+
+def _inpaint_regions(img: np.ndarray, mask: np.ndarray, radius: int, inpaint) -> np.ndarray:
+    """按相互独立的区域逐个调用 inpaint(裁剪图, 裁剪遮罩)，只写回遮罩像素（直接修改 img 并返回）"""
+    count, labels, stats = mask_regions(mask, roi_padding(radius))
+
+    for label in range(1, count):
+        x, y, w, h = stats[label, :4]
+        crop = img[y:y + h, x:x + w]
+        crop_mask = mask[y:y + h, x:x + w]
+        if count > 2:
+            # 包围盒内可能有其他区域的像素，只修复本区域
+            crop_mask = np.where(labels[y:y + h, x:x + w] == label, crop_mask, 0).astype(np.uint8)
+
+        result = inpaint(crop, crop_mask)
+        selected = crop_mask > 0
+        crop[selected] = result[selected]
+
+    return img
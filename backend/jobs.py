@@ -0,0 +1,233 @@
+# 异步任务：本地线程池 + 磁盘状态（无需外部消息队列）
+import json
+import logging
+import os
+import queue
+import re
+import shutil
+import threading
+import time
+import uuid
+
+from backend.admission import memory_budget
+from backend.batch import iter_zip, process_batch
+
+
+# 任务状态与结果的存放目录（多进程共享，任意进程都能查询状态、下载结果）
+JOB_DIR = os.environ.get(
+    'JOB_DIR',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'uploads', 'jobs')
+)
+
+# 同时执行的任务数（每个任务内的图片再交给批量处理进程池并行）
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+
+# 排队等待的任务数上限，超过后拒绝提交
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 16))
+
+# 已结束任务的保留时间（秒），过期后删除状态与结果
+JOB_TTL = int(os.environ.get('JOB_TTL', 3600))
+
+# 执行中写回进度的最小间隔（秒）
+STATUS_INTERVAL = 0.5
+
+logger = logging.getLogger(__name__)
+
+_JOB_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+class QueueFull(Exception):
+    """任务队列已满"""
+
+
+def _job_dir(job_id: str) -> str:
+    return os.path.join(JOB_DIR, job_id)
+
+
+def _write_json(path: str, data: dict):
+    """原子写入 JSON，读取方不会看到写了一半的文件"""
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+class Job:
+    """
+    一个异步任务：按顺序处理若干图片，结果写入任务目录
+    archive=True 时结果为 ZIP（失败信息写入 errors.txt），否则为单张图片
+    memory 为估计的峰值内存（字节），开始处理前在进程内存预算中排队预留；
+    finalize(tasks) 在预留内存后补全任务（如估计共享遮罩），返回最终的 tasks
+    """
+
+    def __init__(self, names: list, tasks: list, output_names: list,
+                 download_name: str, mimetype: str, archive: bool, workers: int,
+                 memory: int = 0, finalize=None):
+        self.id = uuid.uuid4().hex
+        self.tasks = tasks
+        self.memory = memory
+        self.finalize = finalize
+        self.output_names = output_names
+        self.workers = workers
+        self.archive = archive
+        self.status = {
+            'job_id': self.id,
+            'status': 'queued',
+            'total': len(tasks),
+            'completed': 0,
+            'failed': 0,
+            'images': [{'name': name, 'status': 'pending'} for name in names],
+            'error': None,
+            'download_name': download_name,
+            'mimetype': mimetype,
+            'created_at': time.time(),
+            'finished_at': None,
+        }
+        self._saved_at = 0.0
+
+    def save(self, force: bool = True):
+        """写回任务状态（执行中按 STATUS_INTERVAL 节流）"""
+        now = time.time()
+        if force or now - self._saved_at >= STATUS_INTERVAL:
+            _write_json(os.path.join(_job_dir(self.id), 'status.json'), self.status)
+            self._saved_at = now
+
+    def _results(self):
+        """逐张处理并更新进度，按顺序产出 (序号, 是否成功, 结果)"""
+        results = process_batch(self.tasks, self.workers)
+        for index, (ok, result) in enumerate(results):
+            image = self.status['images'][index]
+            if ok:
+                image['status'] = 'done'
+                self.status['completed'] += 1
+            else:
+                image['status'] = 'failed'
+                image['error'] = result
+                self.status['failed'] += 1
+            self.save(force=False)
+            yield index, ok, result
+
+    def _entries(self):
+        """ZIP 条目：成功的图片按顺序写入，失败信息汇总写入 errors.txt"""
+        errors = []
+        for index, ok, result in self._results():
+            if ok:
+                yield self.output_names[index], result
+            else:
+                errors.append(f"{self.status['images'][index]['name']}: {result}")
+        if errors:
+            yield 'errors.txt', '\n'.join(errors) + '\n'
+
+    def run(self):
+        """执行任务：任何异常（含写入状态、预留内存）都记为任务失败，不向外抛出"""
+        result_path = os.path.join(_job_dir(self.id), 'result')
+        tmp_path = result_path + '.tmp'
+        try:
+            # 与同步请求共用内存预算：预算不足时保持 queued 状态等待，不拒绝
+            with memory_budget.reserve(self.memory, wait=True):
+                self.status['status'] = 'running'
+                self.save()
+                with open(tmp_path, 'wb') as f:
+                    if self.finalize is not None:
+                        self.tasks = self.finalize(self.tasks)
+                    if self.archive:
+                        for chunk in iter_zip(self._entries()):
+                            f.write(chunk)
+                    else:
+                        for _, ok, result in self._results():
+                            if not ok:
+                                raise RuntimeError(result)
+                            f.write(result)
+                os.replace(tmp_path, result_path)
+            self.status['status'] = 'done'
+        except Exception as e:
+            logger.exception('任务 %s 执行失败', self.id)
+            self.status['status'] = 'failed'
+            self.status['error'] = str(e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        finally:
+            # 释放上传的图片数据
+            self.tasks = None
+            self.finalize = None
+            self.status['finished_at'] = time.time()
+            try:
+                self.save()
+            except OSError:
+                logger.exception('任务 %s 状态写入失败', self.id)
+
+
+def _worker():
+    """任务执行线程：单个任务出错只记录日志，线程继续处理后续任务"""
+    while True:
+        job = _queue.get()
+        try:
+            job.run()
+        except Exception:
+            logger.exception('任务 %s 执行出错', job.id)
+        finally:
+            _queue.task_done()
+
+
+def _get_queue() -> queue.Queue:
+    """获取任务队列，首次使用时启动工作线程"""
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+            for _ in range(JOB_WORKERS):
+                threading.Thread(target=_worker, daemon=True).start()
+        return _queue
+
+
+def purge_expired():
+    """删除过期的已结束任务"""
+    if not os.path.isdir(JOB_DIR):
+        return
+    now = time.time()
+    for job_id in os.listdir(JOB_DIR):
+        status = get_status(job_id)
+        if status and status['finished_at'] and now - status['finished_at'] > JOB_TTL:
+            shutil.rmtree(_job_dir(job_id), ignore_errors=True)
+
+
+def submit(names: list, tasks: list, output_names: list, download_name: str,
+           mimetype: str, archive: bool = True, workers: int = None, memory: int = 0,
+           finalize=None) -> str:
+    """
+    提交任务，返回任务 ID
+    tasks 与 process_batch 相同，memory 与 finalize 见 Job；队列已满时抛出 QueueFull
+    """
+    job_queue = _get_queue()
+    purge_expired()
+
+    job = Job(names, tasks, output_names, download_name, mimetype, archive, workers, memory, finalize)
+    os.makedirs(_job_dir(job.id), exist_ok=True)
+    job.save()
+    try:
+        job_queue.put_nowait(job)
+    except queue.Full:
+        shutil.rmtree(_job_dir(job.id), ignore_errors=True)
+        raise QueueFull('任务队列已满，请稍后重试')
+    return job.id
+
+
+def get_status(job_id: str):
+    """读取任务状态，任务不存在时返回 None"""
+    if not _JOB_ID_RE.match(job_id):
+        return None
+    try:
+        with open(os.path.join(_job_dir(job_id), 'status.json'), encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def result_path(job_id: str) -> str:
+    """任务结果文件路径（调用前需确认任务已完成）"""
+    return os.path.join(_job_dir(job_id), 'result')
@@ -0,0 +1,209 @@
+# 处理耗时统计：分阶段计时、Prometheus 文本格式导出与 Server-Timing 响应头
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# 耗时直方图的桶上限（秒）
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# 图片像素数直方图的桶上限（百万像素）
+MEGAPIXEL_BUCKETS = (0.5, 1, 2, 4, 8, 12, 16, 24, 36, 50, 100)
+
+_registry = []
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Counter:
+    """单调递增计数器（按标签分组）"""
+
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(self.name, _format_labels(self.label_names, key), value)
+                    for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """累积桶直方图（按标签分组），导出 _bucket/_sum/_count"""
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple = (),
+                 buckets: tuple = SECONDS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = labels
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels.get(name, '') for name in self.label_names)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts = entry[0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self) -> list:
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.label_names, key, f'le="{_format_value(bound)}"')
+                    samples.append((f'{self.name}_bucket', labels, cumulative))
+                labels = _format_labels(self.label_names, key)
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, count))
+        return samples
+
+
+def render() -> str:
+    """全部指标的 Prometheus 文本格式（当前进程）"""
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{labels} {_format_value(value)}')
+    return '\n'.join(lines) + '\n'
+
+
+STAGE_SECONDS = Histogram(
+    'watermark_stage_seconds', '各处理阶段耗时（秒，每个请求按阶段累计）',
+    ('endpoint', 'method', 'stage'))
+REQUEST_SECONDS = Histogram(
+    'watermark_request_seconds', '请求总耗时（秒）', ('endpoint', 'method'))
+REQUESTS = Counter(
+    'watermark_requests_total', '请求数', ('endpoint', 'method', 'status'))
+BYTES_IN = Counter(
+    'watermark_bytes_in_total', '请求体字节数', ('endpoint', 'method'))
+BYTES_OUT = Counter(
+    'watermark_bytes_out_total', '响应体字节数（流式响应不计）', ('endpoint', 'method'))
+IMAGE_MEGAPIXELS = Histogram(
+    'watermark_image_megapixels', '处理的图片像素数（百万像素）', ('endpoint', 'method'),
+    buckets=MEGAPIXEL_BUCKETS)
+ADMISSION_REJECTED = Counter(
+    'watermark_admission_rejected_total', '准入控制拒绝的请求数（pixels：像素数超限，memory：所需内存超过预算，'
+    'busy：预算已满且排队超时）', ('reason',))
+
+
+class RequestTimings:
+    """一个请求内各阶段的累计耗时与处理的图片"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = OrderedDict()
+        self.megapixels = []
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """Server-Timing 响应头（毫秒）"""
+        entries = [f'{stage};dur={seconds * 1000:.1f}' for stage, seconds in self.stages.items()]
+        entries.append(f'total;dur={self.elapsed() * 1000:.1f}')
+        return ', '.join(entries)
+
+
+_current = ContextVar('request_timings', default=None)
+
+
+def begin_request() -> RequestTimings:
+    """开始记录当前请求（线程内）的分阶段耗时"""
+    timings = RequestTimings()
+    _current.set(timings)
+    return timings
+
+
+def end_request(endpoint: str, method: str, status: int,
+                bytes_in: int = None, bytes_out: int = None):
+    """结束当前请求：按请求汇总写入各指标，返回 RequestTimings（未开始记录时返回 None）"""
+    timings = _current.get()
+    if timings is None:
+        return None
+    _current.set(None)
+
+    labels = {'endpoint': endpoint, 'method': method}
+    for stage, seconds in timings.stages.items():
+        STAGE_SECONDS.observe(seconds, stage=stage, **labels)
+    for megapixels in timings.megapixels:
+        IMAGE_MEGAPIXELS.observe(megapixels, **labels)
+    REQUEST_SECONDS.observe(timings.elapsed(), **labels)
+    REQUESTS.inc(status=str(status), **labels)
+    if bytes_in:
+        BYTES_IN.inc(bytes_in, **labels)
+    if bytes_out:
+        BYTES_OUT.inc(bytes_out, **labels)
+    return timings
+
+
+@contextmanager
+def stage_timer(stage: str):
+    """
+    计时一个处理阶段
+    在请求内累计到该请求（请求结束时每个阶段记录一次），
+    请求之外（异步任务线程等）直接记入直方图
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = _current.get()
+        if timings is not None:
+            timings.add(stage, elapsed)
+        else:
+            STAGE_SECONDS.observe(elapsed, stage=stage)
+
+
+def observe_image(height: int, width: int):
+    """记录处理的图片尺寸（请求内）"""
+    timings = _current.get()
+    if timings is not None:
+        timings.megapixels.append(height * width / 1e6)
@@ -0,0 +1,99 @@
+# 实时预览：在缓存的缩小代理图上运行处理阶段，按延迟预算调整代理尺寸
+import math
+import os
+import threading
+import time
+import weakref
+
+import cv2
+
+from backend.watermark_remover import encode_image
+
+
+# 代理图长边的上限与下限（像素）
+PREVIEW_MAX_SIDE = int(os.environ.get('PREVIEW_MAX_SIDE', 1024))
+PREVIEW_MIN_SIDE = 256
+
+# 单次预览的目标耗时（毫秒），超出后缩小代理图，远低于时逐步放大
+PREVIEW_BUDGET_MS = int(os.environ.get('PREVIEW_BUDGET_MS', 250))
+
+# 预览 JPEG 质量
+PREVIEW_QUALITY = 80
+
+# 代理图长边按此粒度取整，避免耗时抖动导致反复重建代理图
+SIDE_STEP = 64
+
+# 会话图片 -> {'side': 目标长边, 'proxy': (长边, 代理图, 缩放比例)}
+# 会话图片过期释放后对应代理图随之释放
+_proxies = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def proxy_scale(height: int, width: int, side: int) -> float:
+    """长边缩放到 side 的比例（不放大）"""
+    return min(1.0, side / max(height, width))
+
+
+def _build_proxy(array, side: int) -> tuple:
+    """按目标长边缩小（INTER_AREA），返回 (代理图, 实际缩放比例)"""
+    height, width = array.shape[:2]
+    scale = proxy_scale(height, width, side)
+    if scale >= 1.0:
+        return array, 1.0
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    proxy = cv2.resize(array, size, interpolation=cv2.INTER_AREA)
+    # 以实际缩放后的宽度为准，坐标映射与代理图尺寸一致
+    return proxy, size[0] / width
+
+
+def get_proxy(image) -> tuple:
+    """取会话图片的代理图，返回 (代理图, 缩放比例)；代理图只读，处理前需复制"""
+    with _lock:
+        entry = _proxies.setdefault(image, {'side': PREVIEW_MAX_SIDE, 'proxy': None})
+        side = entry['side']
+        cached = entry['proxy']
+    if cached is not None and cached[0] == side:
+        return cached[1], cached[2]
+
+    proxy, scale = _build_proxy(image.array, side)
+    with _lock:
+        entry['proxy'] = (side, proxy, scale)
+    return proxy, scale
+
+
+def _adjust_side(image, elapsed_ms: float):
+    """按本次耗时调整下次预览的代理尺寸（耗时约与像素数成正比）"""
+    with _lock:
+        entry = _proxies.get(image)
+        if entry is None:
+            return
+        side = entry['side']
+        if elapsed_ms > PREVIEW_BUDGET_MS:
+            side = side * math.sqrt(PREVIEW_BUDGET_MS / elapsed_ms)
+        elif elapsed_ms < PREVIEW_BUDGET_MS / 2:
+            side = side * 1.25
+        else:
+            return
+        side = int(side) // SIDE_STEP * SIDE_STEP
+        entry['side'] = max(PREVIEW_MIN_SIDE, min(PREVIEW_MAX_SIDE, side))
+
+
+def render_preview(image, build_stages) -> tuple:
+    """
+    在代理图上渲染预览
+    image 为 DecodedImage；build_stages(scale) 按代理图缩放比例构造处理阶段
+    （坐标、字号、边距等像素参数由调用方按 scale 映射）
+    返回 (JPEG 字节, 缩放比例, 处理耗时毫秒)
+    """
+    proxy, scale = get_proxy(image)
+
+    # 代理图只在尺寸变化时重建，不计入处理耗时
+    start = time.perf_counter()
+    img = proxy.copy()
+    for stage in build_stages(scale):
+        img = stage(img)
+    result = encode_image(img, 'jpeg', PREVIEW_QUALITY)
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    _adjust_side(image, elapsed_ms)
+    return result, scale, elapsed_ms
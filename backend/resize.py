@@ -0,0 +1,112 @@
+# 分辨率调整：按比例或目标尺寸缩小，JPEG 在解码时按 DCT 缩放直接得到小图
+import io
+
+import cv2
+from PIL import Image, UnidentifiedImageError
+
+from backend.metrics import stage_timer
+
+
+# JPEG 解码时可用的缩小倍数（libjpeg DCT 域缩放）及对应的 imdecode 标志
+REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# EXIF 方向为这些值时图片需旋转 90°，解码后宽高互换
+TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+def header_info(image):
+    """
+    只读文件头取图片格式与尺寸，返回 (格式, 宽, 高)，无法识别时返回 None
+    image 为图片字节或文件路径（路径只读取文件头，不读入整个文件）；
+    尺寸按 EXIF 方向校正，与 decode_image 解码后的尺寸一致
+    """
+    try:
+        with Image.open(io.BytesIO(image) if isinstance(image, bytes) else image) as img:
+            width, height = img.size
+            fmt = img.format
+            orientation = img.getexif().get(0x0112) if fmt == 'JPEG' else None
+    except (UnidentifiedImageError, OSError):
+        return None
+    if orientation in TRANSPOSED_ORIENTATIONS:
+        width, height = height, width
+    return fmt, width, height
+
+
+def image_size(image):
+    """输入图片（字节、文件路径或已解码图片）的 (宽, 高)，无法识别时返回 None"""
+    shape = getattr(image, 'shape', None)
+    if shape is not None:
+        return shape[1], shape[0]
+    info = header_info(image)
+    return info[1:] if info else None
+
+
+class Resize:
+    """
+    缩小图片的处理阶段（只缩小，不放大）
+    scale 为缩放比例 (0, 1]，width/height 为最大宽高，同时指定时取最小的比例（保持宽高比）；
+    放在流水线第一个阶段时，run_pipeline 对 JPEG 按 DCT 缩放解码，不再分配原尺寸的整图
+    """
+
+    def __init__(self, scale: float = None, width: int = None, height: int = None):
+        if scale is None and width is None and height is None:
+            raise ValueError('请指定缩放比例或目标尺寸')
+        if scale is not None and not 0 < scale <= 1:
+            raise ValueError('缩放比例需在 0 到 1 之间')
+        if (width is not None and width < 1) or (height is not None and height < 1):
+            raise ValueError('目标尺寸需为正整数')
+        self.scale = scale
+        self.width = width
+        self.height = height
+        self.key = f'resize({scale},{width},{height})'
+
+    def target_size(self, width: int, height: int) -> tuple:
+        """原尺寸缩小后的 (宽, 高)"""
+        factor = 1.0
+        if self.scale is not None:
+            factor = self.scale
+        if self.width is not None:
+            factor = min(factor, self.width / width)
+        if self.height is not None:
+            factor = min(factor, self.height / height)
+        if factor >= 1.0:
+            return width, height
+        return max(1, round(width * factor)), max(1, round(height * factor))
+
+    def factor(self, width: int, height: int) -> float:
+        """实际缩放比例（以缩小后的宽度为准，与坐标映射一致）"""
+        return self.target_size(width, height)[0] / width
+
+    def decode_plan(self, image_bytes: bytes) -> tuple:
+        """
+        按文件头确定解码方式，返回 (imdecode 标志, 缩小后的 (宽, 高))，无法读取文件头时尺寸为 None
+        JPEG 取缩小后仍不小于目标尺寸的最大 DCT 缩放倍数，其余格式按原尺寸解码
+        """
+        info = header_info(image_bytes)
+        if info is None:
+            return cv2.IMREAD_COLOR, None
+        fmt, width, height = info
+        size = self.target_size(width, height)
+        if fmt == 'JPEG':
+            for reduction, flags in REDUCED_FLAGS:
+                # libjpeg 缩放后的尺寸向上取整
+                if -(-width // reduction) >= size[0] and -(-height // reduction) >= size[1]:
+                    return flags, size
+        return cv2.IMREAD_COLOR, size
+
+    def __call__(self, img):
+        height, width = img.shape[:2]
+        return resize_to(img, self.target_size(width, height))
+
+
+def resize_to(img, size: tuple):
+    """缩小到 size=(宽, 高)（INTER_AREA），尺寸不变时原样返回"""
+    height, width = img.shape[:2]
+    if size == (width, height):
+        return img
+    with stage_timer('resize'):
+        return cv2.resize(img, size, interpolation=cv2.INTER_AREA)
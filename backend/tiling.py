@@ -0,0 +1,146 @@
+# 分块（有界内存）处理
+import math
+import os
+
+import numpy as np
+
+from backend.cache import stage_key
+from backend.metrics import stage_timer
+
+
+# 分块处理的工作内存预算（MB），不含解码后的整幅图片本身
+TILE_MEMORY_BUDGET = int(os.environ.get('TILE_MEMORY_BUDGET', 512))
+
+# 处理阶段每个像素的峰值工作内存估计（字节）：
+# 分块副本、灰度/遮罩、形态学临时图、int32 标签图、inpaint 中间结果、PIL RGBA 图层
+TILE_BYTES_PER_PIXEL = 32
+
+# 相邻分块的重叠宽度（像素），需覆盖检测/修复的影响范围与单个水印笔画的尺寸
+TILE_OVERLAP = 128
+
+
+def tile_size(budget_mb: int = None, overlap: int = TILE_OVERLAP) -> int:
+    """按内存预算计算分块边长（含重叠）"""
+    budget = (budget_mb or TILE_MEMORY_BUDGET) * 1024 * 1024
+    return max(4 * overlap, int(math.sqrt(budget / TILE_BYTES_PER_PIXEL)))
+
+
+def tile_starts(length: int, size: int, overlap: int) -> list:
+    """一个方向上各分块的起点，相邻分块重叠 overlap 像素，最后一块对齐末端"""
+    if length <= size:
+        return [0]
+    step = size - overlap
+    starts = list(range(0, length - size, step))
+    starts.append(length - size)
+    return starts
+
+
+def _ramp(length: int) -> np.ndarray:
+    """重叠区的线性过渡权重（新分块所占比例从 0 到 1）"""
+    return ((np.arange(length, dtype=np.float32) + 0.5) / length)
+
+
+def _blend_into(dst: np.ndarray, src: np.ndarray, weight: np.ndarray):
+    """dst = dst * (1 - weight) + src * weight（原地）"""
+    dst[:] = (dst * (1 - weight) + src * weight + 0.5).astype(np.uint8)
+
+
+def run_tiled(img: np.ndarray, stage, size: int = None, overlap: int = TILE_OVERLAP) -> np.ndarray:
+    """
+    按重叠分块执行局部处理阶段（直接修改 img 并返回）
+
+    每个分块都以原始像素作为输入（重叠区的原始像素在写回前保存），处理后
+    在重叠区内与已写回的相邻分块线性过渡，消除接缝。同一时刻只有一个分块的
+    工作内存，峰值与分块大小相关，与整图大小无关。
+    """
+    size = size or tile_size(overlap=overlap)
+    img_height, img_width = img.shape[:2]
+    if img_height <= size and img_width <= size:
+        return stage(img)
+
+    ys = tile_starts(img_height, size, overlap)
+    xs = tile_starts(img_width, size, overlap)
+
+    # 与上一行分块重叠的原始像素（下一行分块的顶部输入）
+    top_source = None
+    for i, y0 in enumerate(ys):
+        y1 = min(img_height, y0 + size)
+        overlap_top = ys[i - 1] + size - y0 if i > 0 else 0
+        next_y0 = ys[i + 1] if i + 1 < len(ys) else y1
+        next_top = np.empty((y1 - next_y0, img_width) + img.shape[2:], img.dtype)
+
+        left_source = None
+        for j, x0 in enumerate(xs):
+            x1 = min(img_width, x0 + size)
+            overlap_left = xs[j - 1] + size - x0 if j > 0 else 0
+            next_x0 = xs[j + 1] if j + 1 < len(xs) else x1
+
+            # 还原已被相邻分块覆盖的原始像素，并保存后续分块需要的原始像素
+            tile = img[y0:y1, x0:x1].copy()
+            if overlap_top:
+                tile[:overlap_top] = top_source[:, x0:x1]
+            if overlap_left:
+                tile[:, :overlap_left] = left_source
+            left_source = tile[:, next_x0 - x0:].copy()
+            next_top[:, x0:x1] = tile[next_y0 - y0:]
+
+            result = stage(tile)
+
+            # 重叠区与已写回的结果线性过渡，其余直接写回
+            target = img[y0:y1, x0:x1]
+            if overlap_top:
+                weight_y = _ramp(overlap_top)[:, None, None]
+                _blend_into(target[:overlap_top, overlap_left:],
+                            result[:overlap_top, overlap_left:], weight_y)
+            if overlap_left:
+                weight_x = _ramp(overlap_left)[None, :, None]
+                _blend_into(target[overlap_top:, :overlap_left],
+                            result[overlap_top:, :overlap_left], weight_x)
+            if overlap_top and overlap_left:
+                _blend_into(target[:overlap_top, :overlap_left],
+                            result[:overlap_top, :overlap_left], weight_y * weight_x)
+            target[overlap_top:, overlap_left:] = result[overlap_top:, overlap_left:]
+
+        top_source = next_top
+
+    return img
+
+
+def run_windowed(img: np.ndarray, watermark, size: int = None) -> np.ndarray:
+    """
+    按不重叠的窗口合成水印（直接修改 img 并返回）
+    水印合成逐像素进行，各窗口结果与整图合成完全一致，无需过渡
+    """
+    size = size or tile_size()
+    img_height, img_width = img.shape[:2]
+    with stage_timer('composite'):
+        for y0 in range(0, img_height, size):
+            for x0 in range(0, img_width, size):
+                window = img[y0:y0 + size, x0:x0 + size]
+                watermark.apply_window(window, x0, y0, img_width, img_height)
+    return img
+
+
+class TiledStage:
+    """
+    分块执行的处理阶段：图片不超过一个分块时直接执行，结果与原阶段一致
+    预编译水印（带 apply_window）按窗口合成，其余阶段按重叠分块执行局部处理
+    """
+
+    def __init__(self, stage, budget_mb: int = None):
+        self.stage = stage
+        self.budget_mb = budget_mb
+
+    @property
+    def key(self):
+        """缓存键：分块大小影响分块处理的结果，一并计入"""
+        inner = stage_key(self.stage)
+        if inner is None:
+            return None
+        return f'tiled[{tile_size(self.budget_mb)}]:{inner}'
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        size = tile_size(self.budget_mb)
+        if hasattr(self.stage, 'apply_window'):
+            return run_windowed(img, self.stage, size)
+        return run_tiled(img, self.stage, size)
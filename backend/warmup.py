@@ -0,0 +1,49 @@
+# 服务启动预热：导入重依赖、加载默认字体，并在小图上走一遍各热路径
+import cv2
+import numpy as np
+
+from backend.fonts import get_font
+from backend.watermark_remover import (
+    QRCodeWatermark,
+    TextWatermark,
+    decode_image,
+    encode_image,
+    remove_watermark_auto_array,
+    remove_watermark_color_array,
+    remove_watermark_frequency_array,
+    remove_watermark_region_array,
+)
+
+
+# 预加载的默认字体字号（前端文字/日期时间水印的默认值与常用值）
+WARMUP_FONT_SIZES = (24, 36, 48, 72)
+
+# 预热图片尺寸
+WARMUP_SIZE = (320, 240)
+
+
+def warm_up():
+    """
+    在小图上执行一遍解码、各去水印方式、文字/二维码水印与各格式编码
+    OpenCV/Pillow 的延迟初始化、字体加载与二维码库的首次调用都在这里完成，
+    首个请求不再承担这些开销；在预派生（preload）模式下由主进程执行一次，工作进程直接继承
+    """
+    for size in WARMUP_FONT_SIZES:
+        get_font(size)
+
+    width, height = WARMUP_SIZE
+    img = np.full((height, width, 3), 80, np.uint8)
+    cv2.putText(img, 'WARMUP', (20, height // 2), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 3)
+    image_bytes = encode_image(img, 'png')
+
+    for stage in (remove_watermark_auto_array,
+                  remove_watermark_color_array,
+                  remove_watermark_frequency_array,
+                  lambda arr: remove_watermark_region_array(arr, 20, 20, 60, 30),
+                  TextWatermark('warm-up', position='tile', rotation=30),
+                  TextWatermark('warm-up'),
+                  QRCodeWatermark('warm-up')):
+        stage(decode_image(image_bytes))
+
+    for output_format in ('png', 'jpeg', 'webp'):
+        encode_image(img, output_format, 90)
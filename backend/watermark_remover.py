@@ -1,174 +1,360 @@
 import cv2
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, UnidentifiedImageError
+import hashlib
 import io
-import os
 import qrcode
+from collections import OrderedDict
 from datetime import datetime
 
+from backend.animation import ANIMATED_FORMATS, animated_format, encode_gif, run_animation
+from backend.cache import cached_call, pipeline_key, result_cache
+from backend.compositing import composite_sprite, composite_tiled, fold_cells, pil_to_bgra, premultiply
+from backend.detect import candidate_regions
+from backend.fonts import get_font
+from backend.frequency import frequency_filter
+from backend.inpaint import inpaint_mask, inpaint_rect, roi_padding
+from backend.metrics import observe_image, stage_timer
+from backend.resize import Resize, resize_to
 
-def remove_watermark_inpaint(image_bytes: bytes, mask_bytes: bytes) -> bytes:
+
+def decode_image(image_bytes: bytes, flags: int = cv2.IMREAD_COLOR) -> np.ndarray:
+    """
+    将图片字节解码为 BGR 数组（流水线只解码一次）
+    flags 可为 IMREAD_REDUCED_COLOR_*（JPEG 按 DCT 缩放解码，见 Resize）
+    OpenCV 无法解码的格式回退到 PIL（按原尺寸）
+    """
+    with stage_timer('decode'):
+        nparr = np.frombuffer(image_bytes, np.uint8)
+        img = cv2.imdecode(nparr, flags)
+        if img is None:
+            try:
+                pil_img = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+            except UnidentifiedImageError:
+                raise ValueError('无法识别的图片格式')
+            img = cv2.cvtColor(np.asarray(pil_img), cv2.COLOR_RGB2BGR)
+    return img
+
+
+class DecodedImage:
+    """
+    已解码的图片及其原始内容哈希（结果缓存按原始内容寻址）
+    可作为 run_pipeline 的输入重复使用，每次处理都在副本上进行；
+    动图只解码第一帧（供预览），source 保留原始字节，完整处理时按动图逐帧处理
+    """
+
+    def __init__(self, array: np.ndarray, digest: str, source: bytes = None):
+        self.array = array
+        self.digest = digest
+        self.source = source
+
+    @classmethod
+    def from_bytes(cls, image_bytes: bytes):
+        source = image_bytes if animated_format(image_bytes) else None
+        return cls(decode_image(image_bytes), hashlib.sha1(image_bytes).hexdigest(), source)
+
+    @property
+    def nbytes(self) -> int:
+        return self.array.nbytes + (len(self.source) if self.source is not None else 0)
+
+    @property
+    def shape(self) -> tuple:
+        return self.array.shape
+
+
+def load_image(image, resize: Resize = None) -> np.ndarray:
+    """
+    流水线输入转为可原地修改的 BGR 数组：图片字节解码，已解码图片复制一份
+    指定 resize 时同时缩小：JPEG 直接按 DCT 缩放解码，再缩小到目标尺寸
+    """
+    if isinstance(image, DecodedImage):
+        if resize is None:
+            return image.array.copy()
+        img = resize(image.array)
+        return img.copy() if img is image.array else img
+    if resize is None:
+        return decode_image(image)
+
+    flags, size = resize.decode_plan(image)
+    img = decode_image(image, flags)
+    return resize_to(img, size) if size is not None else resize(img)
+
+
+def encode_image(img: np.ndarray, output_format: str = 'png', quality: int = 95) -> bytes:
+    """
+    将 BGR 数组按目标格式编码（流水线只编码一次）
+    quality 语义与 convert_image_format 一致
+    """
+    output_format = output_format.lower()
+    quality = max(1, min(100, int(quality)))
+
+    if output_format == 'gif':
+        return encode_gif(img)
+    if output_format in ('jpeg', 'jpg'):
+        ext = '.jpg'
+        params = [cv2.IMWRITE_JPEG_QUALITY, quality, cv2.IMWRITE_JPEG_OPTIMIZE, 1]
+    elif output_format == 'webp':
+        ext = '.webp'
+        params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+    else:  # PNG
+        ext = '.png'
+        if quality < 100:
+            # PNG 使用 compress_level (0-9)
+            compress_level = max(0, min(9, int((100 - quality) / 11)))
+        else:
+            compress_level = 6
+        params = [cv2.IMWRITE_PNG_COMPRESSION, compress_level]
+
+    with stage_timer('encode'):
+        ok, buffer = cv2.imencode(ext, img, params)
+    if not ok:
+        raise ValueError(f'图片编码失败: {output_format}')
+    return buffer.tobytes()
+
+
+def encode_png(img: np.ndarray) -> bytes:
+    """按原有行为编码为 PNG（bytes 接口的返回格式）"""
+    with stage_timer('encode'):
+        _, buffer = cv2.imencode('.png', img)
+    return buffer.tobytes()
+
+
+def run_pipeline(image, stages: list,
+                 output_format: str = 'png', quality: int = 95,
+                 use_cache: bool = True) -> bytes:
+    """
+    图片处理流水线
+    解码一次 -> 依次执行各阶段（数组进、数组出）-> 按输出格式编码一次
+    image 为图片字节或 DecodedImage（已解码的会话图片，不再重复解码）
+    stages 中每个元素都是接收 BGR 数组并返回 BGR 数组的可调用对象；
+    第一个阶段为 Resize 时与解码合并，先缩小再执行其余阶段
+    输入为动图且输出格式为 gif/webp 时逐帧处理并输出动图（见 run_animation），否则只处理第一帧
+    结果按 (输入内容哈希, 各阶段参数, 输出格式与质量) 缓存，相同请求不再重复处理
+    """
+    key = pipeline_key(image, stages, output_format, quality) if use_cache else None
+    if key is not None:
+        cached = result_cache.get(key)
+        if cached is not None:
+            return cached
+
+    if output_format.lower() in ANIMATED_FORMATS.values() and animated_format(image):
+        result = run_animation(getattr(image, 'source', image), stages, output_format, quality)
+        if key is not None:
+            result_cache.put(key, result)
+        return result
+
+    resize = None
+    if stages and isinstance(stages[0], Resize):
+        resize, stages = stages[0], stages[1:]
+
+    img = load_image(image, resize)
+    observe_image(*img.shape[:2])
+    for stage in stages:
+        img = stage(img)
+    result = encode_image(img, output_format, quality)
+
+    if key is not None:
+        result_cache.put(key, result)
+    return result
+
+
+def remove_watermark_inpaint_array(img: np.ndarray, mask: np.ndarray,
+                                   inpaint_engine: str = 'telea') -> np.ndarray:
+    """
+    使用 OpenCV inpaint 方法去除水印（数组接口，直接修改 img 并返回）
+    mask 为单通道遮罩；inpaint_engine 为修复引擎（telea 或 pyramid，大面积遮罩用 pyramid 更快）
+    """
+    # 确保遮罩尺寸与图片一致
+    if mask.shape[:2] != img.shape[:2]:
+        mask = cv2.resize(mask, (img.shape[1], img.shape[0]))
+
+    # 只在遮罩所在区域内修复
+    return inpaint_mask(img, mask, radius=3, engine=inpaint_engine)
+
+
+@cached_call
+def remove_watermark_inpaint(image_bytes: bytes, mask_bytes: bytes,
+                             inpaint_engine: str = 'telea') -> bytes:
     """
     使用 OpenCV inpaint 方法去除水印
     用户需要提供水印区域的遮罩
     """
     # 读取原图
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    img = decode_image(image_bytes)
 
     # 读取遮罩
     mask_arr = np.frombuffer(mask_bytes, np.uint8)
     mask = cv2.imdecode(mask_arr, cv2.IMREAD_GRAYSCALE)
 
-    # 确保遮罩尺寸与图片一致
-    if mask.shape[:2] != img.shape[:2]:
-        mask = cv2.resize(mask, (img.shape[1], img.shape[0]))
+    # 编码为 PNG
+    return encode_png(remove_watermark_inpaint_array(img, mask, inpaint_engine))
 
-    # 使用 inpaint 去除水印
-    result = cv2.inpaint(img, mask, inpaintRadius=3, flags=cv2.INPAINT_TELEA)
 
-    # 编码为 PNG
-    _, buffer = cv2.imencode('.png', result)
-    return buffer.tobytes()
+def auto_pixel_mask(img: np.ndarray, threshold: int = 200) -> np.ndarray:
+    """自动检测的逐像素遮罩：灰度高于阈值的浅色像素"""
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    _, mask = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)
+    return mask
+
+
+def refine_auto_mask(roi: np.ndarray, min_area: int = 100, max_area: int = 50000):
+    """
+    清理一个候选区域的遮罩：闭/开运算去噪，按连通域面积过滤，膨胀覆盖水印边缘
+    没有合适大小的区域时返回 None
+    """
+    kernel = np.ones((3, 3), np.uint8)
+    roi = cv2.morphologyEx(roi, cv2.MORPH_CLOSE, kernel)
+    roi = cv2.morphologyEx(roi, cv2.MORPH_OPEN, kernel)
+
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(roi, connectivity=8)
+    areas = stats[1:, cv2.CC_STAT_AREA]
+    keep = (areas > min_area) & (areas < max_area)
+    if not keep.any():
+        return None
+    lut = np.zeros(count, np.uint8)
+    lut[1:][keep] = 255
+    return cv2.dilate(lut[labels], kernel, iterations=2)
+
+
+def inpaint_roi(img: np.ndarray, x0: int, y0: int, roi_mask: np.ndarray,
+                radius: int = 5, engine: str = 'telea') -> np.ndarray:
+    """按 (x0, y0) 处的局部遮罩修复（直接修改 img 并返回），只在外扩后的窗口内运行"""
+    pad = roi_padding(radius)
+    img_height, img_width = img.shape[:2]
+    y1, x1 = y0 + roi_mask.shape[0], x0 + roi_mask.shape[1]
+    wx0, wy0 = max(0, x0 - pad), max(0, y0 - pad)
+    wx1, wy1 = min(img_width, x1 + pad), min(img_height, y1 + pad)
+    window_mask = np.zeros((wy1 - wy0, wx1 - wx0), np.uint8)
+    window_mask[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0] = roi_mask
+    return inpaint_mask(img[wy0:wy1, wx0:wx1], window_mask, radius=radius, engine=engine)
+
+
+def remove_watermark_auto_array(img: np.ndarray, threshold: int = 200,
+                                min_area: int = 100, max_area: int = 50000,
+                                inpaint_engine: str = 'telea') -> np.ndarray:
+    """
+    自动检测并去除浅色/半透明水印（数组接口，直接修改 img 并返回）
+    适用于白色或浅色的文字水印
+
+    先在缩小图上定位候选区域，再只在候选区域内按全分辨率细化遮罩、
+    用连通域统计过滤，min_area/max_area 为全分辨率像素数
+    """
+    with stage_timer('mask'):
+        # 使用阈值检测浅色区域（可能是水印）
+        mask = auto_pixel_mask(img, threshold)
+        candidates = list(candidate_regions(mask))
 
+    for x0, y0, x1, y1, footprint in candidates:
+        with stage_timer('mask'):
+            # 只处理本候选区域
+            roi = np.where(footprint, mask[y0:y1, x0:x1], 0).astype(np.uint8)
+            roi_mask = refine_auto_mask(roi, min_area, max_area)
+        if roi_mask is None:
+            continue
 
+        # 在外扩后的窗口内修复本候选区域
+        inpaint_roi(img, x0, y0, roi_mask, radius=5, engine=inpaint_engine)
+
+    return img
+
+
+@cached_call
 def remove_watermark_auto(image_bytes: bytes, threshold: int = 200,
-                          min_area: int = 100, max_area: int = 50000) -> bytes:
+                          min_area: int = 100, max_area: int = 50000,
+                          inpaint_engine: str = 'telea') -> bytes:
     """
     自动检测并去除浅色/半透明水印
     适用于白色或浅色的文字水印
     """
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+    img = decode_image(image_bytes)
+    return encode_png(remove_watermark_auto_array(img, threshold, min_area, max_area, inpaint_engine))
 
-    # 转换到灰度图
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
 
-    # 使用自适应阈值检测浅色区域（可能是水印）
-    _, mask = cv2.threshold(gray, threshold, 255, cv2.THRESH_BINARY)
+def color_pixel_mask(img: np.ndarray,
+                     color_lower: tuple = (200, 200, 200),
+                     color_upper: tuple = (255, 255, 255)) -> np.ndarray:
+    """颜色范围的逐像素遮罩（BGR 顺序）"""
+    lower = np.array(color_lower, dtype=np.uint8)
+    upper = np.array(color_upper, dtype=np.uint8)
+    return cv2.inRange(img, lower, upper)
+
 
-    # 形态学操作清理噪点
+def refine_color_mask(mask: np.ndarray) -> np.ndarray:
+    """颜色遮罩的形态学处理：闭运算连接笔画，膨胀覆盖边缘"""
     kernel = np.ones((3, 3), np.uint8)
     mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
-
-    # 找到轮廓并过滤
-    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    # 创建新的遮罩，只保留合适大小的区域
-    final_mask = np.zeros_like(mask)
-    for contour in contours:
-        area = cv2.contourArea(contour)
-        if min_area < area < max_area:
-            cv2.drawContours(final_mask, [contour], -1, 255, -1)
+    return cv2.dilate(mask, kernel, iterations=1)
 
-    # 膨胀遮罩以覆盖水印边缘
-    final_mask = cv2.dilate(final_mask, kernel, iterations=2)
 
-    # 使用 inpaint 去除水印
-    result = cv2.inpaint(img, final_mask, inpaintRadius=5, flags=cv2.INPAINT_TELEA)
+def remove_watermark_color_array(img: np.ndarray,
+                                 color_lower: tuple = (200, 200, 200),
+                                 color_upper: tuple = (255, 255, 255),
+                                 inpaint_engine: str = 'telea') -> np.ndarray:
+    """
+    根据颜色范围去除水印（数组接口，直接修改 img 并返回）
+    颜色范围为 BGR 顺序
+    """
+    with stage_timer('mask'):
+        mask = refine_color_mask(color_pixel_mask(img, color_lower, color_upper))
 
-    _, buffer = cv2.imencode('.png', result)
-    return buffer.tobytes()
+    # 只在遮罩所在区域内修复
+    return inpaint_mask(img, mask, radius=3, engine=inpaint_engine)
 
 
+@cached_call
 def remove_watermark_color(image_bytes: bytes,
                            color_lower: tuple = (200, 200, 200),
-                           color_upper: tuple = (255, 255, 255)) -> bytes:
+                           color_upper: tuple = (255, 255, 255),
+                           inpaint_engine: str = 'telea') -> bytes:
     """
     根据颜色范围去除水印
     适用于特定颜色的水印
     """
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-    # 创建颜色范围遮罩
-    lower = np.array(color_lower, dtype=np.uint8)
-    upper = np.array(color_upper, dtype=np.uint8)
-    mask = cv2.inRange(img, lower, upper)
+    img = decode_image(image_bytes)
+    return encode_png(remove_watermark_color_array(img, color_lower, color_upper, inpaint_engine))
 
-    # 形态学操作
-    kernel = np.ones((3, 3), np.uint8)
-    mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, kernel)
-    mask = cv2.dilate(mask, kernel, iterations=1)
 
-    # 使用 inpaint 去除
-    result = cv2.inpaint(img, mask, inpaintRadius=3, flags=cv2.INPAINT_TELEA)
-
-    _, buffer = cv2.imencode('.png', result)
-    return buffer.tobytes()
+def remove_watermark_region_array(img: np.ndarray,
+                                  x: int, y: int,
+                                  width: int, height: int,
+                                  inpaint_engine: str = 'telea') -> np.ndarray:
+    """
+    去除指定区域的水印（数组接口，直接修改 img 并返回）
+    只修复选区外扩一圈的局部区域，耗时与选区大小相关，与整图大小无关
+    """
+    return inpaint_rect(img, x, y, width, height, radius=5, engine=inpaint_engine)
 
 
+@cached_call
 def remove_watermark_region(image_bytes: bytes,
                             x: int, y: int,
-                            width: int, height: int) -> bytes:
+                            width: int, height: int,
+                            inpaint_engine: str = 'telea') -> bytes:
     """
     去除指定区域的水印
     用户指定矩形区域
     """
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-    # 创建遮罩
-    mask = np.zeros(img.shape[:2], dtype=np.uint8)
-    mask[y:y+height, x:x+width] = 255
+    img = decode_image(image_bytes)
+    return encode_png(remove_watermark_region_array(img, x, y, width, height, inpaint_engine))
 
-    # 使用 inpaint 去除
-    result = cv2.inpaint(img, mask, inpaintRadius=5, flags=cv2.INPAINT_TELEA)
 
-    _, buffer = cv2.imencode('.png', result)
-    return buffer.tobytes()
+def remove_watermark_frequency_array(img: np.ndarray) -> np.ndarray:
+    """
+    使用频域滤波去除重复性水印（数组接口）
+    在频域中心附近（除了中心点）应用衰减，这有助于去除周期性水印
+    """
+    with stage_timer('frequency'):
+        return frequency_filter(img)
 
 
+@cached_call
 def remove_watermark_frequency(image_bytes: bytes) -> bytes:
     """
     使用频域滤波去除重复性水印
     适用于周期性平铺的水印
     """
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
-
-    # 分离通道处理
-    channels = cv2.split(img)
-    result_channels = []
-
-    for channel in channels:
-        # 转换到频域
-        dft = cv2.dft(np.float32(channel), flags=cv2.DFT_COMPLEX_OUTPUT)
-        dft_shift = np.fft.fftshift(dft)
-
-        # 创建高通滤波器（去除低频周期性噪声）
-        rows, cols = channel.shape
-        crow, ccol = rows // 2, cols // 2
-
-        # 创建带通滤波器
-        mask = np.ones((rows, cols, 2), np.float32)
-
-        # 在频域中心附近（除了中心点）应用衰减
-        # 这有助于去除周期性水印
-        r = 30  # 滤波器半径
-        for i in range(-r, r):
-            for j in range(-r, r):
-                if i*i + j*j > 5*5 and i*i + j*j < r*r:
-                    mask[crow+i, ccol+j] = 0.5
-
-        # 应用滤波器
-        fshift = dft_shift * mask
-
-        # 逆变换
-        f_ishift = np.fft.ifftshift(fshift)
-        img_back = cv2.idft(f_ishift)
-        img_back = cv2.magnitude(img_back[:,:,0], img_back[:,:,1])
-
-        # 归一化
-        img_back = cv2.normalize(img_back, None, 0, 255, cv2.NORM_MINMAX)
-        result_channels.append(img_back.astype(np.uint8))
-
-    # 合并通道
-    result = cv2.merge(result_channels)
-
-    _, buffer = cv2.imencode('.png', result)
-    return buffer.tobytes()
+    img = decode_image(image_bytes)
+    return encode_png(remove_watermark_frequency_array(img))
 
 
 def hex_to_rgb(hex_color: str) -> tuple:
@@ -198,107 +384,386 @@ def calculate_position(img_width: int, img_height: int,
         return (margin, margin)
 
 
+def _render_text_tile(text: str, font, color: tuple,
+                      text_width: int, text_height: int, rotation: float,
+                      padding: int = 20) -> Image.Image:
+    """渲染单个（可旋转的）文字水印单元，四周留 padding 像素"""
+    # 创建临时图层用于旋转
+    temp_layer = Image.new('RGBA', (text_width + 2 * padding, text_height + 2 * padding),
+                           (255, 255, 255, 0))
+    temp_draw = ImageDraw.Draw(temp_layer)
+    temp_draw.text((padding, padding), text, font=font, fill=color)
+
+    if rotation != 0:
+        temp_layer = temp_layer.rotate(rotation, expand=True, resample=Image.BICUBIC)
+    return temp_layer
+
+
+def _apply_opacity(img: Image.Image, opacity: float) -> Image.Image:
+    """按透明度缩放 RGBA 图片的 alpha 通道"""
+    if opacity >= 1.0:
+        return img
+    arr = np.array(img)
+    arr[..., 3] = (arr[..., 3] * opacity).astype(np.uint8)
+    return Image.fromarray(arr, 'RGBA')
+
+
+# 每个进程缓存的已编译水印数量（批量任务在工作进程中复用）
+COMPILED_CACHE_SIZE = 8
+# 每个水印缓存的缩放尺寸数量（按目标宽度）
+SIZED_CACHE_SIZE = 16
+
+_compiled_cache = OrderedDict()
+
+
+def _restore_watermark(cls, key: str, params: dict):
+    """反序列化已编译水印：同一进程内相同参数只编译一次"""
+    watermark = _compiled_cache.get(key)
+    if watermark is None:
+        watermark = cls(**params)
+        _compiled_cache[key] = watermark
+        if len(_compiled_cache) > COMPILED_CACHE_SIZE:
+            _compiled_cache.popitem(last=False)
+    else:
+        _compiled_cache.move_to_end(key)
+    return watermark
+
+
+class CompiledWatermark:
+    """
+    预编译水印
+    按参数构建一次（解码素材、生成二维码、加载字体、渲染文字），
+    之后可重复应用到任意多张图片；实例可直接作为 run_pipeline 的处理阶段。
+    """
+
+    def __init__(self, **params):
+        self.params = params
+
+        # 参数指纹：素材字节按内容哈希，其余参数按值
+        digest = hashlib.sha1(type(self).__name__.encode())
+        for name, value in sorted(params.items()):
+            if isinstance(value, bytes):
+                value = hashlib.sha1(value).hexdigest()
+            digest.update(repr((name, value)).encode())
+        self.key = digest.hexdigest()
+
+    def apply(self, img: np.ndarray) -> np.ndarray:
+        """合成到整幅图片（直接修改 img 并返回）"""
+        img_height, img_width = img.shape[:2]
+        with stage_timer('composite'):
+            return self.apply_window(img, 0, 0, img_width, img_height)
+
+    def apply_window(self, window: np.ndarray, x0: int, y0: int,
+                     img_width: int, img_height: int) -> np.ndarray:
+        """
+        合成到整图的一个窗口（直接修改 window 并返回）
+        window 位于 img_width x img_height 整图的 (x0, y0) 处，水印位置按整图计算，
+        结果与在整图上合成后裁剪出该窗口一致（用于分块处理）
+        """
+        raise NotImplementedError
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        return self.apply(img)
+
+    def __reduce__(self):
+        # 发往工作进程时只传参数，由目标进程按 key 复用已编译实例
+        return _restore_watermark, (type(self), self.key, self.params)
+
+
+class TextWatermark(CompiledWatermark):
+    """文字水印：字体、颜色与（旋转后的）文字单元只渲染一次"""
+
+    def __init__(self, text: str,
+                 font_size: int = 36, font_color: str = '#FFFFFF',
+                 opacity: float = 0.5, rotation: float = 0,
+                 position: str = 'bottom-right', margin: int = 20,
+                 custom_x: int = 0, custom_y: int = 0,
+                 font_id: str = None,
+                 tile_gap: tuple = (100, 80), tile_padding: int = 20):
+        super().__init__(text=text, font_size=font_size, font_color=font_color,
+                         opacity=opacity, rotation=rotation,
+                         position=position, margin=margin,
+                         custom_x=custom_x, custom_y=custom_y, font_id=font_id,
+                         tile_gap=tuple(tile_gap), tile_padding=tile_padding)
+        self.text = text
+        self.rotation = rotation
+        self.position = position
+        self.margin = margin
+        self.custom_x = custom_x
+        self.custom_y = custom_y
+        # 平铺间距 (横向, 纵向) 与文字单元四周留白（缩小预览时按比例缩放）
+        self.tile_gap = tuple(tile_gap)
+
+        # 加载字体（进程内缓存，不会重复读取字体文件）
+        self.font = get_font(font_size, font_id)
+
+        # 获取文字大小
+        bbox = ImageDraw.Draw(Image.new('RGBA', (1, 1))).textbbox((0, 0), text, font=self.font)
+        self.text_width = bbox[2] - bbox[0]
+        self.text_height = bbox[3] - bbox[1]
+
+        # 转换颜色
+        rgb = hex_to_rgb(font_color)
+        alpha = int(255 * opacity)
+        self.color = (*rgb, alpha)
+
+        # 平铺/旋转时使用的文字单元
+        self.tile = None
+        if position == 'tile' or rotation != 0:
+            self.tile = _render_text_tile(text, self.font, self.color,
+                                          self.text_width, self.text_height, rotation,
+                                          tile_padding)
+            self.tile_bgra = pil_to_bgra(self.tile)
+            if position == 'tile':
+                # 平铺的周期格子只折叠一次，之后每幅图片（每帧）只做混合
+                self.tile_cells = fold_cells(self.tile_bgra, self.tile_spacing(), 'paste')
+
+        # 单个水印的精灵图与其相对定位点的偏移：
+        # 旋转单元先 paste 到透明图层再合成；未旋转时只渲染文字包围盒大小的图层
+        if position != 'tile':
+            if rotation != 0:
+                self.sprite = premultiply(self.tile_bgra, 'paste')
+                self.sprite_offset = (0, 0)
+            else:
+                left, top, right, bottom = bbox
+                layer = Image.new('RGBA', (max(1, right - left), max(1, bottom - top)),
+                                  (255, 255, 255, 0))
+                ImageDraw.Draw(layer).text((-left, -top), text, font=self.font, fill=self.color)
+                self.sprite = premultiply(pil_to_bgra(layer))
+                self.sprite_offset = (left, top)
+
+    @classmethod
+    def from_datetime(cls, format_str: str = '%Y-%m-%d %H:%M:%S',
+                      custom_text: str = '', **kwargs):
+        """日期时间水印：编译时生成一次时间文字，整批图片使用同一时间戳"""
+        return cls(format_datetime_text(format_str, custom_text), **kwargs)
+
+    def tile_spacing(self) -> tuple:
+        """平铺间距 (横向, 纵向)"""
+        return self.text_width + self.tile_gap[0], self.text_height + self.tile_gap[1]
+
+    def apply_window(self, window: np.ndarray, x0: int, y0: int,
+                     img_width: int, img_height: int) -> np.ndarray:
+        if self.position == 'tile':
+            # 平铺模式：单元已渲染并折叠，直接整体平铺合成
+            spacing_x, spacing_y = self.tile_spacing()
+
+            # 与从 (-宽, -高) 起按间距排布、只保留图内单元的结果一致
+            origin = ((-img_width) % spacing_x - x0, (-img_height) % spacing_y - y0)
+            return composite_tiled(window, self.tile_bgra, origin,
+                                   (spacing_x, spacing_y), mode='paste', cells=self.tile_cells)
+
+        # 单个水印（旋转后按旋转单元的尺寸定位）
+        if self.rotation != 0:
+            wm_width, wm_height = self.tile.size
+        else:
+            wm_width, wm_height = self.text_width, self.text_height
+        x, y = calculate_position(img_width, img_height, wm_width, wm_height,
+                                  self.position, self.margin, self.custom_x, self.custom_y)
+
+        # 只在水印包围盒内原地混合（水印不落在窗口内时不做任何处理）
+        offset_x, offset_y = self.sprite_offset
+        return composite_sprite(window, self.sprite, x + offset_x - x0, y + offset_y - y0)
+
+
+class ImageWatermark(CompiledWatermark):
+    """图片水印：素材只解码一次，按目标宽度缓存缩放并调整透明度后的版本"""
+
+    # 平铺间距
+    tile_gap = 50
+
+    def __init__(self, watermark_bytes: bytes,
+                 scale: float = 0.2, opacity: float = 0.5,
+                 position: str = 'bottom-right', margin: int = 20,
+                 custom_x: int = 0, custom_y: int = 0,
+                 tile_gap: int = None):
+        super().__init__(watermark_bytes=watermark_bytes, scale=scale, opacity=opacity,
+                         position=position, margin=margin,
+                         custom_x=custom_x, custom_y=custom_y, tile_gap=tile_gap)
+        self.asset = Image.open(io.BytesIO(watermark_bytes)).convert('RGBA')
+        self._init_layout(scale, opacity, position, margin, custom_x, custom_y, tile_gap)
+
+    def _init_layout(self, scale, opacity, position, margin, custom_x, custom_y, tile_gap=None):
+        if tile_gap is not None:
+            # 覆盖类默认的平铺间距（缩小预览时按比例缩放）
+            self.tile_gap = tile_gap
+        self.scale = scale
+        self.opacity = opacity
+        self.position = position
+        self.margin = margin
+        self.custom_x = custom_x
+        self.custom_y = custom_y
+        self._sized = OrderedDict()
+
+    def sized(self, img_width: int) -> tuple:
+        """
+        按目标图片宽度返回 (BGRA 数组, 精灵图, 平铺格子)，结果按宽度缓存
+        精灵图（预乘 alpha）只在单个水印模式下生成，平铺格子（见 fold_cells）只在平铺模式下生成，其余为 None
+        """
+        cached = self._sized.get(img_width)
+        if cached is not None:
+            self._sized.move_to_end(img_width)
+            return cached
+
+        # 缩放水印
+        wm_width = int(img_width * self.scale)
+        wm_height = int(self.asset.height * (wm_width / self.asset.width))
+        watermark = self.asset.resize((wm_width, wm_height), Image.LANCZOS)
+
+        # 调整透明度
+        watermark = _apply_opacity(watermark, self.opacity)
+
+        watermark_bgra = pil_to_bgra(watermark)
+        sprite = cells = None
+        if self.position == 'tile':
+            cells = fold_cells(watermark_bgra, (wm_width + self.tile_gap, wm_height + self.tile_gap))
+        else:
+            sprite = premultiply(watermark_bgra)
+        cached = (watermark_bgra, sprite, cells)
+        self._sized[img_width] = cached
+        if len(self._sized) > SIZED_CACHE_SIZE:
+            self._sized.popitem(last=False)
+        return cached
+
+    def apply_window(self, window: np.ndarray, x0: int, y0: int,
+                     img_width: int, img_height: int) -> np.ndarray:
+        watermark_bgra, sprite, cells = self.sized(img_width)
+        wm_height, wm_width = watermark_bgra.shape[:2]
+
+        if self.position == 'tile':
+            # 平铺模式（周期格子按宽度缓存，只折叠一次）
+            spacing = (wm_width + self.tile_gap, wm_height + self.tile_gap)
+            return composite_tiled(window, watermark_bgra, (-x0, -y0), spacing, cells=cells)
+
+        # 单个水印：只在水印包围盒内原地混合
+        x, y = calculate_position(img_width, img_height, wm_width, wm_height,
+                                  self.position, self.margin, self.custom_x, self.custom_y)
+        return composite_sprite(window, sprite, x - x0, y - y0)
+
+
+class QRCodeWatermark(ImageWatermark):
+    """二维码水印：二维码只生成一次，其余与图片水印相同"""
+
+    tile_gap = 80
+
+    def __init__(self, url: str,
+                 scale: float = 0.15, opacity: float = 0.8,
+                 position: str = 'bottom-right', margin: int = 20,
+                 custom_x: int = 0, custom_y: int = 0,
+                 fill_color: str = '#000000',
+                 back_color: str = '#FFFFFF',
+                 tile_gap: int = None):
+        CompiledWatermark.__init__(self, url=url, scale=scale, opacity=opacity,
+                                   position=position, margin=margin,
+                                   custom_x=custom_x, custom_y=custom_y,
+                                   fill_color=fill_color, back_color=back_color,
+                                   tile_gap=tile_gap)
+
+        # 生成二维码
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_M,
+            box_size=10,
+            border=2,
+        )
+        qr.add_data(url)
+        qr.make(fit=True)
+
+        # 转换颜色
+        fill_rgb = hex_to_rgb(fill_color)
+        back_rgb = hex_to_rgb(back_color)
+
+        qr_img = qr.make_image(fill_color=fill_rgb, back_color=back_rgb)
+        self.asset = qr_img.convert('RGBA')
+        self._init_layout(scale, opacity, position, margin, custom_x, custom_y, tile_gap)
+
+
+class WatermarkStack:
+    """
+    多层水印：按顺序把各预编译水印合成到同一张图片（后面的图层覆盖在前面之上）
+    作为一个处理阶段运行，分块时每个窗口依次合成全部图层，整图只遍历一次
+    """
+
+    def __init__(self, layers: list):
+        self.layers = list(layers)
+        self.key = 'stack:' + ','.join(layer.key for layer in self.layers)
+
+    def apply(self, img: np.ndarray) -> np.ndarray:
+        """合成到整幅图片（直接修改 img 并返回）"""
+        img_height, img_width = img.shape[:2]
+        with stage_timer('composite'):
+            return self.apply_window(img, 0, 0, img_width, img_height)
+
+    def apply_window(self, window: np.ndarray, x0: int, y0: int,
+                     img_width: int, img_height: int) -> np.ndarray:
+        """合成到整图的一个窗口，参数同 CompiledWatermark.apply_window"""
+        for layer in self.layers:
+            layer.apply_window(window, x0, y0, img_width, img_height)
+        return window
+
+    def __call__(self, img: np.ndarray) -> np.ndarray:
+        return self.apply(img)
+
+
+def add_text_watermark_array(img: np.ndarray, text: str,
+                             font_size: int = 36, font_color: str = '#FFFFFF',
+                             opacity: float = 0.5, rotation: float = 0,
+                             position: str = 'bottom-right', margin: int = 20,
+                             custom_x: int = 0, custom_y: int = 0,
+                             font_id: str = None) -> np.ndarray:
+    """
+    添加文字水印（数组接口，直接修改 img 并返回）
+    font_id 为 register_font 返回的用户字体 ID，未指定时使用系统中文字体
+    批量处理时请直接构建一次 TextWatermark 并重复使用
+    """
+    return TextWatermark(
+        text,
+        font_size=font_size, font_color=font_color,
+        opacity=opacity, rotation=rotation,
+        position=position, margin=margin,
+        custom_x=custom_x, custom_y=custom_y,
+        font_id=font_id
+    ).apply(img)
+
+
+@cached_call
 def add_text_watermark(image_bytes: bytes, text: str,
                        font_size: int = 36, font_color: str = '#FFFFFF',
                        opacity: float = 0.5, rotation: float = 0,
                        position: str = 'bottom-right', margin: int = 20,
-                       custom_x: int = 0, custom_y: int = 0) -> bytes:
+                       custom_x: int = 0, custom_y: int = 0,
+                       font_id: str = None) -> bytes:
     """
     添加文字水印
     """
-    # 打开原始图片
-    img = Image.open(io.BytesIO(image_bytes)).convert('RGBA')
-    img_width, img_height = img.size
-
-    # 创建透明图层用于绘制水印
-    txt_layer = Image.new('RGBA', img.size, (255, 255, 255, 0))
-    draw = ImageDraw.Draw(txt_layer)
-
-    # 尝试加载中文字体
-    font = None
-    font_paths = [
-        '/System/Library/Fonts/PingFang.ttc',  # macOS
-        '/System/Library/Fonts/STHeiti Light.ttc',  # macOS
-        '/usr/share/fonts/truetype/wqy/wqy-zenhei.ttc',  # Linux
-        '/usr/share/fonts/truetype/droid/DroidSansFallbackFull.ttf',  # Linux
-        'C:/Windows/Fonts/msyh.ttc',  # Windows
-        'C:/Windows/Fonts/simhei.ttf',  # Windows
-    ]
-
-    for font_path in font_paths:
-        if os.path.exists(font_path):
-            try:
-                font = ImageFont.truetype(font_path, font_size)
-                break
-            except Exception:
-                continue
-
-    if font is None:
-        try:
-            font = ImageFont.truetype('arial.ttf', font_size)
-        except Exception:
-            font = ImageFont.load_default()
-
-    # 获取文字大小
-    bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = bbox[2] - bbox[0]
-    text_height = bbox[3] - bbox[1]
-
-    # 转换颜色
-    rgb = hex_to_rgb(font_color)
-    alpha = int(255 * opacity)
-    color = (*rgb, alpha)
-
-    if position == 'tile':
-        # 平铺模式
-        spacing_x = text_width + 100
-        spacing_y = text_height + 80
-
-        for y in range(-img_height, img_height * 2, spacing_y):
-            for x in range(-img_width, img_width * 2, spacing_x):
-                # 创建临时图层用于旋转
-                temp_layer = Image.new('RGBA', (text_width + 40, text_height + 40), (255, 255, 255, 0))
-                temp_draw = ImageDraw.Draw(temp_layer)
-                temp_draw.text((20, 20), text, font=font, fill=color)
-
-                if rotation != 0:
-                    temp_layer = temp_layer.rotate(rotation, expand=True, resample=Image.BICUBIC)
-
-                # 粘贴到主图层
-                paste_x = x
-                paste_y = y
-                if 0 <= paste_x < img_width and 0 <= paste_y < img_height:
-                    txt_layer.paste(temp_layer, (paste_x, paste_y), temp_layer)
-    else:
-        # 单个水印
-        x, y = calculate_position(img_width, img_height, text_width, text_height,
-                                   position, margin, custom_x, custom_y)
-
-        if rotation != 0:
-            # 创建临时图层用于旋转
-            temp_layer = Image.new('RGBA', (text_width + 40, text_height + 40), (255, 255, 255, 0))
-            temp_draw = ImageDraw.Draw(temp_layer)
-            temp_draw.text((20, 20), text, font=font, fill=color)
-            temp_layer = temp_layer.rotate(rotation, expand=True, resample=Image.BICUBIC)
-
-            # 重新计算位置
-            new_width, new_height = temp_layer.size
-            x, y = calculate_position(img_width, img_height, new_width, new_height,
-                                       position, margin, custom_x, custom_y)
-            txt_layer.paste(temp_layer, (x, y), temp_layer)
-        else:
-            draw.text((x, y), text, font=font, fill=color)
+    img = decode_image(image_bytes)
+    return encode_png(add_text_watermark_array(
+        img, text,
+        font_size=font_size, font_color=font_color,
+        opacity=opacity, rotation=rotation,
+        position=position, margin=margin,
+        custom_x=custom_x, custom_y=custom_y,
+        font_id=font_id
+    ))
 
-    # 合并图层
-    result = Image.alpha_composite(img, txt_layer)
 
-    # 转换为 RGB 并保存
-    result_rgb = result.convert('RGB')
-    output = io.BytesIO()
-    result_rgb.save(output, format='PNG')
-    return output.getvalue()
+def add_image_watermark_array(img: np.ndarray, watermark_bytes: bytes,
+                              scale: float = 0.2, opacity: float = 0.5,
+                              position: str = 'bottom-right', margin: int = 20,
+                              custom_x: int = 0, custom_y: int = 0) -> np.ndarray:
+    """
+    添加图片水印（数组接口，直接修改 img 并返回）
+    批量处理时请直接构建一次 ImageWatermark 并重复使用
+    """
+    return ImageWatermark(
+        watermark_bytes,
+        scale=scale, opacity=opacity,
+        position=position, margin=margin,
+        custom_x=custom_x, custom_y=custom_y
+    ).apply(img)
 
 
+@cached_call
 def add_image_watermark(image_bytes: bytes, watermark_bytes: bytes,
                         scale: float = 0.2, opacity: float = 0.5,
                         position: str = 'bottom-right', margin: int = 20,
@@ -306,48 +771,35 @@ def add_image_watermark(image_bytes: bytes, watermark_bytes: bytes,
     """
     添加图片水印
     """
-    # 打开原始图片和水印图片
-    img = Image.open(io.BytesIO(image_bytes)).convert('RGBA')
-    watermark = Image.open(io.BytesIO(watermark_bytes)).convert('RGBA')
-
-    img_width, img_height = img.size
-
-    # 缩放水印
-    wm_width = int(img_width * scale)
-    wm_height = int(watermark.height * (wm_width / watermark.width))
-    watermark = watermark.resize((wm_width, wm_height), Image.LANCZOS)
+    img = decode_image(image_bytes)
+    return encode_png(add_image_watermark_array(
+        img, watermark_bytes,
+        scale=scale, opacity=opacity,
+        position=position, margin=margin,
+        custom_x=custom_x, custom_y=custom_y
+    ))
 
-    # 调整透明度
-    if opacity < 1.0:
-        # 获取 alpha 通道
-        r, g, b, a = watermark.split()
-        # 调整透明度
-        a = a.point(lambda x: int(x * opacity))
-        watermark = Image.merge('RGBA', (r, g, b, a))
-
-    if position == 'tile':
-        # 平铺模式
-        result = img.copy()
-        spacing_x = wm_width + 50
-        spacing_y = wm_height + 50
-
-        for y in range(0, img_height, spacing_y):
-            for x in range(0, img_width, spacing_x):
-                result.paste(watermark, (x, y), watermark)
-    else:
-        # 单个水印
-        x, y = calculate_position(img_width, img_height, wm_width, wm_height,
-                                   position, margin, custom_x, custom_y)
-        result = img.copy()
-        result.paste(watermark, (x, y), watermark)
 
-    # 转换为 RGB 并保存
-    result_rgb = result.convert('RGB')
-    output = io.BytesIO()
-    result_rgb.save(output, format='PNG')
-    return output.getvalue()
+def add_qrcode_watermark_array(img: np.ndarray, url: str,
+                               scale: float = 0.15, opacity: float = 0.8,
+                               position: str = 'bottom-right', margin: int = 20,
+                               custom_x: int = 0, custom_y: int = 0,
+                               fill_color: str = '#000000',
+                               back_color: str = '#FFFFFF') -> np.ndarray:
+    """
+    添加二维码水印（数组接口，直接修改 img 并返回）
+    批量处理时请直接构建一次 QRCodeWatermark 并重复使用
+    """
+    return QRCodeWatermark(
+        url,
+        scale=scale, opacity=opacity,
+        position=position, margin=margin,
+        custom_x=custom_x, custom_y=custom_y,
+        fill_color=fill_color, back_color=back_color
+    ).apply(img)
 
 
+@cached_call
 def add_qrcode_watermark(image_bytes: bytes, url: str,
                          scale: float = 0.15, opacity: float = 0.8,
                          position: str = 'bottom-right', margin: int = 20,
@@ -358,59 +810,43 @@ def add_qrcode_watermark(image_bytes: bytes, url: str,
     添加二维码水印
     根据输入的URL生成二维码并添加为水印
     """
-    # 打开原始图片
-    img = Image.open(io.BytesIO(image_bytes)).convert('RGBA')
-    img_width, img_height = img.size
+    img = decode_image(image_bytes)
+    return encode_png(add_qrcode_watermark_array(
+        img, url,
+        scale=scale, opacity=opacity,
+        position=position, margin=margin,
+        custom_x=custom_x, custom_y=custom_y,
+        fill_color=fill_color, back_color=back_color
+    ))
+
+
+def format_datetime_text(format_str: str = '%Y-%m-%d %H:%M:%S',
+                         custom_text: str = '') -> str:
+    """生成日期时间水印文字"""
+    if custom_text:
+        # 支持在自定义文字中嵌入日期时间
+        return datetime.now().strftime(custom_text)
+    return datetime.now().strftime(format_str)
 
-    # 生成二维码
-    qr = qrcode.QRCode(
-        version=1,
-        error_correction=qrcode.constants.ERROR_CORRECT_M,
-        box_size=10,
-        border=2,
-    )
-    qr.add_data(url)
-    qr.make(fit=True)
-
-    # 转换颜色
-    fill_rgb = hex_to_rgb(fill_color)
-    back_rgb = hex_to_rgb(back_color)
-
-    qr_img = qr.make_image(fill_color=fill_rgb, back_color=back_rgb)
-    qr_img = qr_img.convert('RGBA')
-
-    # 缩放二维码
-    qr_width = int(img_width * scale)
-    qr_height = int(qr_img.height * (qr_width / qr_img.width))
-    qr_img = qr_img.resize((qr_width, qr_height), Image.LANCZOS)
-
-    # 调整透明度
-    if opacity < 1.0:
-        r, g, b, a = qr_img.split()
-        a = a.point(lambda x: int(x * opacity))
-        qr_img = Image.merge('RGBA', (r, g, b, a))
-
-    if position == 'tile':
-        # 平铺模式
-        result = img.copy()
-        spacing_x = qr_width + 80
-        spacing_y = qr_height + 80
-
-        for y in range(0, img_height, spacing_y):
-            for x in range(0, img_width, spacing_x):
-                result.paste(qr_img, (x, y), qr_img)
-    else:
-        # 单个水印
-        x, y = calculate_position(img_width, img_height, qr_width, qr_height,
-                                   position, margin, custom_x, custom_y)
-        result = img.copy()
-        result.paste(qr_img, (x, y), qr_img)
 
-    # 转换为 RGB 并保存
-    result_rgb = result.convert('RGB')
-    output = io.BytesIO()
-    result_rgb.save(output, format='PNG')
-    return output.getvalue()
+def add_datetime_watermark_array(img: np.ndarray,
+                                 format_str: str = '%Y-%m-%d %H:%M:%S',
+                                 font_size: int = 36, font_color: str = '#FFFFFF',
+                                 opacity: float = 0.5, rotation: float = 0,
+                                 position: str = 'bottom-right', margin: int = 20,
+                                 custom_x: int = 0, custom_y: int = 0,
+                                 custom_text: str = '', font_id: str = None) -> np.ndarray:
+    """
+    添加日期时间水印（数组接口，直接修改 img 并返回）
+    """
+    return TextWatermark.from_datetime(
+        format_str, custom_text,
+        font_size=font_size, font_color=font_color,
+        opacity=opacity, rotation=rotation,
+        position=position, margin=margin,
+        custom_x=custom_x, custom_y=custom_y,
+        font_id=font_id
+    ).apply(img)
 
 
 def add_datetime_watermark(image_bytes: bytes,
@@ -419,23 +855,17 @@ def add_datetime_watermark(image_bytes: bytes,
                            opacity: float = 0.5, rotation: float = 0,
                            position: str = 'bottom-right', margin: int = 20,
                            custom_x: int = 0, custom_y: int = 0,
-                           custom_text: str = '') -> bytes:
+                           custom_text: str = '', font_id: str = None) -> bytes:
     """
     添加日期时间水印
     自动添加当前日期/时间戳，支持自定义格式
+    按生成的时间文字走文字水印（及其结果缓存），时间变化后不会命中旧结果
     """
-    # 生成日期时间文字
-    if custom_text:
-        # 支持在自定义文字中嵌入日期时间
-        text = datetime.now().strftime(custom_text)
-    else:
-        text = datetime.now().strftime(format_str)
-
-    # 使用现有的文字水印函数
     return add_text_watermark(
-        image_bytes, text,
+        image_bytes, format_datetime_text(format_str, custom_text),
         font_size=font_size, font_color=font_color,
         opacity=opacity, rotation=rotation,
         position=position, margin=margin,
-        custom_x=custom_x, custom_y=custom_y
+        custom_x=custom_x, custom_y=custom_y,
+        font_id=font_id
     )
@@ -0,0 +1,476 @@
+"""
+去水印/加水印性能基准
+
+生成带已知水印图案的合成图片（默认 1、12、24、50 MP），逐个计时
+backend/watermark_remover.py 的各个 bytes 接口函数、convert_image_format 以及 JPEG 缩小输出，
+报告延迟分位数、吞吐量与峰值内存（RSS），结果可写为 JSON 并与保存的基线对比。
+
+每个 (函数, 尺寸) 在独立的子进程中运行，峰值 RSS 互不影响；结果缓存在基准中关闭。
+
+用法：
+    python benchmark.py                                   # 全部函数、全部尺寸
+    python benchmark.py --sizes 1,12 --only auto,text     # 部分函数与尺寸
+    python benchmark.py --output results.json             # 保存结果
+    python benchmark.py --baseline results.json           # 与基线对比，出现退化时退出码为 1
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+# 基准测量的是实际处理耗时，关闭结果缓存（须在导入 backend 之前设置，子进程同样生效）
+os.environ['RESULT_CACHE_MEMORY_MB'] = '0'
+os.environ['RESULT_CACHE_DISK_MB'] = '0'
+
+import cv2
+import numpy as np
+
+from app import convert_image_format
+from backend import watermark_remover
+from backend.resize import Resize
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# 默认图片尺寸（百万像素）
+DEFAULT_SIZES = (1, 12, 24, 50)
+
+# 默认每个用例的计时次数与预热次数
+DEFAULT_REPEATS = 5
+DEFAULT_WARMUP = 1
+
+# 与基线对比时 p50 变慢超过该比例视为退化
+DEFAULT_TOLERANCE = 0.10
+
+# 合成图片中的平铺水印：文字、间距（像素，按 12MP 基准随尺寸缩放）、亮度与不透明度
+PATTERN_TEXT = 'SAMPLE'
+PATTERN_SPACING = 320
+PATTERN_LEVEL = 235
+PATTERN_OPACITY = 0.6
+
+# 缩小输出用例（thumbnail）的目标宽度（像素）
+THUMBNAIL_WIDTH = 1024
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def image_dimensions(megapixels: float) -> tuple:
+    """4:3 比例下给定像素数的 (宽, 高)"""
+    height = int(math.sqrt(megapixels * 1e6 * 3 / 4))
+    width = int(height * 4 / 3)
+    return width, height
+
+
+def watermark_region(width: int, height: int) -> tuple:
+    """合成图片右下角角标的位置 (x, y, 宽, 高)"""
+    return int(width * 0.72), int(height * 0.88), int(width * 0.24), int(height * 0.08)
+
+
+def synthesize_image(width: int, height: int, seed: int = 0) -> tuple:
+    """
+    生成带已知水印的合成图片，返回 (BGR 数组, 角标遮罩)
+    背景为平滑渐变加轻微噪声；叠加浅色平铺文字（自动检测、按颜色、频域滤波）
+    和右下角的白色角标文字（区域修复、inpaint）
+    """
+    rng = np.random.default_rng(seed)
+    scale = math.sqrt(width * height / 12e6)
+
+    # 背景：三个通道不同方向的渐变 + 噪声，保持中低亮度以便检测浅色水印
+    xs = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+    ys = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    img = np.empty((height, width, 3), np.uint8)
+    img[..., 0] = (40 + 80 * xs + 20 * ys).astype(np.uint8)
+    img[..., 1] = (60 + 60 * ys + 10 * xs).astype(np.uint8)
+    img[..., 2] = (50 + 40 * xs + 40 * ys).astype(np.uint8)
+    img += rng.integers(0, 12, (height, width, 1), dtype=np.uint8)
+
+    # 平铺水印
+    spacing = max(64, int(PATTERN_SPACING * scale))
+    font_scale = 1.6 * scale
+    thickness = max(1, int(4 * scale))
+    pattern = np.zeros((height, width), np.uint8)
+    for row, y in enumerate(range(spacing // 2, height, spacing)):
+        offset = (spacing // 2) * (row % 2)
+        for x in range(offset, width, spacing):
+            cv2.putText(pattern, PATTERN_TEXT, (x, y), cv2.FONT_HERSHEY_SIMPLEX,
+                        font_scale, 255, thickness, cv2.LINE_AA)
+    alpha = pattern.astype(np.float32) * (PATTERN_OPACITY / 255)
+    img[:] = (img * (1 - alpha[..., None]) + PATTERN_LEVEL * alpha[..., None]).astype(np.uint8)
+    del pattern, alpha
+
+    # 右下角角标
+    x, y, w, h = watermark_region(width, height)
+    mask = np.zeros((height, width), np.uint8)
+    cv2.putText(mask, '(c) watermark', (x, y + int(h * 0.75)), cv2.FONT_HERSHEY_SIMPLEX,
+                w / 260, 255, max(2, int(6 * scale)), cv2.LINE_AA)
+    img[mask > 0] = 255
+    mask = cv2.dilate(mask, np.ones((3, 3), np.uint8), iterations=2)
+    return img, mask
+
+
+def synthesize_large_mask(width: int, height: int, seed: int = 0) -> np.ndarray:
+    """大面积遮罩（约占 18%）：若干大圆块，模拟白底/大块水印的修复"""
+    rng = np.random.default_rng(seed)
+    mask = np.zeros((height, width), np.uint8)
+    radius = int(min(width, height) * 0.09)
+    for _ in range(12):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(mask, center, int(radius * rng.uniform(0.7, 1.3)), 255, -1)
+    return mask
+
+
+def synthesize_asset() -> bytes:
+    """图片水印素材：带透明背景的 PNG"""
+    asset = np.zeros((200, 400, 4), np.uint8)
+    cv2.rectangle(asset, (10, 10), (390, 190), (40, 40, 200, 200), -1)
+    cv2.putText(asset, 'LOGO', (60, 140), cv2.FONT_HERSHEY_SIMPLEX, 3.5, (255, 255, 255, 255), 8)
+    return cv2.imencode('.png', asset)[1].tobytes()
+
+
+def prepare_inputs(megapixels: float, directory: str) -> dict:
+    """生成某一尺寸的输入文件（PNG），返回用例上下文"""
+    width, height = image_dimensions(megapixels)
+    img, mask = synthesize_image(width, height)
+    paths = {
+        'image': os.path.join(directory, f'{megapixels}mp.png'),
+        'mask': os.path.join(directory, f'{megapixels}mp_mask.png'),
+        'large_mask': os.path.join(directory, f'{megapixels}mp_large_mask.png'),
+        'asset': os.path.join(directory, 'asset.png'),
+        'jpeg': os.path.join(directory, f'{megapixels}mp.jpg'),
+    }
+    cv2.imwrite(paths['image'], img)
+    cv2.imwrite(paths['jpeg'], img, [cv2.IMWRITE_JPEG_QUALITY, 92])
+    cv2.imwrite(paths['mask'], mask)
+    cv2.imwrite(paths['large_mask'], synthesize_large_mask(width, height))
+    if not os.path.exists(paths['asset']):
+        with open(paths['asset'], 'wb') as f:
+            f.write(synthesize_asset())
+    return {
+        'megapixels': megapixels,
+        'width': width,
+        'height': height,
+        'region': watermark_region(width, height),
+        'paths': paths,
+    }
+
+
+# ============================================
+# 用例：名称 -> (说明, 调用函数)
+# 调用函数接收 (图片字节, 上下文) 并返回输出字节
+# ============================================
+
+def _case_inpaint(image_bytes, ctx):
+    return watermark_remover.remove_watermark_inpaint(image_bytes, ctx['mask_bytes'])
+
+
+def _case_auto(image_bytes, ctx):
+    return watermark_remover.remove_watermark_auto(image_bytes)
+
+
+def _case_color(image_bytes, ctx):
+    return watermark_remover.remove_watermark_color(image_bytes)
+
+
+def _case_inpaint_large(image_bytes, ctx):
+    return watermark_remover.remove_watermark_inpaint(image_bytes, ctx['large_mask_bytes'])
+
+
+def _case_inpaint_pyramid(image_bytes, ctx):
+    return watermark_remover.remove_watermark_inpaint(image_bytes, ctx['large_mask_bytes'],
+                                                      inpaint_engine='pyramid')
+
+
+def _case_region(image_bytes, ctx):
+    return watermark_remover.remove_watermark_region(image_bytes, *ctx['region'])
+
+
+def _case_frequency(image_bytes, ctx):
+    return watermark_remover.remove_watermark_frequency(image_bytes)
+
+
+def _case_text(image_bytes, ctx):
+    return watermark_remover.add_text_watermark(image_bytes, '© benchmark', font_size=48,
+                                                position='bottom-right')
+
+
+def _case_text_tile(image_bytes, ctx):
+    return watermark_remover.add_text_watermark(image_bytes, '© benchmark', font_size=48,
+                                                position='tile', rotation=30)
+
+
+def _case_image(image_bytes, ctx):
+    return watermark_remover.add_image_watermark(image_bytes, ctx['asset_bytes'])
+
+
+def _case_image_tile(image_bytes, ctx):
+    return watermark_remover.add_image_watermark(image_bytes, ctx['asset_bytes'],
+                                                 scale=0.1, position='tile')
+
+
+def _case_qrcode(image_bytes, ctx):
+    return watermark_remover.add_qrcode_watermark(image_bytes, 'https://example.com/benchmark')
+
+
+def _case_datetime(image_bytes, ctx):
+    return watermark_remover.add_datetime_watermark(image_bytes)
+
+
+def _case_convert(image_bytes, ctx):
+    return convert_image_format(image_bytes, 'jpeg', 85)
+
+
+def _case_thumbnail(image_bytes, ctx):
+    # JPEG 输入缩小输出：按 DCT 缩放解码
+    return watermark_remover.run_pipeline(ctx['jpeg_bytes'], [Resize(width=THUMBNAIL_WIDTH)], 'jpeg', 85)
+
+
+CASES = {
+    'inpaint': ('remove_watermark_inpaint', _case_inpaint),
+    'inpaint-large': ('remove_watermark_inpaint (大面积遮罩)', _case_inpaint_large),
+    'inpaint-pyramid': ('remove_watermark_inpaint (大面积遮罩, 金字塔修复)', _case_inpaint_pyramid),
+    'auto': ('remove_watermark_auto', _case_auto),
+    'color': ('remove_watermark_color', _case_color),
+    'region': ('remove_watermark_region', _case_region),
+    'frequency': ('remove_watermark_frequency', _case_frequency),
+    'text': ('add_text_watermark', _case_text),
+    'text-tile': ('add_text_watermark (平铺, 旋转)', _case_text_tile),
+    'image': ('add_image_watermark', _case_image),
+    'image-tile': ('add_image_watermark (平铺)', _case_image_tile),
+    'qrcode': ('add_qrcode_watermark', _case_qrcode),
+    'datetime': ('add_datetime_watermark', _case_datetime),
+    'convert': ('convert_image_format (JPEG 85)', _case_convert),
+    'thumbnail': (f'run_pipeline (JPEG 输入, Resize 宽 {THUMBNAIL_WIDTH})', _case_thumbnail),
+}
+
+
+def reset_peak_rss() -> bool:
+    """重置当前进程的峰值 RSS 计数（Linux 4.0+ 支持），成功返回 True"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    """当前进程的峰值 RSS（MB），平台不支持时返回 None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KB 为单位，macOS 以字节为单位
+    if sys.platform == 'darwin':
+        return peak / (1024 * 1024)
+    return peak / 1024
+
+
+def run_case(name: str, inputs: dict, repeats: int, warmup: int) -> dict:
+    """在（子）进程中运行一个用例，返回原始计时与内存数据"""
+    _, func = CASES[name]
+    paths = inputs['paths']
+    with open(paths['image'], 'rb') as f:
+        image_bytes = f.read()
+    with open(paths['mask'], 'rb') as f:
+        mask_bytes = f.read()
+    with open(paths['asset'], 'rb') as f:
+        asset_bytes = f.read()
+    with open(paths['jpeg'], 'rb') as f:
+        jpeg_bytes = f.read()
+    with open(paths['large_mask'], 'rb') as f:
+        large_mask_bytes = f.read()
+    ctx = dict(inputs, mask_bytes=mask_bytes, asset_bytes=asset_bytes, jpeg_bytes=jpeg_bytes,
+               large_mask_bytes=large_mask_bytes)
+
+    # 以输入读取之后的内存为基准（可重置时从当前 RSS 重新计峰值），之后的增长即用例本身的工作内存
+    reset_peak_rss()
+    rss_before = peak_rss_mb()
+
+    for _ in range(warmup):
+        func(image_bytes, ctx)
+
+    times = []
+    output = b''
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = func(image_bytes, ctx)
+        times.append(time.perf_counter() - start)
+
+    rss_after = peak_rss_mb()
+    return {
+        'times': times,
+        'input_bytes': len(image_bytes),
+        'output_bytes': len(output),
+        'peak_rss_mb': rss_after,
+        'rss_growth_mb': None if rss_before is None else rss_after - rss_before,
+    }
+
+
+def percentile(values: list, q: float) -> float:
+    """线性插值分位数"""
+    ordered = sorted(values)
+    if len(ordered) == 1:
+        return ordered[0]
+    position = (len(ordered) - 1) * q / 100
+    lower = math.floor(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def summarize(name: str, inputs: dict, raw: dict) -> dict:
+    """汇总一个用例：分位数（毫秒）、吞吐量（MP/s、张/s）、内存"""
+    times = raw['times']
+    median = percentile(times, 50)
+    result = {
+        'name': name,
+        'function': CASES[name][0],
+        'megapixels': inputs['megapixels'],
+        'width': inputs['width'],
+        'height': inputs['height'],
+        'runs': len(times),
+        'min_ms': min(times) * 1000,
+        'mean_ms': statistics.mean(times) * 1000,
+    }
+    for q in PERCENTILES:
+        result[f'p{q}_ms'] = percentile(times, q) * 1000
+    result.update({
+        'images_per_s': 1 / median,
+        'mp_per_s': inputs['width'] * inputs['height'] / 1e6 / median,
+        'input_bytes': raw['input_bytes'],
+        'output_bytes': raw['output_bytes'],
+        'peak_rss_mb': raw['peak_rss_mb'],
+        'rss_growth_mb': raw['rss_growth_mb'],
+    })
+    return result
+
+
+def environment() -> dict:
+    """运行环境信息（写入结果，便于判断基线是否可比）"""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'opencv_threads': cv2.getNumThreads(),
+    }
+
+
+def compare(results: list, baseline: dict, tolerance: float) -> list:
+    """按 (用例, 尺寸) 与基线对比 p50，返回退化的条目说明"""
+    base = {(item['name'], item['megapixels']): item for item in baseline.get('results', [])}
+    regressions = []
+    print()
+    print(f"{'用例':<16} {'MP':>5} {'基线 p50':>11} {'当前 p50':>11} {'变化':>8}")
+    for item in results:
+        previous = base.get((item['name'], item['megapixels']))
+        if previous is None:
+            continue
+        change = item['p50_ms'] / previous['p50_ms'] - 1
+        flag = ''
+        if change > tolerance:
+            flag = '  退化'
+            regressions.append(f"{item['name']} @ {item['megapixels']}MP: "
+                               f"{previous['p50_ms']:.1f}ms -> {item['p50_ms']:.1f}ms")
+        print(f"{item['name']:<16} {item['megapixels']:>5g} {previous['p50_ms']:>9.1f}ms "
+              f"{item['p50_ms']:>9.1f}ms {change:>+7.1%}{flag}")
+    return regressions
+
+
+def print_result(item: dict):
+    rss = '-' if item['peak_rss_mb'] is None else f"{item['peak_rss_mb']:.0f}/{item['rss_growth_mb']:+.0f}"
+    print(f"{item['name']:<16} {item['megapixels']:>5g} {item['p50_ms']:>9.1f} {item['p90_ms']:>9.1f} "
+          f"{item['p99_ms']:>9.1f} {item['mp_per_s']:>8.1f} {item['images_per_s']:>7.2f} {rss:>12}",
+          flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='去水印/加水印性能基准')
+    parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                        help='图片尺寸（百万像素），逗号分隔')
+    parser.add_argument('--only', default='', help=f"只运行的用例，逗号分隔（可选：{','.join(CASES)}）")
+    parser.add_argument('--repeats', type=int, default=DEFAULT_REPEATS, help='每个用例的计时次数')
+    parser.add_argument('--warmup', type=int, default=DEFAULT_WARMUP, help='每个用例的预热次数')
+    parser.add_argument('--output', help='结果 JSON 输出路径')
+    parser.add_argument('--baseline', help='基线结果 JSON，与之对比 p50')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help='p50 变慢超过该比例视为退化（默认 0.10）')
+    parser.add_argument('--in-process', action='store_true',
+                        help='在当前进程中运行（更快，但峰值 RSS 会累积）')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    sizes = [float(size) for size in args.sizes.split(',') if size]
+    names = [name for name in args.only.split(',') if name] or list(CASES)
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        print(f"未知的用例: {', '.join(unknown)}", file=sys.stderr)
+        return 2
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with tempfile.TemporaryDirectory(prefix='watermark-bench-') as directory:
+        print(f"{'用例':<16} {'MP':>5} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} "
+              f"{'MP/s':>8} {'张/s':>7} {'峰值/增长MB':>12}")
+        for megapixels in sizes:
+            inputs = prepare_inputs(megapixels, directory)
+            for name in names:
+                if args.in_process:
+                    raw = run_case(name, inputs, args.repeats, args.warmup)
+                else:
+                    # 每个用例一个新进程，峰值 RSS 只反映该用例
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                        raw = executor.submit(run_case, name, inputs, args.repeats, args.warmup).result()
+                item = summarize(name, inputs, raw)
+                results.append(item)
+                print_result(item)
+
+    report = {'environment': environment(), 'repeats': args.repeats, 'results': results}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'\n结果已写入 {args.output}')
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'\n{len(regressions)} 项退化（超过 {args.tolerance:.0%}）：')
+            for line in regressions:
+                print(f'  {line}')
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,357 @@
+"""
+离线批量处理：遍历输入目录，在多个进程中直接调用后端函数去水印/加水印，
+结果按相同的目录结构写入输出目录。
+
+处理参数与 HTTP 接口的表单参数一致（--param 键=值，上传文件用 --file 字段名=路径）。
+输出目录中的清单（.bulk-manifest.jsonl）逐张记录输入文件的哈希与处理参数：
+重新运行时跳过输入与参数都未变化的图片，中断后再次运行即从中断处继续。
+运行中定期输出进度、吞吐量与预计剩余时间。
+
+用法：
+    python bulk.py remove photos/ out/ --param method=auto --param threshold=210
+    python bulk.py add photos/ out/ --param type=text --param text=© --param position=tile
+    python bulk.py add photos/ out/ --param type=image --file watermark_image=logo.png --format jpeg
+    python bulk.py add photos/ out/ --layers layers.json --file logo=logo.png --workers 8
+    python bulk.py remove photos/ out/ --param resize_width=2048 --force   # 忽略清单全部重新处理
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+
+# 每张图片只处理一次，关闭结果缓存（须在导入 backend 之前设置，子进程同样生效）
+os.environ['RESULT_CACHE_MEMORY_MB'] = '0'
+os.environ['RESULT_CACHE_DISK_MB'] = '0'
+
+from werkzeug.datastructures import FileStorage
+
+from app import (
+    ParamError,
+    build_remove_stage,
+    build_watermark,
+    output_file_info,
+    read_resize,
+    read_watermark_layers,
+    resized_stages,
+    tiled,
+)
+from backend.admission import check_image
+from backend.batch import default_workers, get_executor, reset_executor
+from backend.watermark_remover import run_pipeline
+
+
+# 处理的输入文件扩展名
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff')
+
+# 保持原格式输出时各扩展名对应的输出格式，其余格式输出为 PNG（GIF/WebP 动图逐帧处理后仍输出动图）
+FORMAT_BY_EXTENSION = {'.jpg': 'jpeg', '.jpeg': 'jpeg', '.png': 'png', '.webp': 'webp', '.gif': 'gif'}
+
+# 清单文件名（位于输出目录）
+MANIFEST_NAME = '.bulk-manifest.jsonl'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='离线批量去水印/加水印')
+    parser.add_argument('action', choices=('remove', 'add'), help='remove 去水印，add 加水印')
+    parser.add_argument('input', help='输入目录（递归遍历）')
+    parser.add_argument('output', help='输出目录（按输入的目录结构写入）')
+    parser.add_argument('--param', action='append', default=[], metavar='键=值',
+                        help='处理参数，与接口表单参数相同，可重复')
+    parser.add_argument('--file', action='append', default=[], metavar='字段=路径',
+                        help='水印图片，字段名与接口的上传字段相同（默认 watermark_image），可重复')
+    parser.add_argument('--layers', metavar='JSON文件', help='水印图层列表（同接口的 layers 参数）')
+    parser.add_argument('--format', choices=('png', 'jpeg', 'webp', 'gif'),
+                        help='输出格式，默认保持原格式（无法保持时为 PNG）')
+    parser.add_argument('--quality', type=int, default=95, help='JPEG/WebP 质量（默认 95）')
+    parser.add_argument('--workers', type=int, default=0, help='进程数（默认 BATCH_WORKERS 或 CPU 核数）')
+    parser.add_argument('--manifest', help=f'清单路径（默认 输出目录/{MANIFEST_NAME}）')
+    parser.add_argument('--force', action='store_true', help='忽略清单，全部重新处理')
+    parser.add_argument('--progress-interval', type=float, default=5.0, help='进度输出间隔秒数（默认 5）')
+    args = parser.parse_args(argv)
+
+    for option in ('param', 'file'):
+        pairs = {}
+        for item in getattr(args, option):
+            key, sep, value = item.partition('=')
+            if not sep or not key:
+                parser.error(f'--{option} 需为 键=值 格式: {item}')
+            pairs[key] = value
+        setattr(args, option, pairs)
+    return args
+
+
+def read_options(args) -> tuple:
+    """
+    参数与水印文件转为接口使用的 (表单, 上传文件)，及参数指纹（文件按内容哈希）
+    参数指纹与清单中的记录一致时，输入未变化的图片不再处理
+    """
+    form = dict(args.param)
+    if args.layers:
+        with open(args.layers, encoding='utf-8') as f:
+            form['layers'] = f.read()
+
+    files, digests = {}, {}
+    for field, path in args.file.items():
+        with open(path, 'rb') as f:
+            data = f.read()
+        files[field] = FileStorage(io.BytesIO(data), filename=os.path.basename(path))
+        digests[field] = hashlib.sha1(data).hexdigest()
+
+    options = [args.action, sorted(form.items()), sorted(digests.items()), args.format, args.quality]
+    return form, files, hashlib.sha1(json.dumps(options, ensure_ascii=False).encode()).hexdigest()
+
+
+def stage_builder(action: str, form: dict, files: dict):
+    """返回 build(scale)：按缩放比例构造处理阶段，每个比例只构造一次（水印只编译一次）"""
+    if action == 'add':
+        layers = read_watermark_layers(form, files)
+        make = lambda scale: [tiled(build_watermark(layers, scale))]
+    else:
+        make = lambda scale: [build_remove_stage(form, scale=scale)]
+
+    built = {}
+
+    def build(scale):
+        if scale not in built:
+            built[scale] = make(scale)
+        return built[scale]
+    return build
+
+
+def scan(input_dir: str, exclude: str) -> list:
+    """递归列出输入目录中的图片，返回 [(相对路径, 大小, 修改时间 ns)]，跳过 exclude 目录（输出目录）"""
+    found = []
+    for root, dirs, names in os.walk(input_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.realpath(os.path.join(root, d)) != exclude)
+        for name in sorted(names):
+            if not name.lower().endswith(IMAGE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            found.append((os.path.relpath(path, input_dir), stat.st_size, stat.st_mtime_ns))
+    return found
+
+
+def output_plan(rel: str, output_format: str) -> tuple:
+    """输出的 (相对路径, 格式)：未指定格式时保持原格式与扩展名"""
+    stem, ext = os.path.splitext(rel)
+    if output_format is None:
+        output_format = FORMAT_BY_EXTENSION.get(ext.lower())
+        if output_format is not None:
+            return rel, output_format
+        output_format = 'png'
+    return f'{stem}.{output_file_info(output_format)[0]}', output_format
+
+
+def load_manifest(path: str) -> dict:
+    """读取清单 {相对路径: 记录}，同一路径以最后一条为准；中断时写了一半的行忽略"""
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry['path']] = entry
+    return entries
+
+
+def write_manifest(path: str, entries: dict):
+    """按当前记录重写清单（去掉追加过程中同一路径的旧记录）"""
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as f:
+        for entry in entries.values():
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    os.replace(temp, path)
+
+
+def process_file(task: tuple) -> tuple:
+    """
+    处理单个文件（在工作进程中运行），异常不向外抛出
+    task 为 (输入路径, 输出路径, stages, 输出格式, 质量, 清单中的输入哈希或 None)；
+    输入哈希与清单一致且输出已存在时跳过（只是修改时间变化）；像素数超过上限（MAX_IMAGE_PIXELS）的图片不解码，记为失败。
+    输出先写入临时文件再改名，中断时不会留下不完整的结果。
+    返回 (状态 done/skipped/failed, 输入哈希, 输入字节数, 错误信息)
+    """
+    src, dst, stages, output_format, quality, previous = task
+    try:
+        with open(src, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha1(data).hexdigest()
+        if digest == previous and os.path.exists(dst):
+            return 'skipped', digest, len(data), None
+
+        check_image(data)
+        result = run_pipeline(data, stages, output_format, quality, use_cache=False)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        temp = dst + '.part'
+        with open(temp, 'wb') as f:
+            f.write(result)
+        os.replace(temp, dst)
+        return 'done', digest, len(data), None
+    except Exception as e:
+        return 'failed', None, 0, str(e)
+
+
+def run_tasks(tasks, workers: int):
+    """
+    并行执行 process_file，按完成顺序产出 (附带信息, 结果)
+    tasks 为 (附带信息, task) 的惰性迭代器，同时在途的任务最多 workers * 2 个
+    """
+    if workers <= 1:
+        for meta, task in tasks:
+            yield meta, process_file(task)
+        return
+
+    executor = get_executor(workers)
+    pending = {}
+    try:
+        for meta, task in tasks:
+            pending[executor.submit(process_file, task)] = meta
+            if len(pending) >= workers * 2:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    yield pending.pop(future), future.result()
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield pending.pop(future), future.result()
+    finally:
+        # 中断时取消尚未开始的任务
+        for future in pending:
+            future.cancel()
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    return f'{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class Progress:
+    """进度统计：已处理/跳过/失败数、吞吐量（张/s、输入 MB/s）与预计剩余时间"""
+
+    def __init__(self, total: int, interval: float):
+        self.total = total
+        self.interval = interval
+        self.done = self.skipped = self.failed = 0
+        self.bytes = 0
+        self.start = self.last = time.monotonic()
+
+    def update(self, status: str, size: int):
+        if status == 'done':
+            self.done += 1
+            self.bytes += size
+        elif status == 'skipped':
+            self.skipped += 1
+        else:
+            self.failed += 1
+        now = time.monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.start, 1e-6)
+        finished = self.done + self.skipped + self.failed
+        rate = finished / elapsed
+        eta = format_duration((self.total - finished) / rate) if rate > 0 else '--:--:--'
+        percent = finished / self.total if self.total else 1.0
+        print(f'[{finished}/{self.total} {percent:.1%}] 处理 {self.done} 跳过 {self.skipped} 失败 {self.failed}  '
+              f'{self.done / elapsed:.1f} 张/s {self.bytes / elapsed / 1e6:.1f} MB/s  '
+              f'已用 {format_duration(elapsed)} 剩余 {eta}', file=sys.stderr, flush=True)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    input_dir = os.path.abspath(args.input)
+    output_dir = os.path.abspath(args.output)
+    if not os.path.isdir(input_dir):
+        print(f'输入目录不存在: {args.input}', file=sys.stderr)
+        return 2
+
+    try:
+        form, files, options_key = read_options(args)
+        resize = read_resize(form)
+        build = stage_builder(args.action, form, files)
+        # 先按原尺寸构造一次，参数错误在开始处理前报告
+        build(1.0)
+    except (ParamError, ValueError, OSError) as e:
+        print(f'参数错误: {e}', file=sys.stderr)
+        return 2
+
+    os.makedirs(output_dir, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(output_dir, MANIFEST_NAME)
+    entries = {} if args.force else load_manifest(manifest_path)
+
+    # 输入大小、修改时间与参数都和清单一致且输出存在的图片不读取文件，直接跳过
+    todo, outputs = [], {}
+    found = scan(input_dir, output_dir)
+    for rel, size, mtime_ns in found:
+        output_rel, output_format = output_plan(rel, args.format)
+        if output_rel in outputs:
+            print(f'输出文件名冲突: {outputs[output_rel]} 与 {rel} 都输出为 {output_rel}，'
+                  f'请不指定 --format（保持原格式输出）或重命名其中一个', file=sys.stderr)
+            return 2
+        outputs[output_rel] = rel
+
+        entry = entries.get(rel)
+        previous = None
+        if entry is not None and entry['params'] == options_key \
+                and os.path.exists(os.path.join(output_dir, output_rel)):
+            if entry['size'] == size and entry['mtime_ns'] == mtime_ns:
+                continue
+            previous = entry['sha1']
+        todo.append((rel, size, mtime_ns, output_rel, output_format, previous))
+
+    workers = args.workers or default_workers()
+    print(f'共 {len(found)} 张图片，{len(found) - len(todo)} 张未变化已跳过，待处理 {len(todo)} 张'
+          f'（{workers} 个进程）', file=sys.stderr, flush=True)
+
+    def tasks():
+        for rel, size, mtime_ns, output_rel, output_format, previous in todo:
+            src = os.path.join(input_dir, rel)
+            # 缩小输出时只读取文件头确定缩放比例，参数按比例映射（同批量接口）
+            stages = resized_stages(resize, src, build)
+            task = (src, os.path.join(output_dir, output_rel), stages, output_format, args.quality, previous)
+            yield (rel, size, mtime_ns, output_rel), task
+
+    progress = Progress(len(todo), args.progress_interval)
+    errors = []
+    interrupted = False
+    with open(manifest_path, 'a', encoding='utf-8') as manifest:
+        try:
+            for (rel, size, mtime_ns, output_rel), (status, digest, nbytes, error) in run_tasks(tasks(), workers):
+                progress.update(status, nbytes)
+                if status == 'failed':
+                    errors.append(f'{rel}: {error}')
+                    print(f'失败 {rel}: {error}', file=sys.stderr, flush=True)
+                    continue
+                # 每张完成后立即追加记录，中断后重新运行从这里继续
+                entry = {'path': rel, 'size': size, 'mtime_ns': mtime_ns, 'sha1': digest,
+                         'params': options_key, 'output': output_rel}
+                entries[rel] = entry
+                manifest.write(json.dumps(entry, ensure_ascii=False) + '\n')
+                manifest.flush()
+        except KeyboardInterrupt:
+            interrupted = True
+            reset_executor()
+
+    write_manifest(manifest_path, entries)
+    progress.report()
+    if interrupted:
+        print('已中断，重新运行将从中断处继续', file=sys.stderr)
+        return 130
+    if errors:
+        print(f'{len(errors)} 张处理失败', file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+# 生产环境启动配置：gunicorn -c gunicorn.conf.py app:app
+#
+# 主进程预先导入应用（cv2/numpy/qrcode、字体）并预热各热路径，之后派生多个工作进程；
+# 每个工作进程的 OpenCV 线程数按工作进程数分配，避免并发请求时线程超订。
+import os
+
+import cv2
+
+
+cpu_count = os.cpu_count() or 1
+
+# 监听地址（环境变量 PORT，默认 5001，与开发模式一致）
+bind = f"0.0.0.0:{os.environ.get('PORT', 5001)}"
+
+# 工作进程数（环境变量 WEB_WORKERS，默认 CPU 核数）
+workers = int(os.environ.get('WEB_WORKERS', 0)) or cpu_count
+
+# 每个工作进程的线程数：处理期间 OpenCV/NumPy 释放 GIL，少量线程即可重叠上传与处理
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 2))
+
+# 每个工作进程的 OpenCV 线程数（环境变量 OPENCV_THREADS，默认按核数均分）
+opencv_threads = int(os.environ.get('OPENCV_THREADS', 0)) or max(1, cpu_count // workers)
+
+# 大图处理可能较慢
+timeout = int(os.environ.get('WEB_TIMEOUT', 300))
+graceful_timeout = 30
+keepalive = 5
+
+# 主进程先加载应用，工作进程共享已导入的模块与预热结果
+preload_app = True
+
+accesslog = '-'
+errorlog = '-'
+
+# 主进程不启动 OpenCV 线程池：派生前创建的线程不会被子进程继承
+cv2.setNumThreads(1)
+
+
+def when_ready(server):
+    """应用已加载、派生工作进程之前：在主进程中预热"""
+    from backend.batch import default_workers, worker_threads
+    from backend.warmup import warm_up
+    warm_up()
+    server.log.info('预热完成，工作进程 %d 个，每个 OpenCV 线程 %d 个', workers, opencv_threads)
+    batch_workers = default_workers()
+    server.log.info('批量处理进程 %d 个，每个 OpenCV 线程 %d 个', batch_workers, worker_threads(batch_workers))
+
+
+def post_fork(server, worker):
+    """工作进程启动后设置本进程的 OpenCV 线程数"""
+    cv2.setNumThreads(opencv_threads)
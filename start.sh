@@ -50,8 +50,8 @@ echo "=== 使用 PM2 启动服务 ==="
 # 停止旧进程（如果存在）
 pm2 delete shuiyin 2>/dev/null || true
 
-# 启动新进程
-pm2 start venv/bin/python3 --name shuiyin -- app.py
+# 启动新进程（gunicorn 预派生多个工作进程，配置见 gunicorn.conf.py）
+pm2 start venv/bin/gunicorn --name shuiyin -- -c gunicorn.conf.py app:app
 
 # 保存 PM2 进程列表并设置开机自启
 pm2 save
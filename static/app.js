@@ -83,6 +83,8 @@ document.addEventListener('DOMContentLoaded', function() {
     const templateList = document.getElementById('templateList');
 
     let currentFile = null;
+    let currentImageId = null;  // 服务器会话中的图片句柄（每张图片只上传一次）
+    let pendingImageUpload = null;  // 进行中的图片上传
     let resultBlob = null;
     let watermarkFile = null;
     let currentWatermarkType = 'text';
@@ -100,7 +102,9 @@ document.addEventListener('DOMContentLoaded', function() {
         timeout: 120000,        // 120秒超时
         maxRetries: 3,          // 最多重试3次
         retryDelays: [1000, 2000, 4000],  // 指数退避: 1s, 2s, 4s
-        retryableStatusCodes: [500, 502, 503, 504]  // 可重试的服务器错误
+        retryableStatusCodes: [500, 502, 503, 504],  // 可重试的服务器错误
+        jobPollInterval: 1000,  // 异步任务状态轮询间隔
+        previewDelay: 150       // 调整参数后请求实时预览的防抖延迟
     };
 
     /**
@@ -226,7 +230,9 @@ document.addEventListener('DOMContentLoaded', function() {
                     // 返回整个 xhr 对象，以便访问 response
                     resolve(xhr);
                 } else {
-                    reject(new Error(`服务器错误: ${xhr.status} ${xhr.statusText}`));
+                    const error = new Error(`服务器错误: ${xhr.status} ${xhr.statusText}`);
+                    error.status = xhr.status;
+                    reject(error);
                 }
             };
 
@@ -283,6 +289,59 @@ document.addEventListener('DOMContentLoaded', function() {
         throw lastError;
     }
 
+    /**
+     * 轮询异步任务直到结束（只查询状态，不会重新上传或重新处理）
+     * @param {string} statusUrl - 任务状态URL
+     * @param {function} onStatus - 状态回调
+     * @returns {Promise<object>} 任务最终状态
+     */
+    async function waitForJob(statusUrl, onStatus) {
+        while (true) {
+            const response = await fetchWithRetry(statusUrl);
+            const status = await response.json();
+            if (!response.ok) {
+                throw new Error(status.error || `服务器错误: ${response.status}`);
+            }
+
+            if (onStatus) {
+                onStatus(status);
+            }
+            if (status.status === 'done' || status.status === 'failed') {
+                return status;
+            }
+            await new Promise(resolve => setTimeout(resolve, UPLOAD_CONFIG.jobPollInterval));
+        }
+    }
+
+    /**
+     * 上传当前图片到服务器会话（每张图片只上传一次），返回图片句柄
+     * @param {function} onProgress - 进度回调
+     * @returns {Promise<string>}
+     */
+    async function ensureImageUploaded(onProgress) {
+        if (!currentImageId) {
+            // 预览与处理同时触发时共用同一次上传
+            if (!pendingImageUpload) {
+                const file = currentFile;
+                const formData = new FormData();
+                formData.append('image', file);
+                pendingImageUpload = uploadWithRetryAndProgress('/api/images', formData, onProgress)
+                    .then(blob => blob.text())
+                    .then(text => {
+                        if (file === currentFile) {
+                            currentImageId = JSON.parse(text).image_id;
+                        }
+                        return JSON.parse(text).image_id;
+                    })
+                    .finally(() => {
+                        pendingImageUpload = null;
+                    });
+            }
+            return pendingImageUpload;
+        }
+        return currentImageId;
+    }
+
     // 新水印类型面板引用
     const qrcodeWatermarkPanel = document.getElementById('qrcodeWatermarkPanel');
     const datetimeWatermarkPanel = document.getElementById('datetimeWatermarkPanel');
@@ -394,6 +453,8 @@ document.addEventListener('DOMContentLoaded', function() {
 
     function handleFile(file) {
         currentFile = file;
+        currentImageId = null;
+        pendingImageUpload = null;
         const reader = new FileReader();
         reader.onload = (e) => {
             originalImage.src = e.target.result;
@@ -599,6 +660,9 @@ document.addEventListener('DOMContentLoaded', function() {
         };
 
         canvas.onmouseup = () => {
+            if (isDrawing) {
+                schedulePreview();
+            }
             isDrawing = false;
         };
 
@@ -636,6 +700,7 @@ document.addEventListener('DOMContentLoaded', function() {
         }
 
         setupRegionSelection();
+        schedulePreview();
     });
 
     // 方法按钮点击事件
@@ -679,6 +744,7 @@ document.addEventListener('DOMContentLoaded', function() {
             watermarkTabs.forEach(t => t.classList.remove('active'));
             tab.classList.add('active');
             currentWatermarkType = tab.dataset.type;
+            schedulePreview();
 
             // 隐藏所有面板
             textWatermarkPanel.style.display = 'none';
@@ -888,14 +954,20 @@ document.addEventListener('DOMContentLoaded', function() {
     // 单图处理按钮
     // ============================================
 
-    processBtn.addEventListener('click', async () => {
-        if (!currentFile) return;
-
-        loading.style.display = 'flex';
-        loadingText.textContent = '正在处理中...';
+    /**
+     * 按当前设置构造单图处理请求
+     * @param {boolean} silent - 参数不完整时不弹出提示（实时预览）
+     * @returns {{apiUrl: string, formData: FormData, isAddWatermark: boolean}|null} 参数不完整时返回 null
+     */
+    function buildProcessForm(silent) {
+        const invalid = (message) => {
+            if (!silent) {
+                showAlert(message);
+            }
+            return null;
+        };
 
         const formData = new FormData();
-        formData.append('image', currentFile);
         formData.append('format', outputFormat.value);
         formData.append('quality', outputQuality.value);
 
@@ -916,9 +988,7 @@ document.addEventListener('DOMContentLoaded', function() {
 
             if (currentWatermarkType === 'text') {
                 if (!watermarkText.value.trim()) {
-                    showAlert('请输入水印文字');
-                    loading.style.display = 'none';
-                    return;
+                    return invalid('请输入水印文字');
                 }
                 formData.append('text', watermarkText.value);
                 formData.append('font_size', fontSize.value);
@@ -926,18 +996,14 @@ document.addEventListener('DOMContentLoaded', function() {
                 formData.append('rotation', rotation.value);
             } else if (currentWatermarkType === 'image') {
                 if (!watermarkFile) {
-                    showAlert('请上传水印图片');
-                    loading.style.display = 'none';
-                    return;
+                    return invalid('请上传水印图片');
                 }
                 formData.append('watermark_image', watermarkFile);
                 formData.append('scale', watermarkScale.value / 100);
             } else if (currentWatermarkType === 'qrcode') {
                 const qrcodeUrl = document.getElementById('qrcodeUrl').value;
                 if (!qrcodeUrl.trim()) {
-                    showAlert('请输入二维码链接');
-                    loading.style.display = 'none';
-                    return;
+                    return invalid('请输入二维码链接');
                 }
                 formData.append('url', qrcodeUrl);
                 formData.append('scale', document.getElementById('qrcodeScale').value / 100);
@@ -980,6 +1046,23 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         }
 
+        return { apiUrl, formData, isAddWatermark };
+    }
+
+    processBtn.addEventListener('click', async () => {
+        if (!currentFile) return;
+
+        const processRequest = buildProcessForm(false);
+        if (!processRequest) return;
+        const { apiUrl, formData } = processRequest;
+
+        // 正式处理按原图进行，丢弃尚未返回的预览
+        clearTimeout(previewTimer);
+        previewSeq++;
+
+        loading.style.display = 'flex';
+        loadingText.textContent = '正在处理中...';
+
         try {
             // 进度回调函数
             const updateProgress = (percent, loaded, total, phase, message) => {
@@ -1007,8 +1090,18 @@ document.addEventListener('DOMContentLoaded', function() {
                 }
             };
 
-            // 使用带进度和重试的上传
-            resultBlob = await uploadWithRetryAndProgress(apiUrl, formData, updateProgress);
+            // 原图只上传一次，之后调整参数只发送图片句柄；句柄过期（410）时重新上传
+            formData.set('image_id', await ensureImageUploaded(updateProgress));
+            try {
+                resultBlob = await uploadWithRetryAndProgress(apiUrl, formData, updateProgress);
+            } catch (error) {
+                if (error.status !== 410) {
+                    throw error;
+                }
+                currentImageId = null;
+                formData.set('image_id', await ensureImageUploaded(updateProgress));
+                resultBlob = await uploadWithRetryAndProgress(apiUrl, formData, updateProgress);
+            }
 
             // 验证返回的数据
             if (!resultBlob || resultBlob.size === 0) {
@@ -1034,6 +1127,69 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     });
 
+    // ============================================
+    // 实时预览
+    // ============================================
+
+    let previewTimer = null;
+    let previewSeq = 0;      // 只显示最后一次请求的预览
+    let previewUrl = null;
+
+    /**
+     * 调整参数后防抖请求预览：服务器在缩小的代理图上处理并返回小尺寸 JPEG，
+     * 坐标等参数仍按原图填写；下载的结果需点击“开始处理”按原图生成
+     */
+    function schedulePreview() {
+        clearTimeout(previewTimer);
+        if (!currentFile || currentMode !== 'single') return;
+        previewTimer = setTimeout(requestPreview, UPLOAD_CONFIG.previewDelay);
+    }
+
+    async function requestPreview() {
+        const previewRequest = buildProcessForm(true);
+        if (!previewRequest) return;
+        const { formData, isAddWatermark } = previewRequest;
+        formData.append('action', isAddWatermark ? 'add' : 'remove');
+
+        const seq = ++previewSeq;
+        try {
+            formData.set('image_id', await ensureImageUploaded());
+            let response = await fetch('/api/preview', { method: 'POST', body: formData });
+            if (response.status === 410) {
+                currentImageId = null;
+                formData.set('image_id', await ensureImageUploaded());
+                response = await fetch('/api/preview', { method: 'POST', body: formData });
+            }
+            if (!response.ok) return;
+
+            const blob = await response.blob();
+            if (seq !== previewSeq) return;
+
+            if (previewUrl) {
+                URL.revokeObjectURL(previewUrl);
+            }
+            previewUrl = URL.createObjectURL(blob);
+            resultImage.src = previewUrl;
+            resultImage.style.display = 'block';
+            resultPlaceholder.style.display = 'none';
+
+            // 参数已变化，之前的处理结果不再对应当前设置
+            downloadBtn.disabled = true;
+            resultBlob = null;
+        } catch (error) {
+            // 预览失败不打断操作，点击“开始处理”时再提示
+        }
+    }
+
+    const controlsPanel = previewSection.querySelector('.controls');
+    ['input', 'change'].forEach(type => {
+        controlsPanel.addEventListener(type, (e) => {
+            // 输出格式与质量不影响预览
+            if (e.target === outputFormat || e.target === outputQuality) return;
+            schedulePreview();
+        });
+    });
+
     // ============================================
     // 批量处理相关
     // ============================================
@@ -1659,7 +1815,7 @@ document.addEventListener('DOMContentLoaded', function() {
         const method = batchMethodSelect.value;
 
         if (method === 'add-watermark') {
-            apiUrl = '/api/batch-add-watermark';
+            apiUrl = '/api/jobs/batch-add-watermark';
             formData.append('type', batchWatermarkType);
             formData.append('position', document.getElementById('batchWatermarkPosition').value);
             formData.append('opacity', batchWatermarkOpacity.value / 100);
@@ -1708,7 +1864,7 @@ document.addEventListener('DOMContentLoaded', function() {
                 formData.append('rotation', document.getElementById('batchDatetimeRotation').value);
             }
         } else {
-            apiUrl = '/api/batch-remove-watermark';
+            apiUrl = '/api/jobs/batch-remove-watermark';
             formData.append('method', method);
 
             if (method === 'auto') {
@@ -1780,24 +1936,35 @@ document.addEventListener('DOMContentLoaded', function() {
                 }
             };
 
-            // 使用带进度和重试的上传
+            // 提交异步任务（图片只上传一次），之后轮询处理进度
             const blob = await uploadWithRetryAndProgress(apiUrl, formData, updateProgress);
 
             // 验证返回的数据
             if (!blob || blob.size === 0) {
                 throw new Error('服务器返回了空数据，请稍后重试');
             }
+            const job = JSON.parse(await blob.text());
 
-            const url = URL.createObjectURL(blob);
+            const status = await waitForJob(job.status_url, (s) => {
+                loadingText.textContent = `正在处理 ${s.completed + s.failed} / ${s.total} 张图片...`;
+            });
+            if (status.status !== 'done') {
+                throw new Error(status.error || '任务执行失败');
+            }
+
+            // 直接从服务器下载结果
             const a = document.createElement('a');
-            a.href = url;
-            a.download = method === 'add-watermark' ? 'watermarked.zip' : 'watermark_removed.zip';
+            a.href = job.result_url;
+            a.download = status.download_name;
             document.body.appendChild(a);
             a.click();
             document.body.removeChild(a);
-            URL.revokeObjectURL(url);
 
-            showAlert(`成功处理 ${batchFiles.length} 张图片！`);
+            if (status.failed > 0) {
+                showAlert(`成功处理 ${status.completed} 张图片，${status.failed} 张失败（详见 errors.txt）`);
+            } else {
+                showAlert(`成功处理 ${status.completed} 张图片！`);
+            }
 
         } catch (error) {
             showAlert('处理失败：' + error.message);
@@ -1881,7 +2048,9 @@ document.addEventListener('DOMContentLoaded', function() {
         const url = URL.createObjectURL(resultBlob);
         const a = document.createElement('a');
         a.href = url;
-        const ext = outputFormat.value === 'jpg' ? 'jpg' : outputFormat.value;
+        // 动图按源格式输出（GIF/WebP），扩展名以服务端返回的类型为准
+        const types = { 'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp', 'image/gif': 'gif' };
+        const ext = types[resultBlob.type] || (outputFormat.value === 'jpg' ? 'jpg' : outputFormat.value);
         a.download = 'processed_' + currentFile.name.replace(/\.[^/.]+$/, '') + '.' + ext;
         document.body.appendChild(a);
         a.click();
@@ -1900,6 +2069,9 @@ document.addEventListener('DOMContentLoaded', function() {
 
         setTimeout(() => {
             currentFile = null;
+            currentImageId = null;
+            pendingImageUpload = null;
+            clearTimeout(previewTimer);
             resultBlob = null;
             watermarkFile = null;
             imageInput.value = '';